@@ -4,7 +4,7 @@ from flask import Flask
 from flask_mongoengine import MongoEngine
 from src.lib import (
     taddy,
-    summarize,
+    pipeline,
 )
 from src.lib.models import (
     Episode,
@@ -28,6 +28,10 @@ def parse_args():
         "-ll", "--log_level", choices=log_levels,
         default="INFO", help="The log level (default: INFO)"
     )
+    parser.add_argument(
+        "--profile", action="store_true",
+        help="Profile the summarization job, the profile is saved to the database."
+    )
     return parser.parse_args()
 
 
@@ -39,7 +43,9 @@ if __name__ == "__main__":
     app.config["MONGODB_SETTINGS"] = {
         "db": "summpods",
         "host": "localhost",
-        "port": 27017
+        "port": 27017,
+        # defer connecting until first use so the client is created after fork
+        "connect": False,
     }
 
     db = MongoEngine()
@@ -50,7 +56,7 @@ if __name__ == "__main__":
         logger.info(podcast.name)
         episodes = taddy.get_episodes(podcast, limitPerPage=25)
 
-    summarize.transcribe_and_summarize(episodes[0])
+    pipeline.transcribe_and_summarize(episodes[0], profile=args.profile)
 
     logger.info(Podcast.objects())
     logger.info(Episode.objects())
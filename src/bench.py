@@ -0,0 +1,304 @@
+import argparse
+import concurrent.futures
+import logging
+import random
+import time
+import mongoengine
+from src.lib import backends, dedup, search
+from src.lib.models import SearchEntry, Transcription
+
+logger = logging.getLogger(__name__)
+
+# scratch database dropped and refilled by the benchmarks, never the app's
+SCRATCH_DB = "summpods_bench"
+
+
+def percentile(values, p):
+    """
+    Returns the p-th percentile of values using nearest-rank.
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def report(name, latencies):
+    """
+    Logs latency percentiles in milliseconds.
+    """
+    logger.info("{name}: n={n} p50={p50:.2f}ms p95={p95:.2f}ms p99={p99:.2f}ms max={max:.2f}ms".format(
+        name=name,
+        n=len(latencies),
+        p50=percentile(latencies, 50) * 1000,
+        p95=percentile(latencies, 95) * 1000,
+        p99=percentile(latencies, 99) * 1000,
+        max=max(latencies, default=0) * 1000,
+    ))
+
+
+def make_vocabulary(size, seed):
+    """
+    Returns size synthetic words and Zipf weights so generated text has a
+    realistic mix of common and rare terms.
+    """
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(letters) for _ in range(rng.randint(4, 10))))
+    words = sorted(words)
+    weights = [1 / (rank + 1) for rank in range(size)]
+    return words, weights
+
+
+def bench_search(args):
+    """
+    Fills a scratch database with synthetic search entries and measures index
+    build time and query latency.
+    """
+    mongoengine.connect(db=SCRATCH_DB, host="localhost", port=27017)
+    SearchEntry.drop_collection()
+
+    rng = random.Random(args.seed)
+    words, weights = make_vocabulary(args.vocabulary, args.seed)
+    collection = SearchEntry._get_collection()
+
+    logger.info("Inserting {n} entries...".format(n=args.num_docs))
+    start = time.perf_counter()
+    batch = []
+    for i in range(args.num_docs):
+        batch.append({
+            "episode_uuid": str(i),
+            "episode_name": " ".join(rng.choices(words, weights, k=6)),
+            "podcast_uuid": str(i % 500),
+            "podcast_name": " ".join(rng.choices(words, weights, k=3)),
+            "summary_text": " ".join(rng.choices(words, weights, k=args.summary_words)),
+            "transcription_text": " ".join(rng.choices(words, weights, k=args.transcript_words)),
+        })
+        if len(batch) == 1000:
+            collection.insert_many(batch)
+            batch = []
+    if batch:
+        collection.insert_many(batch)
+    logger.info("Inserted in {t:.1f}s".format(t=time.perf_counter() - start))
+
+    start = time.perf_counter()
+    SearchEntry.ensure_indexes()
+    logger.info("Built text index in {t:.1f}s".format(t=time.perf_counter() - start))
+
+    # query mid-frequency terms, the most common ones match nearly every document
+    query_words = words[len(words) // 100:len(words) // 10]
+    for terms_per_query in (1, 2):
+        for page in (1, 5):
+            latencies = []
+            for _ in range(args.num_queries):
+                query = " ".join(rng.sample(query_words, terms_per_query))
+                start = time.perf_counter()
+                search.search(query, page=page)
+                latencies.append(time.perf_counter() - start)
+            report("search terms={terms} page={page}".format(terms=terms_per_query, page=page), latencies)
+
+    if not args.keep:
+        SearchEntry.drop_collection()
+
+
+def mutate(words, rng, vocabulary, ratio):
+    """
+    Returns a copy of words with ratio of them replaced by random words, to
+    simulate a re-upload with a different intro or ad reads.
+    """
+    words = list(words)
+    for i in rng.sample(range(len(words)), int(len(words) * ratio)):
+        words[i] = rng.choice(vocabulary)
+    return words
+
+
+def bench_dedup(args):
+    """
+    Measures MinHash signing cost and LSH index build and query cost for
+    growing numbers of transcriptions.
+    """
+    mongoengine.connect(db=SCRATCH_DB, host="localhost", port=27017)
+    Transcription.drop_collection()
+    Transcription.ensure_indexes()
+    collection = Transcription._get_collection()
+
+    rng = random.Random(args.seed)
+    words, weights = make_vocabulary(args.vocabulary, args.seed)
+
+    sizes = sorted(args.sizes)
+    texts = []
+    sign_latencies = []
+    inserted = 0
+    for size in sizes:
+        start = time.perf_counter()
+        batch = []
+        while inserted < size:
+            text_words = rng.choices(words, weights, k=args.transcript_words)
+            texts.append(text_words)
+            sign_start = time.perf_counter()
+            signature = dedup.get_signature(" ".join(text_words))
+            sign_latencies.append(time.perf_counter() - sign_start)
+            batch.append({
+                "text": " ".join(text_words),
+                "minhash": signature,
+                "lsh_bands": dedup.get_band_keys(signature),
+            })
+            inserted += 1
+            if len(batch) == 1000:
+                collection.insert_many(batch)
+                batch = []
+        if batch:
+            collection.insert_many(batch)
+        logger.info("size={size}: indexed up to {size} transcriptions in {t:.1f}s".format(
+            size=size, t=time.perf_counter() - start))
+
+        duplicate_latencies = []
+        unique_latencies = []
+        found = 0
+        for _ in range(args.num_queries):
+            # a near duplicate of an indexed transcription should be found
+            duplicate = mutate(rng.choice(texts), rng, words, args.mutation)
+            transcription = dedup.sign(Transcription(text=" ".join(duplicate)))
+            start = time.perf_counter()
+            found += bool(dedup.find_near_duplicates(transcription, threshold=args.threshold))
+            duplicate_latencies.append(time.perf_counter() - start)
+
+            # an unrelated transcription should not be
+            unique = rng.choices(words, weights, k=args.transcript_words)
+            transcription = dedup.sign(Transcription(text=" ".join(unique)))
+            start = time.perf_counter()
+            dedup.find_near_duplicates(transcription, threshold=args.threshold)
+            unique_latencies.append(time.perf_counter() - start)
+
+        report("size={size} query duplicate".format(size=size), duplicate_latencies)
+        report("size={size} query unique".format(size=size), unique_latencies)
+        logger.info("size={size}: recall {recall:.3f} at {mutation:.0%} mutation".format(
+            size=size, recall=found / args.num_queries, mutation=args.mutation))
+
+    report("sign ({words} words)".format(words=args.transcript_words), sign_latencies)
+    Transcription.drop_collection()
+
+
+class StubEngine:
+    """
+    Stands in for a local transcription model by using real_time_factor
+    seconds of CPU time per second of audio, so pool overheads and scaling
+    across cores can be measured without model weights.
+    """
+
+    def __init__(self, real_time_factor, bitrate):
+        self.real_time_factor = real_time_factor
+        self.bitrate = bitrate
+
+    def load(self, threads):
+        pass
+
+    def transcribe(self, audio):
+        audio_seconds = len(audio) * 8 / self.bitrate
+        deadline = time.process_time() + audio_seconds * self.real_time_factor
+        while time.process_time() < deadline:
+            pass
+        return "stub", audio_seconds
+
+
+def bench_transcribe(args):
+    """
+    Measures the throughput of the process pool transcription backend for
+    growing pool sizes, using the stub engine unless a model path is given.
+    """
+    if args.model_path:
+        engine = backends.FasterWhisperEngine(args.model_path)
+        with open(args.audio, "rb") as f:
+            audio = f.read()
+    else:
+        engine = StubEngine(args.real_time_factor, args.bitrate)
+        audio = bytes(args.slice_seconds * args.bitrate // 8)
+
+    for processes in sorted(args.processes):
+        backend = backends.ProcessPoolBackend(engine, processes=processes, threads_per_process=args.threads)
+        start = time.perf_counter()
+        backend.transcribe(audio[:len(audio) // 100], "warm_up.mp3")
+        logger.info("processes={n}: pool started in {t:.1f}s".format(n=processes, t=time.perf_counter() - start))
+        backend.audio_seconds = backend.processing_seconds = 0.0
+
+        latencies = []
+
+        def transcribe(i):
+            slice_start = time.perf_counter()
+            backend.transcribe(audio, "{i}.mp3".format(i=i))
+            latencies.append(time.perf_counter() - slice_start)
+
+        start = time.perf_counter()
+        # submit from threads like the pipeline does, keeping every process busy
+        with concurrent.futures.ThreadPoolExecutor(processes * 2) as submitters:
+            list(submitters.map(transcribe, range(args.num_slices)))
+        elapsed = time.perf_counter() - start
+        backend.shutdown()
+
+        stats = backend.get_stats()
+        cores = processes * args.threads
+        report("processes={n} slice".format(n=processes), latencies)
+        logger.info(
+            "processes={n}: {audio:.0f}s of audio in {t:.1f}s, {throughput:.1f}x real time, "
+            "{per_core:.1f}x per core, real-time factor {rtf:.3f}".format(
+                n=processes,
+                audio=stats["audio_seconds"],
+                t=elapsed,
+                throughput=stats["audio_seconds"] / elapsed,
+                per_core=stats["audio_seconds"] / elapsed / cores,
+                rtf=stats["real_time_factor"] or 0,
+            ))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmarks for summpods library code.")
+    log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+    parser.add_argument(
+        "-ll", "--log_level", choices=log_levels,
+        default="INFO", help="The log level (default: INFO)"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    search_parser = subparsers.add_parser("search", help="Full-text search index and query latency.")
+    search_parser.add_argument("--num_docs", type=int, default=100000)
+    search_parser.add_argument("--num_queries", type=int, default=200)
+    search_parser.add_argument("--vocabulary", type=int, default=20000)
+    search_parser.add_argument("--summary_words", type=int, default=150)
+    search_parser.add_argument("--transcript_words", type=int, default=1000)
+    search_parser.add_argument("--keep", action="store_true", help="Keep the generated collection.")
+    search_parser.set_defaults(func=bench_search)
+
+    dedup_parser = subparsers.add_parser("dedup", help="MinHash signing and LSH index build and query cost.")
+    dedup_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    dedup_parser.add_argument("--num_queries", type=int, default=100)
+    dedup_parser.add_argument("--vocabulary", type=int, default=20000)
+    dedup_parser.add_argument("--transcript_words", type=int, default=1000)
+    dedup_parser.add_argument("--mutation", type=float, default=0.05,
+                              help="Fraction of words changed in near duplicates (default: 0.05)")
+    dedup_parser.add_argument("--threshold", type=float, default=dedup.SIMILARITY_THRESHOLD)
+    dedup_parser.set_defaults(func=bench_dedup)
+
+    transcribe_parser = subparsers.add_parser(
+        "transcribe", help="Local transcription backend throughput per core, with a stub engine by default.")
+    transcribe_parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    transcribe_parser.add_argument("--threads", type=int, default=1, help="Threads per process (default: 1)")
+    transcribe_parser.add_argument("--num_slices", type=int, default=16)
+    transcribe_parser.add_argument("--slice_seconds", type=int, default=600,
+                                   help="Audio seconds per stub slice (default: 600)")
+    transcribe_parser.add_argument("--bitrate", type=int, default=128000)
+    transcribe_parser.add_argument("--real_time_factor", type=float, default=0.02,
+                                   help="CPU seconds the stub engine uses per audio second (default: 0.02)")
+    transcribe_parser.add_argument("--model_path", help="Benchmark faster-whisper with these weights instead.")
+    transcribe_parser.add_argument("--audio", help="Audio file transcribed as every slice with --model_path.")
+    transcribe_parser.set_defaults(func=bench_transcribe)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+    args.func(args)
@@ -1,6 +1,9 @@
 class BaseConfig(object):
     DEBUG = False
     TESTING = False
+    MONGODB_DB = "summpods"
+    # share of summarization jobs profiled, see src/lib/profiling.py
+    PROFILE_SAMPLE_RATE = 0.0
 
 
 class ProductionConfig(BaseConfig):
@@ -14,3 +17,8 @@ class DevelopmentConfig(BaseConfig):
 
 class TestingConfig(BaseConfig):
     TESTING = True
+
+
+class LoadTestConfig(BaseConfig):
+    # scratch database filled and dropped by src/loadtest.py
+    MONGODB_DB = "summpods_loadtest"
@@ -0,0 +1,58 @@
+import argparse
+import gzip
+import logging
+import sys
+from datetime import datetime
+import mongoengine
+from src.lib import export
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Export summaries or transcriptions as newline delimited JSON. An interrupted export "
+                    "is resumed by passing the last cursor it logged."
+    )
+    log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+    parser.add_argument(
+        "-ll", "--log_level", choices=log_levels,
+        default="INFO", help="The log level (default: INFO)"
+    )
+    parser.add_argument("kind", choices=sorted(export.KINDS))
+    parser.add_argument("-o", "--output", help="The output file (default: stdout)")
+    parser.add_argument("--gzip", action="store_true", help="Gzip the output.")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Only export records created since (UTC).")
+    parser.add_argument("--podcast_uuid")
+    parser.add_argument("--model", help="Only export records of this summarization or transcription model.")
+    parser.add_argument("--cursor", help="Resume after the record with this id.")
+    parser.add_argument("--batch_size", type=int, default=export.DEFAULT_BATCH_SIZE)
+    parser.add_argument("--no_text", action="store_true", help="Leave out summary and transcription texts.")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    mongoengine.connect(db="summpods", host="localhost", port=27017)
+    if args.output:
+        output = gzip.open(args.output, "at", encoding="utf-8") if args.gzip else open(args.output, "a", encoding="utf-8")
+    else:
+        output = gzip.open(sys.stdout.buffer, "wt", encoding="utf-8") if args.gzip else sys.stdout
+
+    count = 0
+    with output:
+        for records in export.export(
+                args.kind,
+                since=args.since,
+                podcast_uuid=args.podcast_uuid,
+                model=args.model,
+                cursor=args.cursor,
+                batch_size=args.batch_size,
+                include_text=not args.no_text):
+            output.writelines(export.to_ndjson(records))
+            output.flush()
+            count += len(records)
+            logger.info("Exported {count} {kind}, cursor {cursor}".format(
+                count=count, kind=args.kind, cursor=records[-1]["id"]))
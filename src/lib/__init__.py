@@ -1,9 +1,21 @@
-from . import models, utils, taddy, transcribe, summarize
+from . import models, cache, memo, utils, persist, ratelimit, audiocache, backends, profiling, jobs, taddy, search, export, dedup, transcribe, summarize, pipeline
 
 __all__ = (
     "models",
+    "cache",
+    "memo",
     "utils",
+    "persist",
+    "ratelimit",
+    "audiocache",
+    "backends",
+    "profiling",
+    "jobs",
     "taddy",
+    "search",
+    "export",
+    "dedup",
     "transcribe",
     "summarize",
+    "pipeline",
 )
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# downloaded episode audio and audio slices transcoded from it are kept here,
+# None, or an empty AUDIO_CACHE_DIR, disables the cache
+CACHE_DIR = os.environ.get("AUDIO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "summpods_audio")) or None
+# the least recently used entries are evicted once the cache exceeds this size
+MAX_BYTES = 20 * 1024 ** 3
+# files no index refers to, left by crashed writers or replaced by newer
+# downloads, are removed once they are this old
+ORPHAN_SECONDS = 3600
+
+# Every entry has a json index file naming its data files. Data files get a
+# unique name and are written before the index is atomically replaced, so
+# concurrent readers and writers in other processes always see a complete
+# entry. The modification time of the index is the last use of the entry.
+_INDEX_SUFFIX = ".json"
+
+
+def _enabled():
+    return CACHE_DIR is not None and MAX_BYTES > 0
+
+
+def _get_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _read_index(key):
+    try:
+        with open(os.path.join(CACHE_DIR, key + _INDEX_SUFFIX)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_file(name, write):
+    # writes to a temporary file first so no reader ever sees a partial file
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, prefix=".", suffix=".tmp", delete=False) as f:
+        write(f)
+    os.replace(f.name, os.path.join(CACHE_DIR, name))
+
+
+def _write_index(key, index):
+    _write_file(key + _INDEX_SUFFIX, lambda f: f.write(json.dumps(index).encode()))
+
+
+def _open(name, stack):
+    # an open file stays readable even if the entry is evicted meanwhile
+    return stack.enter_context(open(os.path.join(CACHE_DIR, name), "rb"))
+
+
+def _touch(key):
+    try:
+        os.utime(os.path.join(CACHE_DIR, key + _INDEX_SUFFIX))
+    except FileNotFoundError:
+        pass
+
+
+def get_validators(url):
+    """
+    Returns the conditional request headers revalidating the cached audio of
+    url, empty if it is not cached or has no ETag or Last-Modified date.
+    """
+    if not _enabled() or (index := _read_index(_get_key(url))) is None:
+        return {}
+    headers = {}
+    if index.get("etag"):
+        headers["If-None-Match"] = index["etag"]
+    if index.get("last_modified"):
+        headers["If-Modified-Since"] = index["last_modified"]
+    return headers
+
+
+def load(url, stack):
+    """
+    Opens the cached audio of url.
+
+    Args:
+        url (str): The url of the audio file.
+        stack (contextlib.ExitStack): The file is closed with the stack.
+
+    Returns:
+        BinaryIO or None: The audio file, or None if it is not cached.
+    """
+    if not _enabled() or (index := _read_index(key := _get_key(url))) is None:
+        return None
+    try:
+        audio_file = _open(index["file"], stack)
+    except FileNotFoundError:
+        # evicted by another process since the index was read
+        return None
+    if os.fstat(audio_file.fileno()).st_size != index["size"]:
+        return None
+    _touch(key)
+    logger.debug("Found {size} bytes of cached audio".format(size=index["size"]))
+    return audio_file
+
+
+def store(url, audio, headers):
+    """
+    Caches the audio of url with the validators of the response it was
+    downloaded with, replacing any previously cached audio, and evicts least
+    recently used entries if the cache is full. Failures are logged and ignored.
+
+    Args:
+        url (str): The url of the audio file.
+        audio (memoryview): The downloaded audio.
+        headers (Mapping[str, str]): The response headers.
+    """
+    if not _enabled() or len(audio) > MAX_BYTES:
+        return
+    key = _get_key(url)
+    name = "{key}.{version}.audio".format(key=key, version=uuid.uuid4().hex[:8])
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _write_file(name, lambda f: f.write(audio))
+        _write_index(key, {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": len(audio),
+            "file": name,
+        })
+        logger.debug("Cached {size} bytes of audio".format(size=len(audio)))
+        evict()
+    except OSError as e:
+        logger.warning("Could not cache audio: {error}".format(error=e))
+
+
+def _get_splits_key(audio, params):
+    digest = hashlib.blake2b(audio, digest_size=16)
+    digest.update(json.dumps(params).encode())
+    return digest.hexdigest() + ".splits"
+
+
+def load_splits(audio, params):
+    """
+    Returns the cached slices transcoded from audio, see transcribe._split_with_pydub.
+
+    Args:
+        audio (memoryview): The audio the slices were cut from.
+        params (list): The JSON serializable parameters the slices were cut with.
+
+    Returns:
+        Tuple[List[int], List[int], List[memoryview]] or None: The slice boundaries,
+            the slice ends and the slices, or None if they are not cached.
+    """
+    if not _enabled() or (index := _read_index(key := _get_splits_key(audio, params))) is None:
+        return None
+    splits = []
+    try:
+        for name in index["files"]:
+            with open(os.path.join(CACHE_DIR, name), "rb") as f:
+                splits.append(memoryview(f.read()))
+    except FileNotFoundError:
+        return None
+    _touch(key)
+    logger.debug("Loaded {n} cached audio slices".format(n=len(splits)))
+    return index["boundaries"], index["ends"], splits
+
+
+def store_splits(audio, params, boundaries, ends, splits):
+    """
+    Caches the slices transcoded from audio. Failures are logged and ignored.
+
+    Args:
+        audio (memoryview): The audio the slices were cut from.
+        params (list): The JSON serializable parameters the slices were cut with.
+        boundaries (List[int]): The boundaries of the slices.
+        ends (List[int]): The ends of the slices.
+        splits (List[memoryview]): The slices.
+    """
+    if not _enabled():
+        return
+    key = _get_splits_key(audio, params)
+    version = uuid.uuid4().hex[:8]
+    names = ["{key}.{version}.{i}.mp3".format(key=key, version=version, i=i) for i in range(len(splits))]
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        for name, split in zip(names, splits):
+            _write_file(name, lambda f: f.write(split))
+        _write_index(key, {"boundaries": boundaries, "ends": ends, "files": names})
+        evict()
+    except OSError as e:
+        logger.warning("Could not cache audio slices: {error}".format(error=e))
+
+
+def _get_size(name):
+    try:
+        return os.path.getsize(os.path.join(CACHE_DIR, name))
+    except FileNotFoundError:
+        return 0
+
+
+def evict(max_bytes=None):
+    """
+    Removes least recently used entries until the cache is at most max_bytes,
+    and files no entry refers to.
+
+    Args:
+        max_bytes (int, optional): The size to shrink the cache to, MAX_BYTES by default.
+
+    Returns:
+        int: The number of bytes removed.
+    """
+    max_bytes = MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    referenced = set()
+    orphans = []
+    now = time.time()
+    if not os.path.isdir(CACHE_DIR):
+        return 0
+    for entry in os.scandir(CACHE_DIR):
+        if entry.name.endswith(_INDEX_SUFFIX):
+            if (index := _read_index(entry.name[:-len(_INDEX_SUFFIX)])) is None:
+                continue
+            files = [index["file"]] if "file" in index else index["files"]
+            referenced.update(files)
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, entry.name, files, stat.st_size + sum(_get_size(name) for name in files)))
+        else:
+            orphans.append(entry)
+
+    removed = 0
+    for entry in orphans:
+        try:
+            if entry.name not in referenced and now - entry.stat().st_mtime > ORPHAN_SECONDS:
+                removed += entry.stat().st_size
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+
+    total = sum(size for _, _, _, size in entries)
+    for _, name, files, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        # the index goes first so readers miss instead of finding missing files
+        for file_name in [name] + files:
+            try:
+                os.remove(os.path.join(CACHE_DIR, file_name))
+            except FileNotFoundError:
+                pass
+        total -= size
+        removed += size
+    if removed:
+        logger.info("Evicted {removed} bytes from the audio cache".format(removed=removed))
+    return removed
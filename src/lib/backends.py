@@ -0,0 +1,196 @@
+import concurrent.futures
+import io
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from src.lib.utils import (
+    get_openai,
+)
+from src.lib import ratelimit
+
+logger = logging.getLogger(__name__)
+
+# directory of the CTranslate2 whisper weights used by the local engine, e.g. a
+# model converted with `ct2-transformers-converter --quantization int8`
+LOCAL_MODEL_PATH = os.environ.get("WHISPER_MODEL_PATH", "/models/whisper")
+# decoding threads per local engine process, the pool runs one process per
+# THREADS_PER_PROCESS cores so slices are transcribed in parallel
+THREADS_PER_PROCESS = 2
+BEAM_SIZE = 1
+
+# the engine loaded in a pool process
+_engine = None
+
+
+class WhisperAPIBackend:
+    """
+    Transcribes with the OpenAI whisper API, throttled by the shared rate limiter.
+    """
+
+    def transcribe(self, audio_file, name):
+        """
+        Transcribes one in-memory audio file.
+
+        Args:
+            audio_file (memoryview): The audio file.
+            name (str): The file name sent with the file.
+
+        Returns:
+            str: The transcription text.
+        """
+        transcription_result = ratelimit.call("whisper-1", lambda: get_openai().Audio.transcribe_raw(
+            "whisper-1", audio_file, name))
+        logger.debug(transcription_result)
+        return transcription_result["text"]
+
+
+class FasterWhisperEngine:
+    """
+    Runs an int8 quantized whisper model on the CPU with faster-whisper. The
+    weights are read from model_path, nothing is downloaded.
+    """
+
+    def __init__(self, model_path=None, beam_size=BEAM_SIZE):
+        self.model_path = model_path or LOCAL_MODEL_PATH
+        self.beam_size = beam_size
+        self._model = None
+
+    def load(self, threads):
+        from faster_whisper import WhisperModel
+        self._model = WhisperModel(self.model_path, device="cpu", compute_type="int8", cpu_threads=threads)
+
+    def transcribe(self, audio):
+        """
+        Returns:
+            Tuple[str, float]: The transcription text and the audio duration in seconds.
+        """
+        segments, info = self._model.transcribe(io.BytesIO(audio), beam_size=self.beam_size)
+        return " ".join(segment.text.strip() for segment in segments), info.duration
+
+
+def _init_process(engine, threads):
+    global _engine
+    engine.load(threads)
+    _engine = engine
+
+
+def _transcribe_in_process(audio):
+    start = time.perf_counter()
+    text, audio_seconds = _engine.transcribe(audio)
+    return text, audio_seconds, time.perf_counter() - start
+
+
+class ProcessPoolBackend:
+    """
+    Transcribes with a local engine running in a pool of processes, so slices
+    transcribed concurrently by the pipeline use separate cores. Each process
+    loads the engine once. The pool is started on first use.
+
+    Args:
+        engine: Has load(threads), called once per process, and transcribe(audio)
+            returning the text and the audio duration in seconds. Must be picklable.
+        processes (int, optional): The pool size, one per THREADS_PER_PROCESS cores by default.
+        threads_per_process (int, optional): The threads each process may use.
+    """
+
+    def __init__(self, engine, processes=None, threads_per_process=THREADS_PER_PROCESS):
+        self.engine = engine
+        self.threads_per_process = threads_per_process
+        self.processes = processes or max(1, (os.cpu_count() or 1) // threads_per_process)
+        self.audio_seconds = 0.0
+        self.processing_seconds = 0.0
+        self._pool = None
+        self._lock = threading.Lock()
+        # the pool's processes belong to the parent
+        os.register_at_fork(after_in_child=self._forget_pool)
+
+    def _forget_pool(self):
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                logger.info("Starting {n} transcription processes...".format(n=self.processes))
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.processes,
+                    # forking a process with database and http clients in use is unsafe
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_process,
+                    initargs=(self.engine, self.threads_per_process),
+                )
+            return self._pool
+
+    def transcribe(self, audio_file, name):
+        """
+        Transcribes one in-memory audio file in a pool process and logs the
+        real-time factor, the processing time per second of audio.
+
+        Args:
+            audio_file (memoryview): The audio file.
+            name (str): The file name, used for logging.
+
+        Returns:
+            str: The transcription text.
+        """
+        text, audio_seconds, seconds = self._get_pool().submit(_transcribe_in_process, bytes(audio_file)).result()
+        with self._lock:
+            self.audio_seconds += audio_seconds
+            self.processing_seconds += seconds
+        logger.info("Transcribed {name}: {audio:.0f}s of audio in {seconds:.1f}s, real-time factor {rtf:.3f}".format(
+            name=name, audio=audio_seconds, seconds=seconds, rtf=seconds / audio_seconds if audio_seconds else 0))
+        return text
+
+    def get_stats(self):
+        """
+        Returns the audio and processing seconds transcribed by this process
+        and their ratio, the average real-time factor.
+        """
+        with self._lock:
+            return {
+                "audio_seconds": self.audio_seconds,
+                "processing_seconds": self.processing_seconds,
+                "real_time_factor": self.processing_seconds / self.audio_seconds if self.audio_seconds else None,
+            }
+
+    def shutdown(self):
+        """
+        Stops the pool processes, they are started again on the next call.
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+# backends by TranscriptionModel.name
+BACKENDS = {
+    "whisper": WhisperAPIBackend(),
+    "whisper-local": ProcessPoolBackend(FasterWhisperEngine()),
+}
+
+
+def register(name, backend):
+    """
+    Registers a transcription backend for the transcription model with the given name.
+
+    Args:
+        name (str): The TranscriptionModel name.
+        backend: Has transcribe(audio_file, name) returning the transcription text.
+    """
+    BACKENDS[name] = backend
+
+
+def get_backend(name):
+    """
+    Returns the transcription backend for the transcription model with the given name.
+
+    Raises:
+        Exception: If no backend is registered for the model.
+    """
+    if name not in BACKENDS:
+        raise Exception("No transcription backend for model {name}, available: {names}".format(
+            name=name, names=", ".join(sorted(BACKENDS))))
+    return BACKENDS[name]
@@ -0,0 +1,144 @@
+import hashlib
+import logging
+import random
+import re
+import struct
+import zlib
+from src.lib.models import (
+    Transcription,
+)
+
+logger = logging.getLogger(__name__)
+
+# words per shingle
+SHINGLE_SIZE = 3
+# signature length, split into NUM_BANDS bands of NUM_PERMUTATIONS / NUM_BANDS rows.
+# With 32 bands of 4 rows transcripts above the similarity threshold are nearly
+# always candidates while ones below 0.3 rarely are.
+NUM_PERMUTATIONS = 128
+NUM_BANDS = 32
+# minimum estimated jaccard similarity of the shingle sets for transcripts to be
+# considered duplicates. Transcripts of the same audio with ~5% of words differing
+# (whisper noise, a new ad read) score around 0.75, different episodes of the same
+# show well below 0.2.
+SIMILARITY_THRESHOLD = 0.65
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# permutations are fixed so signatures stay comparable across processes and releases
+_rng = random.Random(1)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERMUTATIONS)
+]
+
+
+def get_shingle_hashes(text):
+    """
+    Returns the set of 32 bit hashes of the word shingles of text.
+
+    Args:
+        text (str): The text to shingle.
+
+    Returns:
+        set[int]: The shingle hashes.
+    """
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_SIZE:
+        words += [""] * (SHINGLE_SIZE - len(words))
+    return {
+        zlib.crc32(" ".join(words[i:i + SHINGLE_SIZE]).encode())
+        for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def get_signature(text):
+    """
+    Computes the MinHash signature of text.
+
+    Args:
+        text (str): The text to sign.
+
+    Returns:
+        List[int]: NUM_PERMUTATIONS minimum hash values.
+    """
+    hashes = get_shingle_hashes(text)
+    return [
+        min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMUTATIONS
+    ]
+
+
+def get_band_keys(signature):
+    """
+    Returns the LSH band keys for a signature. Two signatures sharing any key
+    are candidate duplicates.
+
+    Args:
+        signature (List[int]): A MinHash signature.
+
+    Returns:
+        List[str]: One key per band.
+    """
+    rows = len(signature) // NUM_BANDS
+    return [
+        "{band}:{digest}".format(
+            band=band,
+            digest=hashlib.blake2b(
+                struct.pack("<{n}I".format(n=rows), *signature[band * rows:(band + 1) * rows]),
+                digest_size=8).hexdigest())
+        for band in range(NUM_BANDS)
+    ]
+
+
+def estimate_similarity(signature, other_signature):
+    """
+    Estimates the jaccard similarity of the texts two signatures belong to.
+    """
+    return sum(a == b for a, b in zip(signature, other_signature)) / len(signature)
+
+
+def sign(transcription):
+    """
+    Sets the MinHash signature and LSH band keys of a transcription. Called
+    before a transcription is saved so it is indexed for duplicate lookups.
+
+    Args:
+        transcription (Transcription): The transcription to sign.
+
+    Returns:
+        Transcription: The signed transcription.
+    """
+    transcription.minhash = get_signature(transcription.text)
+    transcription.lsh_bands = get_band_keys(transcription.minhash)
+    return transcription
+
+
+def find_near_duplicates(transcription, threshold=SIMILARITY_THRESHOLD):
+    """
+    Finds other transcriptions whose text is nearly identical to the given
+    transcription using the LSH band index.
+
+    Args:
+        transcription (Transcription): A signed transcription.
+        threshold (float, optional): The minimum estimated jaccard similarity.
+
+    Returns:
+        List[Tuple[float, Transcription]]: Similarity and transcription of each
+            duplicate, most similar first. Only ids and signatures are loaded.
+    """
+    if not transcription.lsh_bands:
+        return []
+    candidates = Transcription.objects(
+        lsh_bands__in=transcription.lsh_bands,
+        id__ne=transcription.id,
+    ).only("id", "minhash")
+
+    duplicates = []
+    for candidate in candidates:
+        similarity = estimate_similarity(transcription.minhash, candidate.minhash)
+        if similarity >= threshold:
+            duplicates.append((similarity, candidate))
+    duplicates.sort(key=lambda duplicate: duplicate[0], reverse=True)
+    logger.debug("Found {n} near duplicate transcriptions".format(n=len(duplicates)))
+    return duplicates
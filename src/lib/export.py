@@ -0,0 +1,163 @@
+import json
+import logging
+from bson import ObjectId
+from pymongo.errors import CursorNotFound
+from src.lib.models import (
+    Summary,
+    Transcription,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+
+# exported collections and the fields exported from each, text is optional
+KINDS = {
+    "summaries": (Summary, ("creation_date", "podcast_uuid", "transcription", "summarization_model", "prompt")),
+    "transcriptions": (Transcription, ("creation_date", "podcast_uuid", "episode", "transcription_model")),
+}
+
+
+def get_filter(kind, since=None, podcast_uuid=None, model=None, cursor=None):
+    """
+    Builds the query for an export.
+
+    Args:
+        kind (str): One of KINDS.
+        since (datetime, optional): Only export documents created at or after since (UTC).
+        podcast_uuid (str, optional): Only export documents of this podcast.
+        model (str, optional): Only export documents of this summarization or
+            transcription model, depending on kind.
+        cursor (str, optional): The id of the last document of a previous export,
+            only documents after it are exported.
+
+    Returns:
+        dict: The query.
+
+    Raises:
+        ValueError: If cursor is not a valid id.
+    """
+    query = {}
+    id_range = {}
+    if since is not None:
+        query["creation_date"] = {"$gte": since}
+        # documents are inserted after their creation date so this bounds the
+        # _id index scan without dropping any
+        id_range["$gte"] = ObjectId.from_datetime(since)
+    if cursor:
+        if not ObjectId.is_valid(cursor):
+            raise ValueError("Invalid cursor {cursor}".format(cursor=cursor))
+        id_range["$gt"] = ObjectId(cursor)
+    if id_range:
+        query["_id"] = id_range
+    if podcast_uuid is not None:
+        query["podcast_uuid"] = podcast_uuid
+    if model is not None:
+        query["summarization_model" if kind == "summaries" else "transcription_model"] = model
+    return query
+
+
+def _get_episode_uuids(transcription_ids):
+    return {
+        transcription["_id"]: transcription.get("episode")
+        for transcription in Transcription._get_collection().find(
+            {"_id": {"$in": list(transcription_ids)}}, {"episode": 1})
+    }
+
+
+def _to_record(kind, document, episode_uuids):
+    record = {
+        "id": str(document["_id"]),
+        "creation_date": document["creation_date"].isoformat() if document.get("creation_date") else None,
+        "podcast_uuid": document.get("podcast_uuid"),
+    }
+    if kind == "summaries":
+        record["episode_uuid"] = episode_uuids.get(document.get("transcription"))
+        record["transcription_id"] = str(document["transcription"]) if document.get("transcription") else None
+        record["summarization_model"] = document.get("summarization_model")
+        record["prompt"] = document.get("prompt")
+    else:
+        record["episode_uuid"] = document.get("episode")
+        record["transcription_model"] = document.get("transcription_model")
+    if "text" in document:
+        record["text"] = document["text"]
+    return record
+
+
+def _to_records(kind, batch):
+    episode_uuids = {}
+    if kind == "summaries":
+        episode_uuids = _get_episode_uuids({
+            document["transcription"] for document in batch if document.get("transcription")})
+    return [_to_record(kind, document, episode_uuids) for document in batch]
+
+
+def export(kind, since=None, podcast_uuid=None, model=None, cursor=None,
+           batch_size=DEFAULT_BATCH_SIZE, include_text=True):
+    """
+    Streams the documents of an export in _id order, one batch in memory at a
+    time. Episode uuids of summaries are looked up once per batch. If the
+    server side cursor times out, e.g. because the consumer is slow, the
+    export continues from the last document returned.
+
+    Args:
+        kind (str): One of KINDS.
+        since, podcast_uuid, model, cursor: Filters, see get_filter.
+        batch_size (int, optional): The number of documents fetched per round trip.
+        include_text (bool, optional): Whether to export the text of each document.
+
+    Yields:
+        List[dict]: The records of each batch. The id of the last record is the
+            cursor to resume the export from.
+
+    Raises:
+        ValueError: If kind or cursor is invalid.
+    """
+    if kind not in KINDS:
+        raise ValueError("Unknown export {kind}".format(kind=kind))
+    document_class, fields = KINDS[kind]
+    projection = dict.fromkeys(fields + (("text",) if include_text else ()), 1)
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    collection = document_class._get_collection()
+
+    while True:
+        documents = collection.find(
+            get_filter(kind, since, podcast_uuid, model, cursor),
+            projection,
+            sort=[("_id", 1)],
+            batch_size=batch_size,
+        )
+        try:
+            batch = []
+            for document in documents:
+                batch.append(document)
+                if len(batch) == batch_size:
+                    yield _to_records(kind, batch)
+                    cursor = str(batch[-1]["_id"])
+                    batch = []
+            if batch:
+                yield _to_records(kind, batch)
+            return
+        except CursorNotFound:
+            logger.warning("Export cursor timed out, resuming after {cursor}".format(cursor=cursor))
+        finally:
+            documents.close()
+
+
+def to_ndjson(records):
+    """
+    Returns the newline delimited JSON lines of records.
+    """
+    return [json.dumps(record, ensure_ascii=False) + "\n" for record in records]
+
+
+def export_ndjson(kind, **kwargs):
+    """
+    Streams an export as newline delimited JSON, see export.
+
+    Yields:
+        str: The lines of each batch.
+    """
+    for records in export(kind, **kwargs):
+        yield "".join(to_ndjson(records))
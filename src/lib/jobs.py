@@ -0,0 +1,449 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from mongoengine import DoesNotExist, NotUniqueError, Q
+from src.lib.models import (
+    Job,
+)
+from src.lib import persist, profiling
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# priority lanes of queued jobs, highest first: summaries requested by users,
+# summaries of episodes nobody asked for yet, and summaries redone with another model
+INTERACTIVE = "interactive"
+BACKFILL = "backfill"
+RESUMMARIZE = "resummarize"
+LANES = (INTERACTIVE, BACKFILL, RESUMMARIZE)
+# job slots of the workers, set by worker.py from --slots
+SLOTS = 4
+# slots the lower lanes together leave free for interactive jobs
+RESERVED_SLOTS = 1
+# a job yields its worker between slices or chunks when a job of a higher lane
+# has been queued for this long without a free worker
+PREEMPT_AFTER_SECONDS = 10
+# how often a running job checks whether it should yield
+PREEMPT_CHECK_SECONDS = 5
+
+# a lease not renewed for this long is considered abandoned by a crashed process
+LEASE_SECONDS = 60
+HEARTBEAT_SECONDS = 15
+# how often requesters attached to a running job check for its result
+POLL_SECONDS = 2
+
+# the job run by the current thread, if any
+_current = threading.local()
+
+
+class Preempted(Exception):
+    """
+    Raised in a job that yields its worker to a job of a higher lane. The job
+    is queued again and resumes from its checkpoints.
+    """
+
+
+def get_job_key(episode, transcription_model, summarization_model, prompt):
+    """
+    Returns the key identifying a summarization job.
+
+    Args:
+        episode (Episode): The episode to summarize.
+        transcription_model (TranscriptionModel): The transcription model.
+        summarization_model (SummarizationModel): The summarization model.
+        prompt (str): The prompt, or a name for how it is chosen.
+
+    Returns:
+        str: The job key.
+    """
+    return ":".join((episode.uuid, transcription_model.name, summarization_model.name, prompt))
+
+
+def get_owner():
+    """
+    Returns an identifier for the calling thread, unique across hosts and processes.
+    """
+    return "{host}:{pid}:{thread}:{nonce}".format(
+        host=socket.gethostname(),
+        pid=os.getpid(),
+        thread=threading.get_ident(),
+        nonce=uuid.uuid4().hex[:8],
+    )
+
+
+def _get_summary(job):
+    # the summary of a done job, None if it has been deleted since
+    try:
+        return job.summary
+    except DoesNotExist:
+        return None
+
+
+def acquire(key, owner, **fields):
+    """
+    Tries to take the lease of a job. Succeeds if the job does not exist yet,
+    is not running, or its lease has expired because its owner stopped sending
+    heartbeats.
+
+    Args:
+        key (str): The job key.
+        owner (str): The identifier of the caller.
+        **fields: Job fields set when the job is created.
+
+    Returns:
+        Job or None: The job if the lease was acquired, otherwise None.
+    """
+    now = datetime.utcnow()
+    lease_expires = now + timedelta(seconds=LEASE_SECONDS)
+    try:
+        job = Job(key=key, status=RUNNING, owner=owner, start_date=now, heartbeat=now, lease_expires=lease_expires,
+                  **fields)
+        job.save(force_insert=True)
+        logger.debug("Acquired new job {key}".format(key=key))
+        return job
+    except NotUniqueError:
+        pass
+
+    job = Job.objects(Q(key=key) & (Q(status__ne=RUNNING) | Q(lease_expires__lt=now))).modify(
+        new=True,
+        set__status=RUNNING,
+        set__owner=owner,
+        set__start_date=now,
+        set__heartbeat=now,
+        set__lease_expires=lease_expires,
+        unset__error=True,
+    )
+    if job:
+        logger.info("Took over job {key}".format(key=key))
+    return job
+
+
+def enqueue(key, lane, profiling=False, **fields):
+    """
+    Queues a job for a worker in the given lane. A job that is already queued
+    or running is moved up to lane if that has a higher priority, a failed job
+    is queued again, as is a done job whose summary has been deleted, and other
+    done jobs are left alone.
+
+    Args:
+        key (str): The job key.
+        lane (str): One of LANES.
+        profiling (bool, optional): Whether the worker should profile the job.
+        **fields: Job fields set when the job is created, podcast_uuid is used
+            to share workers fairly between podcasts.
+
+    Returns:
+        Job: The job.
+    """
+    now = datetime.utcnow()
+    try:
+        job = Job(key=key, status=QUEUED, lane=lane, profiling=profiling, enqueue_date=now, **fields)
+        job.save(force_insert=True)
+        logger.debug("Queued job {key} in lane {lane}".format(key=key, lane=lane))
+        return job
+    except NotUniqueError:
+        pass
+
+    retry = Q(status=FAILED)
+    if (job := Job.objects(key=key, status=DONE).first()) is not None and _get_summary(job) is None:
+        # unless it was run again meanwhile
+        retry |= Q(status=DONE, finish_date=job.finish_date)
+    if Job.objects(Q(key=key) & retry).update_one(
+            set__status=QUEUED, set__lane=lane, set__profiling=profiling, set__enqueue_date=now,
+            unset__owner=True, unset__summary=True):
+        logger.debug("Queued job {key} again in lane {lane}".format(key=key, lane=lane))
+    elif Job.objects(key=key, status__in=(QUEUED, RUNNING), lane__in=LANES[LANES.index(lane) + 1:]).update_one(
+            set__lane=lane):
+        logger.debug("Moved job {key} up to lane {lane}".format(key=key, lane=lane))
+    return Job.objects(key=key).first()
+
+
+def _claimable(now):
+    # queued jobs and jobs whose worker crashed
+    return Q(status=QUEUED) | (Q(status=RUNNING) & Q(lease_expires__lt=now))
+
+
+def get_lane_concurrency():
+    """
+    Returns the maximum number of running jobs of each lane and the lanes
+    below it together, across all workers. Lower lanes leave RESERVED_SLOTS
+    of the SLOTS free for interactive jobs, and resummarize jobs take at most
+    a quarter of them. Workers with a single slot run lower lanes too, and
+    rely on preemption to make room for interactive jobs.
+    """
+    return {
+        INTERACTIVE: SLOTS,
+        BACKFILL: max(1, SLOTS - RESERVED_SLOTS),
+        RESUMMARIZE: max(1, SLOTS // 4),
+    }
+
+
+def _is_full(lane, lane_counts, lane_concurrency):
+    # a job of lane counts towards the limits of the lanes above it too
+    return any(
+        sum(lane_counts[lower_lane] for lower_lane in LANES[i:]) >= lane_concurrency[LANES[i]]
+        for i in range(LANES.index(lane) + 1)
+    )
+
+
+def _get_running_counts(now):
+    lanes, podcasts = Counter(), Counter()
+    for job in Job.objects(status=RUNNING, lease_expires__gte=now).only("lane", "podcast_uuid"):
+        lanes[job.lane] += 1
+        podcasts[job.podcast_uuid] += 1
+    return lanes, podcasts
+
+
+def claim(owner):
+    """
+    Takes the lease of the next queued job. Lanes are served in priority order
+    as long as they are below their concurrency, see get_lane_concurrency. Within a
+    lane the podcast with the fewest running jobs goes first, so one podcast
+    with many episodes does not hold up the others, then the job queued
+    earliest.
+
+    Args:
+        owner (str): The identifier of the worker.
+
+    Returns:
+        Job or None: The claimed job, or None if there is nothing to run.
+    """
+    now = datetime.utcnow()
+    lane_counts, podcast_counts = _get_running_counts(now)
+    lane_concurrency = get_lane_concurrency()
+    for lane in LANES:
+        if _is_full(lane, lane_counts, lane_concurrency):
+            continue
+        podcasts = Job.objects(_claimable(now) & Q(lane=lane)).aggregate([
+            {"$group": {"_id": "$podcast_uuid", "enqueue_date": {"$min": "$enqueue_date"}}},
+        ])
+        podcasts = sorted(podcasts, key=lambda podcast: (podcast_counts[podcast["_id"]], podcast["enqueue_date"]))
+        for podcast in podcasts:
+            for candidate in Job.objects(_claimable(now) & Q(lane=lane, podcast_uuid=podcast["_id"])) \
+                    .order_by("enqueue_date").only("key").limit(10):
+                job = Job.objects(Q(key=candidate.key) & _claimable(now)).modify(
+                    new=True,
+                    set__status=RUNNING,
+                    set__owner=owner,
+                    set__start_date=now,
+                    set__heartbeat=now,
+                    set__lease_expires=now + timedelta(seconds=LEASE_SECONDS),
+                    unset__error=True,
+                )
+                if job is not None:
+                    logger.info("Claimed job {key} in lane {lane}".format(key=job.key, lane=lane))
+                    return job
+    return None
+
+
+def should_yield(key, lane):
+    """
+    Returns whether the running job key of the given lane should yield its
+    worker to a job of a higher lane which has been waiting for one for more
+    than PREEMPT_AFTER_SECONDS while its lane is below its concurrency. As
+    many jobs yield as there are such waiting jobs without a free slot, those
+    of the lowest lane that started most recently first.
+    """
+    higher_lanes = LANES[:LANES.index(lane)] if lane in LANES else ()
+    if not higher_lanes:
+        return False
+    now = datetime.utcnow()
+    lane_counts, _ = _get_running_counts(now)
+    lane_concurrency = get_lane_concurrency()
+    waiting_since = now - timedelta(seconds=PREEMPT_AFTER_SECONDS)
+    waiting = sum(
+        min(Job.objects(status=QUEUED, lane=higher_lane, enqueue_date__lt=waiting_since).count(),
+            max(0, lane_concurrency[higher_lane] - lane_counts[higher_lane]))
+        for higher_lane in higher_lanes
+    )
+    # waiting jobs are claimed by free slots, e.g. those of jobs that just yielded
+    if (waiting := waiting - max(0, SLOTS - sum(lane_counts.values()))) <= 0:
+        return False
+    running = Job.objects(status=RUNNING, lease_expires__gte=now, lane__in=LANES[LANES.index(lane):]) \
+        .only("key", "lane", "start_date")
+    running = sorted(running, key=lambda job: (LANES.index(job.lane), job.start_date or datetime.min), reverse=True)
+    return key in [job.key for job in running[:waiting]]
+
+
+def checkpoint():
+    """
+    Marks a point between slices or chunks of the job run by the calling
+    thread where it can stop and resume later from its checkpoints. Checks at
+    most every PREEMPT_CHECK_SECONDS whether the job should yield its worker.
+    Does nothing outside of a job run by a worker.
+
+    Raises:
+        Preempted: If the job should yield its worker.
+    """
+    if (lane := getattr(_current, "lane", None)) is None:
+        return
+    now = time.monotonic()
+    if now - _current.checked < PREEMPT_CHECK_SECONDS:
+        return
+    _current.checked = now
+    if should_yield(_current.key, lane):
+        raise Preempted("Job {key} yields to a job of a higher lane".format(key=_current.key))
+
+
+def requeue(key, owner):
+    """
+    Queues a job held by owner again, keeping its place in its lane.
+    """
+    Job.objects(key=key, owner=owner).update_one(
+        set__status=QUEUED,
+        unset__owner=True,
+        unset__stage=True,
+        inc__preemptions=1,
+    )
+
+
+def renew(key, owner):
+    """
+    Extends the lease of a job held by owner.
+
+    Returns:
+        bool: False if the lease has been taken over by someone else.
+    """
+    now = datetime.utcnow()
+    return bool(Job.objects(key=key, owner=owner, status=RUNNING).update_one(
+        set__heartbeat=now,
+        set__lease_expires=now + timedelta(seconds=LEASE_SECONDS),
+    ))
+
+
+def finish(key, owner, summary, writes=None):
+    """
+    Marks a job held by owner as done with the given summary and the number
+    of database writes it made.
+    """
+    Job.objects(key=key, owner=owner).update_one(
+        set__status=DONE,
+        set__summary=summary,
+        set__finish_date=datetime.utcnow(),
+        set__writes=writes,
+    )
+
+
+def fail(key, owner, error):
+    """
+    Marks a job held by owner as failed so attached requesters stop waiting
+    and the next request retries it.
+    """
+    Job.objects(key=key, owner=owner).update_one(
+        set__status=FAILED,
+        set__error=str(error),
+        set__finish_date=datetime.utcnow(),
+    )
+
+
+def report_progress(**progress):
+    """
+    Records progress of the job run by the calling thread, e.g.
+    report_progress(stage="transcribing", slices_done=2, slices_total=6).
+    Does nothing outside of a job. Stage changes are also recorded in the
+    profile of profiled jobs.
+    """
+    if (key := getattr(_current, "key", None)) is None:
+        return
+    if "stage" in progress:
+        profiling.on_stage(progress["stage"])
+    Job.objects(key=key, owner=_current.owner).update_one(
+        **{"set__{field}".format(field=field): value for field, value in progress.items()})
+
+
+def _heartbeat(key, owner, stopped):
+    while not stopped.wait(HEARTBEAT_SECONDS):
+        if not renew(key, owner):
+            logger.warning("Lost lease of job {key}".format(key=key))
+            return
+
+
+def run(key, owner, fn, lane=None):
+    """
+    Runs fn for a job whose lease is held by owner, sending heartbeats while
+    it runs and recording its result or error, and the database writes made
+    by fn (see persist.count_writes).
+
+    Args:
+        key (str): The job key.
+        owner (str): The identifier of the caller.
+        fn (Callable[[], Summary]): Does the work.
+        lane (str, optional): The lane of a job run by a worker, which makes
+            it preemptible at checkpoint() calls.
+
+    Returns:
+        Summary: The result of fn.
+
+    Raises:
+        Preempted: If the job yielded its worker, it is queued again.
+    """
+    stopped = threading.Event()
+    threading.Thread(target=_heartbeat, args=(key, owner, stopped), daemon=True).start()
+    _current.key, _current.owner, _current.lane = key, owner, lane
+    _current.checked = time.monotonic()
+    try:
+        with persist.count_writes() as writes:
+            summary = fn()
+    except Preempted:
+        requeue(key, owner)
+        raise
+    except Exception as e:
+        fail(key, owner, e)
+        raise
+    finally:
+        stopped.set()
+        _current.key = _current.owner = _current.lane = None
+    logger.info("Job {key} made {total} database writes: {counts}".format(
+        key=key, total=writes.total, counts=dict(writes.counts)))
+    finish(key, owner, summary, writes.total)
+    return summary
+
+
+def single_flight(key, fn, wait=True, **fields):
+    """
+    Runs fn at most once at a time per key across all processes. The first
+    requester runs it, later requesters attach to the running job and get
+    its result. A job whose owner crashed is taken over once its lease
+    expires, a done job whose summary has been deleted is run again.
+
+    Args:
+        key (str): The job key.
+        fn (Callable[[], Summary]): Does the work.
+        wait (bool, optional): Whether to wait for a job running elsewhere.
+            If False, None is returned instead.
+        **fields: Job fields set when the job is created.
+
+    Returns:
+        Summary or None: The summary produced by the job.
+
+    Raises:
+        Exception: If the job being waited for failed.
+    """
+    owner = get_owner()
+    attached = False
+    while True:
+        if (job := Job.objects(key=key).first()) is not None:
+            if job.status == DONE and (summary := _get_summary(job)) is not None:
+                return summary
+            if job.status == FAILED and attached:
+                raise Exception("Job {key} failed: {error}".format(key=key, error=job.error))
+
+        if acquire(key, owner, **fields) is not None:
+            return run(key, owner, fn)
+
+        if not wait:
+            logger.info("Job {key} is already running".format(key=key))
+            return None
+        if not attached:
+            logger.info("Attaching to running job {key}".format(key=key))
+            attached = True
+        time.sleep(POLL_SECONDS)
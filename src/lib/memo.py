@@ -0,0 +1,151 @@
+import logging
+import threading
+import time
+from pymongo import UpdateOne
+from src.lib.cache import LRUCache
+from src.lib.models import (
+    CacheVersion,
+)
+
+logger = logging.getLogger(__name__)
+
+# misses are remembered this long, so a document written by another process
+# is found after at most this many seconds even if its broadcast is missed
+NEGATIVE_TTL = 30
+# memoized documents never change, this bounds how long one deleted outside of
+# the admin views is still returned
+POSITIVE_TTL = 3600
+# how often each process polls the write counts broadcast by others
+POLL_SECONDS = 1
+
+# memos by name
+_memos = {}
+# write counts by collection as of the last poll
+_versions = {}
+_poll_lock = threading.Lock()
+_last_poll = 0.0
+_MISSING = object()
+
+
+def _is_miss(value):
+    return value is None or value is False
+
+
+class Memo(LRUCache):
+    """
+    Per-process cache of lookups of documents which never change once written,
+    e.g. finished transcriptions and summaries keyed by their identity. Misses,
+    None or False, expire after negative_ttl seconds. Writes to the namespace,
+    the collection the documents belong to, are broadcast with invalidate:
+    inserts drop the misses remembered by every process, deletes all entries.
+    Memoized documents are shared between threads and must not be modified.
+
+    Args:
+        name (str): The name the memo is reported under, see get_stats.
+        namespace (str): The collection name of the memoized documents.
+        maxsize (int, optional): The number of entries kept.
+        negative_ttl (float, optional): How long misses are remembered.
+    """
+
+    def __init__(self, name, namespace, maxsize=1024, negative_ttl=NEGATIVE_TTL):
+        super().__init__(maxsize, ttl=POSITIVE_TTL)
+        self.name = name
+        self.namespace = namespace
+        self.negative_ttl = negative_ttl
+        _memos[name] = self
+
+    def get(self, key, default=None):
+        _poll()
+        return super().get(key, default)
+
+    def set(self, key, value, ttl=None):
+        if ttl is None and _is_miss(value):
+            ttl = self.negative_ttl
+        super().set(key, value, ttl)
+
+    def load(self, key, fn):
+        """
+        Returns the value memoized for key, calling fn to look it up if there
+        is none.
+        """
+        if (value := self.get(key, _MISSING)) is _MISSING:
+            value = fn()
+            self.set(key, value)
+        return value
+
+    def drop_misses(self):
+        """
+        Removes the misses remembered by this process.
+        """
+        with self._lock:
+            for key in [key for key, (value, _) in self._entries.items() if _is_miss(value)]:
+                del self._entries[key]
+
+
+def _apply(namespace, deleted):
+    for memo in list(_memos.values()):
+        if memo.namespace == namespace:
+            if deleted:
+                memo.clear()
+            else:
+                memo.drop_misses()
+
+
+def _poll():
+    global _last_poll
+    now = time.monotonic()
+    # one thread polls while the others go on with what they have
+    if now - _last_poll < POLL_SECONDS or not _poll_lock.acquire(blocking=False):
+        return
+    try:
+        # collections first written since the last poll had no writes before
+        unwritten = None if _last_poll == 0.0 else (0, 0)
+        _last_poll = now
+        for version in CacheVersion._get_collection().find():
+            counts = (version.get("inserts", 0), version.get("deletes", 0))
+            if (previous := _versions.get(version["_id"], unwritten)) is not None and previous != counts:
+                _apply(version["_id"], deleted=previous[1] != counts[1])
+            _versions[version["_id"]] = counts
+    except Exception:
+        logger.exception("Polling cache invalidations failed")
+    finally:
+        _poll_lock.release()
+
+
+def invalidate(*namespaces, deleted=False):
+    """
+    Broadcasts writes to collections to the memos of every process, applying
+    them to those of this process at once. Collections no memo is registered
+    for are skipped, the others are broadcast with one bulk write.
+
+    Args:
+        *namespaces (str): The collection names.
+        deleted (bool, optional): Whether documents were deleted or changed
+            rather than inserted.
+    """
+    memoized = {memo.namespace for memo in list(_memos.values())}
+    if not (namespaces := sorted(set(namespaces) & memoized)):
+        return
+    for namespace in namespaces:
+        _apply(namespace, deleted)
+    CacheVersion._get_collection().bulk_write([
+        UpdateOne({"_id": namespace}, {"$inc": {"deletes" if deleted else "inserts": 1}}, upsert=True)
+        for namespace in namespaces
+    ], ordered=False)
+
+
+def get_version(namespace):
+    """
+    Returns the write counts of a collection as of the last poll, None before
+    its first write. They change with every write broadcast, so they can key
+    memoized results of queries over the whole collection.
+    """
+    _poll()
+    return _versions.get(namespace)
+
+
+def get_stats():
+    """
+    Returns the stats of each memo of this process by name, see LRUCache.get_stats.
+    """
+    return {name: memo.get_stats() for name, memo in sorted(_memos.items())}
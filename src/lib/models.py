@@ -1,13 +1,24 @@
 from datetime import datetime
 from mongoengine import (
     Document,
+    EmbeddedDocument,
     StringField,
     URLField,
+    BooleanField,
     IntField,
+    FloatField,
     DateTimeField,
     ReferenceField,
+    ListField,
+    BinaryField,
+    EmbeddedDocumentField,
 )
+from bson import DBRef
+from flask import Response, abort, g, request, url_for
+from flask_admin import expose
 from flask_admin.contrib.mongoengine import ModelView
+from flask_admin.contrib.mongoengine.filters import FilterEqual
+from markupsafe import Markup
 
 
 class Podcast(Document):
@@ -35,29 +46,262 @@ class SummarizationModel(Document):
     name = StringField(primary_key=True)
 
 
+# number of characters of text kept in the previews shown by admin list views
+PREVIEW_LENGTH = 200
+
+
+def get_preview(text):
+    """
+    Returns the start of text shown in admin list views.
+    """
+    if text is None:
+        return None
+    return text[:PREVIEW_LENGTH] + ("..." if len(text) > PREVIEW_LENGTH else "")
+
+
 class Transcription(Document):
     """
     Model to represent a transcription. An assumption made here is that
     a transcription is uniquely defined by its episode (which uniquely
-    belongs to a podcast), and transcription_model.
+    belongs to a podcast), and transcription_model. minhash and lsh_bands
+    are used to find near duplicate transcriptions of other episodes.
+    podcast_uuid and text_preview are denormalized on save for admin list
+    views.
     """
     transcription_model = ReferenceField(TranscriptionModel)
     episode = ReferenceField(Episode)
+    podcast_uuid = StringField()
     creation_date = DateTimeField(default=datetime.utcnow)
     text = StringField()
+    text_preview = StringField()
+    minhash = ListField(IntField())
+    lsh_bands = ListField(StringField())
+
+    meta = {
+        "indexes": [
+            "lsh_bands",
+            ("episode", "transcription_model"),
+            "-creation_date",
+            ("transcription_model", "-creation_date"),
+            ("podcast_uuid", "-creation_date"),
+        ],
+    }
+
+    def clean(self):
+        self.text_preview = get_preview(self.text)
+        if self.podcast_uuid is None and self.episode is not None and self.episode.podcast is not None:
+            self.podcast_uuid = self.episode.podcast.uuid
 
 
 class Summary(Document):
     """
     Model to represent an episode summary. As assumption made here is that
     a summary is uniquely defined by its transcription, summarization_model,
-    and prompt.
+    and prompt. reused_from is set when the text was copied from the summary of
+    a near duplicate transcription. podcast_uuid and text_preview are
+    denormalized on save for admin list views.
     """
     summarization_model = ReferenceField(SummarizationModel)
     transcription = ReferenceField(Transcription)
+    podcast_uuid = StringField()
     prompt = StringField()
     creation_date = DateTimeField(default=datetime.utcnow)
     text = StringField()
+    text_preview = StringField()
+    reused_from = ReferenceField("self")
+
+    meta = {
+        "indexes": [
+            ("transcription", "summarization_model", "prompt"),
+            "-creation_date",
+            ("summarization_model", "-creation_date"),
+            ("podcast_uuid", "-creation_date"),
+        ],
+    }
+
+    def clean(self):
+        self.text_preview = get_preview(self.text)
+        if self.podcast_uuid is None and self.transcription is not None:
+            self.podcast_uuid = self.transcription.podcast_uuid
+
+
+class SplitManifest(Document):
+    """
+    Records how the audio of an episode was split for transcription so that a
+    retry reproduces the same slices. boundaries are slice start offsets plus
+    the end of the audio, in bytes of the downloaded file or, when slices were
+    re-encoded, in milliseconds. ends are the slice end offsets, past the start
+    of the next slice where slices overlap; manifests without ends are from
+    splits without overlap. size is the size of the downloaded file.
+    """
+    episode_uuid = StringField(primary_key=True)
+    size = IntField()
+    unit = StringField(choices=("bytes", "ms"))
+    boundaries = ListField(IntField())
+    ends = ListField(IntField())
+
+
+class SliceTranscription(Document):
+    """
+    Checkpoint of the transcription of one audio slice, saved as soon as the
+    slice is transcribed. Slices are identified by their start and end in the
+    episode's SplitManifest. Checkpoints are removed once the full
+    transcription is saved.
+    """
+    episode_uuid = StringField()
+    transcription_model = StringField()
+    unit = StringField(choices=("bytes", "ms"))
+    start = IntField()
+    end = IntField()
+    text = StringField()
+    creation_date = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        "indexes": [
+            {
+                "fields": ["episode_uuid", "transcription_model", "unit", "start", "end"],
+                "unique": True,
+            },
+        ],
+    }
+
+
+class SearchEntry(Document):
+    """
+    Denormalized copy of a summary, its transcription, episode and podcast
+    names used to serve full-text search from a single weighted text index.
+    Entries are written when a summary is saved.
+    """
+    summary = ReferenceField(Summary, unique=True)
+    episode_uuid = StringField()
+    episode_name = StringField()
+    podcast_uuid = StringField()
+    podcast_name = StringField()
+    summary_text = StringField()
+    transcription_text = StringField()
+    creation_date = DateTimeField(default=datetime.utcnow)
+
+    meta = {
+        "indexes": [
+            {
+                "fields": ["$episode_name", "$podcast_name", "$summary_text", "$transcription_text"],
+                "default_language": "english",
+                "weights": {
+                    "episode_name": 10,
+                    "podcast_name": 5,
+                    "summary_text": 3,
+                    "transcription_text": 1,
+                },
+            },
+        ],
+    }
+
+
+class RateLimit(Document):
+    """
+    Shared token bucket state for an upstream API. Every web and worker process
+    updates it atomically before calling the API (see ratelimit.py). scale is
+    the adaptive share of the configured limits currently in use, granted
+    whether the last attempt to take from the bucket succeeded. Times are
+    epoch seconds.
+    """
+    name = StringField(primary_key=True)
+    requests = FloatField()
+    tokens = FloatField()
+    updated = FloatField()
+    scale = FloatField(default=1.0)
+    blocked_until = FloatField(default=0.0)
+    granted = BooleanField()
+
+
+class CacheVersion(Document):
+    """
+    Counts the writes to a collection whose documents are memoized by every
+    process (see memo.py). Processes poll the counts and drop remembered
+    misses when inserts changes, and all their entries when deletes changes.
+    """
+    name = StringField(primary_key=True)
+    inserts = IntField(default=0)
+    deletes = IntField(default=0)
+
+
+class ProfileStage(EmbeddedDocument):
+    """
+    Resource usage of one stage of a profiled job. Times are in seconds from
+    the start of the job, memory peaks are in bytes.
+    """
+    name = StringField()
+    start = FloatField()
+    duration = FloatField()
+    peak_rss = IntField()
+    peak_traced = IntField()
+
+
+class Profile(Document):
+    """
+    Model to represent the profile of a job run with profiling enabled (see
+    profiling.py). function_stats and allocation_stats are readable reports,
+    stats is the raw cProfile data in the format written by pstats.dump_stats.
+    """
+    job_key = StringField()
+    episode_uuid = StringField()
+    summary = ReferenceField(Summary)
+    creation_date = DateTimeField(default=datetime.utcnow)
+    duration = FloatField()
+    error = StringField()
+    stages = ListField(EmbeddedDocumentField(ProfileStage))
+    function_stats = StringField()
+    allocation_stats = StringField()
+    stats = BinaryField()
+
+    meta = {
+        "indexes": ["job_key", "-creation_date"],
+    }
+
+
+class Job(Document):
+    """
+    Model to represent a summarization job. The key is derived from the episode,
+    transcription model, summarization model and prompt so that concurrent
+    requests for the same work share one job (see jobs.py). The process running
+    the job holds a lease that it renews with heartbeats; a lease that is not
+    renewed before lease_expires is taken over by the next requester. stage,
+    slices_done and slices_total report the progress of a running job. Queued
+    jobs wait in a priority lane for a worker (see worker.py); podcast_uuid is
+    used to share workers fairly between podcasts, and start_date picks the
+    jobs which yield to higher lanes first. writes is the number of
+    database writes a finished job made.
+    """
+    key = StringField(primary_key=True)
+    episode_uuid = StringField()
+    transcription_model = StringField()
+    summarization_model = StringField()
+    prompt = StringField()
+    status = StringField(choices=("queued", "running", "done", "failed"))
+    lane = StringField(choices=("interactive", "backfill", "resummarize"))
+    podcast_uuid = StringField()
+    profiling = BooleanField()
+    owner = StringField()
+    creation_date = DateTimeField(default=datetime.utcnow)
+    enqueue_date = DateTimeField()
+    start_date = DateTimeField()
+    preemptions = IntField(default=0)
+    heartbeat = DateTimeField()
+    lease_expires = DateTimeField()
+    finish_date = DateTimeField()
+    summary = ReferenceField(Summary)
+    error = StringField()
+    stage = StringField()
+    slices_done = IntField()
+    slices_total = IntField()
+    writes = IntField()
+    profile = ReferenceField(Profile)
+
+    meta = {
+        "indexes": [
+            ("status", "lane", "podcast_uuid", "enqueue_date"),
+        ],
+    }
 
 
 # Admin views
@@ -81,20 +325,227 @@ class EpisodeView(ModelView):
     )
 
 
-class TranscriptionView(ModelView):
+def _format_reference(view, context, model, name):
+    # show the name of the referenced document loaded by LightweightModelView.get_list
+    value = getattr(model, name)
+    key = value.id if isinstance(value, DBRef) else value
+    return g.get("admin_reference_names", {}).get(name, {}).get(key, key)
+
+
+class LightweightModelView(ModelView):
+    """
+    Model view for large collections. List pages load only the listed columns
+    and never dereference references row by row: the names of the documents
+    referenced by the columns in column_reference_names are loaded with one
+    query per column and page. Without filters the total is estimated from
+    collection metadata instead of counted. Sorting is limited to indexed
+    columns.
+    """
+    can_view_details = True
+    column_sortable_list = ("creation_date",)
+    column_default_sort = ("creation_date", True)
+    # column -> (referenced document, field shown instead of the reference)
+    column_reference_names = {}
+
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        query = self.get_query().only(*self.column_list).no_dereference()
+        filtered = False
+        for flt, flt_name, value in filters:
+            f = self._filters[flt]
+            query = f.apply(query, f.clean(value))
+            filtered = True
+        if self._search_supported and search:
+            query = self._search(query, search)
+            filtered = True
+
+        if filtered:
+            count = query.count()
+        else:
+            count = self.model._get_collection().estimated_document_count()
+
+        if sort_column:
+            query = query.order_by("{desc}{column}".format(desc="-" if sort_desc else "", column=sort_column))
+        else:
+            query = query.order_by(*["{desc}{column}".format(desc="-" if desc else "", column=column)
+                                     for column, desc in self._get_default_order()])
+
+        page_size = self.page_size if page_size is None else page_size
+        if page_size:
+            query = query.limit(page_size)
+            if page:
+                query = query.skip(page * page_size)
+        if not execute:
+            return count, query
+
+        rows = list(query)
+        g.admin_reference_names = {}
+        for column, (document, field) in self.column_reference_names.items():
+            keys = set()
+            for row in rows:
+                if (value := getattr(row, column)) is not None:
+                    keys.add(value.id if isinstance(value, DBRef) else value)
+            g.admin_reference_names[column] = {
+                referenced.pk: getattr(referenced, field)
+                for referenced in document.objects(pk__in=list(keys)).only(field)
+            }
+        return count, rows
+
+    def after_model_change(self, form, model, is_created):
+        self._invalidate()
+
+    def after_model_delete(self, model):
+        # after the delete, so no process memoizes the document again meanwhile
+        self._invalidate()
+
+    def _invalidate(self):
+        # edits and deletes reach the per-process memos of every process, see memo.py;
+        # imported here as memo.py depends on this module
+        from src.lib import memo
+        memo.invalidate(self.model._get_collection_name(), deleted=True)
+
+
+class TranscriptionView(LightweightModelView):
     column_list = (
+        "creation_date",
         "transcription_model",
+        "podcast_uuid",
         "episode",
+        "text_preview",
+    )
+    column_labels = {
+        "podcast_uuid": "Podcast",
+        "text_preview": "Text",
+    }
+    column_reference_names = {
+        "podcast_uuid": (Podcast, "name"),
+        "episode": (Episode, "name"),
+    }
+    column_formatters = {
+        "transcription_model": _format_reference,
+        "podcast_uuid": _format_reference,
+        "episode": _format_reference,
+    }
+    column_filters = (
         "creation_date",
-        "text",
+        FilterEqual(Transcription.transcription_model, "Model"),
+        FilterEqual(Transcription.podcast_uuid, "Podcast uuid"),
     )
 
 
-class SummaryView(ModelView):
+class SummaryView(LightweightModelView):
     column_list = (
+        "creation_date",
         "summarization_model",
-        "transcription",
+        "podcast_uuid",
         "prompt",
+        "text_preview",
+    )
+    column_labels = {
+        "podcast_uuid": "Podcast",
+        "text_preview": "Text",
+    }
+    column_reference_names = {
+        "podcast_uuid": (Podcast, "name"),
+    }
+    column_formatters = {
+        "summarization_model": _format_reference,
+        "podcast_uuid": _format_reference,
+        "prompt": lambda view, context, model, name: get_preview(model.prompt),
+    }
+    column_filters = (
+        "creation_date",
+        FilterEqual(Summary.summarization_model, "Model"),
+        FilterEqual(Summary.podcast_uuid, "Podcast uuid"),
+    )
+
+
+class JobView(ModelView):
+    column_list = (
+        "key",
+        "status",
+        "lane",
+        "preemptions",
+        "stage",
+        "slices_done",
+        "slices_total",
+        "owner",
         "creation_date",
-        "text",
+        "enqueue_date",
+        "start_date",
+        "heartbeat",
+        "lease_expires",
+        "finish_date",
+        "writes",
+        "error",
+        "profile",
     )
+
+
+def _format_pre(view, context, model, name):
+    return Markup("<pre>{text}</pre>").format(text=getattr(model, name) or "")
+
+
+def _format_stages(view, context, model, name):
+    rows = Markup("").join(
+        Markup("<tr><td>{name}</td><td>{start:.1f}</td><td>{duration:.1f}</td>"
+               "<td>{peak_rss:.1f}</td><td>{peak_traced:.1f}</td></tr>").format(
+            name=stage.name,
+            start=stage.start,
+            duration=stage.duration,
+            peak_rss=(stage.peak_rss or 0) / 2 ** 20,
+            peak_traced=(stage.peak_traced or 0) / 2 ** 20,
+        )
+        for stage in model.stages
+    )
+    return Markup("<table class=\"table\"><tr><th>stage</th><th>start (s)</th><th>duration (s)</th>"
+                  "<th>peak RSS (MiB)</th><th>peak traced (MiB)</th></tr>{rows}</table>").format(rows=rows)
+
+
+def _format_stats_link(view, context, model, name):
+    if not model.stats:
+        return ""
+    return Markup("<a href=\"{url}\">Download .prof</a>").format(url=url_for(".stats_view", id=model.id))
+
+
+class ProfileView(ModelView):
+    can_create = False
+    can_edit = False
+    can_view_details = True
+    column_list = (
+        "creation_date",
+        "job_key",
+        "duration",
+        "error",
+    )
+    column_details_list = (
+        "creation_date",
+        "job_key",
+        "episode_uuid",
+        "summary",
+        "duration",
+        "error",
+        "stages",
+        "stats",
+        "function_stats",
+        "allocation_stats",
+    )
+    column_formatters_detail = {
+        "stages": _format_stages,
+        "stats": _format_stats_link,
+        "function_stats": _format_pre,
+        "allocation_stats": _format_pre,
+    }
+    column_default_sort = ("creation_date", True)
+
+    @expose("/stats/")
+    def stats_view(self):
+        """
+        Serves the raw cProfile data of a profile, for snakeviz or pstats.
+        """
+        profile = self.get_one(request.args.get("id", ""))
+        if profile is None or not profile.stats:
+            abort(404)
+        return Response(bytes(profile.stats), mimetype="application/octet-stream", headers={
+            "Content-Disposition": "attachment; filename={key}.prof".format(key=profile.job_key.replace(":", "_")),
+        })
@@ -0,0 +1,213 @@
+import collections
+import contextlib
+import hashlib
+import logging
+import threading
+from bson import BSON
+from mongoengine import Document
+from mongoengine.fields import ReferenceField
+from pymongo import UpdateOne, monitoring
+from src.lib.cache import LRUCache
+from src.lib import memo
+
+logger = logging.getLogger(__name__)
+
+# referenced documents written by this process, by collection and id, with a
+# digest of their content so writing the same content again is skipped. They
+# are forgotten after a while in case another process deleted them.
+MAX_WRITTEN = 10000
+WRITTEN_TTL_SECONDS = 3600
+
+_WRITE_COMMANDS = ("insert", "update", "delete", "findAndModify")
+
+_written = LRUCache(maxsize=MAX_WRITTEN, ttl=WRITTEN_TTL_SECONDS)
+# the write counter of the calling thread, see count_writes
+_current = threading.local()
+_totals = collections.Counter()
+_totals_lock = threading.Lock()
+
+
+class WriteCounter:
+    """
+    Counts the write commands sent to the database, by command name.
+    """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    def add(self, command_name):
+        with self._lock:
+            self.counts[command_name] += 1
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+class _WriteListener(monitoring.CommandListener):
+    # started events are published on the thread sending the command
+
+    def started(self, event):
+        if event.command_name not in _WRITE_COMMANDS:
+            return
+        with _totals_lock:
+            _totals[event.command_name] += 1
+        if (counter := getattr(_current, "counter", None)) is not None:
+            counter.add(event.command_name)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+# applies to clients connected after this module is imported
+monitoring.register(_WriteListener())
+
+
+@contextlib.contextmanager
+def count_writes():
+    """
+    Counts the writes sent by the calling thread, and by functions it hands
+    to other threads with wrap, while the context is active.
+
+    Yields:
+        WriteCounter: The counter.
+    """
+    previous = getattr(_current, "counter", None)
+    _current.counter = WriteCounter()
+    try:
+        yield _current.counter
+    finally:
+        _current.counter = previous
+
+
+def wrap(fn):
+    """
+    Returns fn wrapped to count its writes with the counter of the calling
+    thread, for work handed to other threads. Returns fn itself if the calling
+    thread is not counting writes.
+    """
+    if (counter := getattr(_current, "counter", None)) is None:
+        return fn
+
+    def counted(*args, **kwargs):
+        previous = getattr(_current, "counter", None)
+        _current.counter = counter
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.counter = previous
+    return counted
+
+
+def get_write_counts():
+    """
+    Returns the number of write commands sent by this process, by command name.
+    """
+    with _totals_lock:
+        return dict(_totals)
+
+
+def _get_references(document, references):
+    for name, field in document._fields.items():
+        if not isinstance(field, ReferenceField):
+            continue
+        # lazy references still holding an id were loaded and are not written
+        if isinstance(value := document._data.get(name), Document) and value is not document:
+            _get_references(value, references)
+            references.append(value)
+    return references
+
+
+def _get_upsert(document):
+    """
+    Returns the update writing document, or None if it is known to be stored.
+    Documents loaded from the database only write their changed fields so
+    other fields are not overwritten with stale copies, other documents
+    write all their fields unless this process already wrote the same ones.
+    """
+    son = document.to_mongo()
+    _id = son.pop("_id")
+    if not document._created:
+        if not (changed := document._get_changed_fields()):
+            return None
+        son = {field: value for field, value in son.items() if field.split(".")[0] in changed}
+    key = (document._get_collection_name(), _id)
+    digest = hashlib.blake2b(BSON.encode(son), digest_size=16).digest()
+    if _written.get(key) == digest:
+        return None
+    update = {"$set": son} if son else {"$setOnInsert": {"_id": _id}}
+    return key, digest, UpdateOne({"_id": _id}, update, upsert=True)
+
+
+def _save_references(document):
+    # returns the number of documents written and their collections
+    requests = collections.defaultdict(dict)
+    for reference in _get_references(document, []):
+        if (upsert := _get_upsert(reference)) is not None:
+            key, digest, request = upsert
+            # a document referenced twice is written once
+            requests[type(reference)][key] = (digest, request)
+
+    count = 0
+    for document_class, upserts in requests.items():
+        document_class._get_collection().bulk_write([request for _, request in upserts.values()], ordered=False)
+        for key, (digest, _) in upserts.items():
+            _written.set(key, digest)
+        count += len(upserts)
+    if count:
+        logger.debug("Upserted {count} referenced documents".format(count=count))
+    return count, [document_class._get_collection_name() for document_class in requests]
+
+
+def save_references(document):
+    """
+    Upserts the documents referenced by document, recursively, which are new
+    or changed, with one unordered bulk write per collection, and broadcasts
+    the writes to the memos of every process, see memo.py.
+
+    Args:
+        document (Document): The document whose references are saved.
+
+    Returns:
+        int: The number of documents written.
+    """
+    count, namespaces = _save_references(document)
+    memo.invalidate(*namespaces)
+    return count
+
+
+def insert(document):
+    """
+    Saves a new document with a single acknowledged insert after upserting
+    its new or changed references, replacing document.save(cascade=True)
+    which writes every referenced document again. The insert and the reference
+    upserts are broadcast to the memos of every process in one write, see memo.py.
+
+    Args:
+        document (Document): The document, not saved before.
+
+    Returns:
+        Document: The saved document.
+
+    Raises:
+        mongoengine.ValidationError: If the document is invalid.
+    """
+    document.validate()
+    _, namespaces = _save_references(document)
+    son = document.to_mongo()
+    document.pk = document._get_collection().insert_one(son).inserted_id
+    document._created = False
+    document._clear_changed_fields()
+    memo.invalidate(document._get_collection_name(), *namespaces)
+    return document
+
+
+def forget():
+    """
+    Forgets the documents written by this process, so they are written again.
+    """
+    _written.clear()
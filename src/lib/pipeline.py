@@ -0,0 +1,306 @@
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+from src.lib.utils import (
+    get_transcription_if_exists,
+)
+from src.lib.models import (
+    SliceTranscription,
+    SplitManifest,
+    SummarizationModel,
+    TranscriptionModel,
+)
+from src.lib import backends, jobs, persist, profiling, summarize, taddy, transcribe
+
+logger = logging.getLogger(__name__)
+
+# job key prompt component for summaries whose prompt is chosen by transcription length
+AUTO_PROMPT = "auto"
+
+# slices transcribed and chunks summarized concurrently per episode, on top of
+# which calls are throttled by the shared rate limiter
+TRANSCRIBE_WORKERS = 4
+SUMMARIZE_WORKERS = 4
+
+
+def _completed(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+
+def _on_progress(download, callback):
+    # calls back between downloaded chunks so finished stages are picked up while downloading
+    for audio, received in download:
+        yield audio, received
+        callback(audio, received)
+
+
+def _is_overlapping(slices):
+    # slices of one split either all overlap the next or none do
+    return len(slices) > 1 and slices[0][2] > slices[1][1]
+
+
+def stream(episode, transcription_model, summarization_model, manifest=None):
+    """
+    Transcribes and summarizes an episode with all stages overlapping. Slices
+    are cut while the audio downloads, each slice is transcribed as soon as it
+    is cut, and chunks of the transcription are summarized as soon as enough
+    of it is transcribed in order. Only the final summary of the chunk
+    summaries waits for everything else, so for long episodes the time taken
+    approaches the download time plus one slice plus one summary.
+
+    Args:
+        episode (Episode): The episode.
+        transcription_model (TranscriptionModel): The transcription model.
+        summarization_model (SummarizationModel): The summarization model.
+        manifest (SplitManifest, optional): The split manifest of a previous attempt.
+
+    Returns:
+        Summary: The summary of the episode.
+
+    Raises:
+        transcribe.SplitError: If the audio cannot be split on mp3 frame boundaries
+            after some slices were cut.
+
+    Notes:
+        - Slice transcriptions are checkpointed as they complete, also for slices
+          transcribed before an error, and reused by a retry.
+        - Chunk summaries are discarded if a summary of a near duplicate
+          transcription turns out to exist.
+    """
+    checkpoints = {
+        (checkpoint.unit, checkpoint.start, checkpoint.end): checkpoint.text
+        for checkpoint in SliceTranscription.objects(
+            episode_uuid=episode.uuid, transcription_model=transcription_model.name)
+    }
+    slices = []
+    slice_futures = []
+    chunk_futures = []
+    # texts of the slices transcribed so far without gaps, joined into transcript
+    texts = []
+    transcript = ""
+    # where the last chunk ended in transcript
+    position = 0
+    size = None
+
+    def transcribe_slice(i, unit, start, end, split):
+        logger.info("Transcribing slice {i} ({start}-{end} {unit})".format(i=i + 1, start=start, end=end, unit=unit))
+        text = transcribe.transcribe_file(split, "{i}.mp3".format(i=i), transcription_model)
+        transcribe.save_checkpoint(episode, transcription_model, unit, start, end, text)
+        return text
+
+    def summarize_chunk(start, end, num_chunks):
+        logger.info("Summarizing chunk {i} of ~{N}".format(i=len(chunk_futures) + 1, N=num_chunks))
+        return summarizers.submit(
+            profiling.wrap(persist.wrap(summarize.summarize_chunk)), transcript[start:end], num_chunks, summarization_model, first=start == 0)
+
+    def advance(final=False):
+        nonlocal transcript, position
+        jobs.checkpoint()
+        for future in slice_futures:
+            if future.done() and future.exception() is not None:
+                raise future.exception()
+        done = len(texts)
+        while len(texts) < len(slice_futures) and slice_futures[len(texts)].done():
+            texts.append(slice_futures[len(texts)].result())
+        if len(texts) > done:
+            jobs.report_progress(slices_done=sum(future.done() for future in slice_futures))
+            transcript = transcribe.join_transcriptions(texts, _is_overlapping(slices))
+        elif not final:
+            return
+
+        # the number of chunks determines the length of chunk summaries, it is estimated
+        # from the share of the audio transcribed until the whole transcription exists
+        token_count = summarize.get_token_count(transcript, summarization_model)
+        if not final and texts:
+            total = size if slices[-1][0] == "bytes" else slices[-1][2]
+            token_count = token_count * total // max(1, slices[len(texts) - 1][2])
+        # transcriptions this short are summarized in one shot without chunk summaries
+        if token_count <= summarize.MAX_TOKEN_COUNT:
+            return
+        num_chunks = max(len(chunk_futures) + 1, summarize.estimate_num_chunks(token_count))
+        # joining the next slice may still change the end of the transcript
+        stable = transcript if final else transcript[:transcribe.get_stable_length(transcript)]
+        while (chunk := summarize.get_next_chunk(stable, position, summarization_model, final)) is not None:
+            chunk_futures.append(summarize_chunk(*chunk, num_chunks))
+            position = chunk[1]
+
+    def on_download(audio, received):
+        nonlocal size
+        size = len(audio)
+        advance()
+
+    def chunk_summary_texts():
+        advance(final=True)
+        return [future.result() for future in chunk_futures]
+
+    with concurrent.futures.ThreadPoolExecutor(TRANSCRIBE_WORKERS, thread_name_prefix="transcribe") as transcribers, \
+            concurrent.futures.ThreadPoolExecutor(SUMMARIZE_WORKERS, thread_name_prefix="summarize") as summarizers:
+        try:
+            with contextlib.ExitStack() as stack:
+                logger.debug("Downloading {src}...".format(src=episode.audioUrl))
+                jobs.report_progress(stage="downloading")
+                download = transcribe.download_audio_progressively(episode.audioUrl, stack)
+                audio, received = next(download)
+                size = len(audio)
+                if manifest is not None and manifest.size != size:
+                    logger.warning("Audio changed since last attempt, discarding checkpoints...")
+                    SliceTranscription.objects(
+                        episode_uuid=episode.uuid, transcription_model=transcription_model.name).delete()
+                    manifest, checkpoints = None, {}
+
+                splits = transcribe.split_audio_progressively(
+                    itertools.chain([(audio, received)], _on_progress(download, on_download)),
+                    (manifest.unit, manifest.boundaries, manifest.ends) if manifest else None,
+                    lambda num_slices: jobs.report_progress(slices_total=num_slices))
+                for i, (unit, start, end, split) in enumerate(splits):
+                    if i == 0:
+                        # the rest of the audio may still be downloading
+                        jobs.report_progress(stage="transcribing")
+                    slices.append((unit, start, end))
+                    if (text := checkpoints.get((unit, start, end))) is not None:
+                        logger.info("Slice {i} already transcribed".format(i=i + 1))
+                        slice_futures.append(_completed(text))
+                    else:
+                        slice_futures.append(transcribers.submit(profiling.wrap(persist.wrap(transcribe_slice)), i, unit, start, end, split))
+
+                unit = slices[0][0]
+                boundaries = [start for _, start, _ in slices] + [slices[-1][2]]
+                ends = [end for _, _, end in slices]
+                SplitManifest(episode_uuid=episode.uuid, size=size, unit=unit, boundaries=boundaries, ends=ends).save()
+
+                while len(texts) < len(slice_futures):
+                    if (pending := [future for future in slice_futures if not future.done()]):
+                        concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    advance()
+
+            transcription = transcribe.save_transcription(episode, transcription_model, texts, _is_overlapping(slices))
+            return summarize.summarize(transcription, summarization_model, chunk_summary_texts)
+        finally:
+            for future in itertools.chain(slice_futures, chunk_futures):
+                future.cancel()
+
+
+def run(episode, transcription_model, summarization_model):
+    """
+    Transcribes and summarizes an episode, reusing an existing transcription
+    and the checkpoints of a previous attempt.
+
+    Returns:
+        Summary: The summary of the episode.
+    """
+    backends.get_backend(transcription_model.name)
+    if get_transcription_if_exists(episode, transcription_model) is None:
+        manifest, texts = transcribe.get_checkpoints(episode, transcription_model)
+        if manifest is None or None in texts:
+            try:
+                return stream(episode, transcription_model, summarization_model, manifest)
+            except transcribe.SplitError as e:
+                logger.warning("{error}, falling back to splitting after download...".format(error=e))
+
+    transcription = transcribe.transcribe(episode, transcription_model)
+    return summarize.summarize(transcription, summarization_model)
+
+
+def _get_work(key, episode, transcription_model, summarization_model, profile):
+    def work():
+        return run(episode, transcription_model, summarization_model)
+
+    def profiled_work():
+        return profiling.profiled(key, work, episode_uuid=episode.uuid)
+
+    return profiled_work if profiling.should_profile(profile) else work
+
+
+def transcribe_and_summarize(episode,
+                             transcription_model=TranscriptionModel(name="whisper"),
+                             summarization_model=SummarizationModel(name="gpt-3.5-turbo"),
+                             wait=True,
+                             profile=None):
+    """
+    Generate a summary of the given episode by transcribing it and summarizing the transcription.
+    Concurrent requests for the same episode and models, from any process, are coalesced into
+    a single job.
+
+    Args:
+        episode (str): The episode to be transcribed and summarized.
+        transcription_model (TranscriptionModel, optional): The transcription model to use.
+        summarization_model (SummarizationModel, optional): The summarization model to use.
+        wait (bool, optional): Whether to wait for the result if the job is already running
+            elsewhere. If False, None is returned in that case.
+        profile (bool, optional): Whether to profile the job if it is run by this call,
+            see profiling.py. If None, jobs are profiled at profiling.SAMPLE_RATE.
+
+    Returns:
+        str: The summary of the episode.
+    """
+    key = jobs.get_job_key(episode, transcription_model, summarization_model, AUTO_PROMPT)
+    return jobs.single_flight(
+        key,
+        _get_work(key, episode, transcription_model, summarization_model, profile),
+        wait=wait,
+        episode_uuid=episode.uuid,
+        transcription_model=transcription_model.name,
+        summarization_model=summarization_model.name,
+        prompt=AUTO_PROMPT,
+    )
+
+
+def enqueue(episode,
+            lane=jobs.INTERACTIVE,
+            transcription_model=TranscriptionModel(name="whisper"),
+            summarization_model=SummarizationModel(name="gpt-3.5-turbo"),
+            profile=None):
+    """
+    Queues the summarization of an episode for a worker, see worker.py.
+
+    Args:
+        episode (Episode): The episode to be transcribed and summarized.
+        lane (str, optional): The priority lane, one of jobs.LANES.
+        transcription_model (TranscriptionModel, optional): The transcription model to use.
+        summarization_model (SummarizationModel, optional): The summarization model to use.
+        profile (bool, optional): Whether to profile the job, see transcribe_and_summarize.
+            Sampling at profiling.SAMPLE_RATE is decided here, as it is only set
+            in the web app and not in the workers running the job.
+
+    Returns:
+        Job: The queued job.
+    """
+    return jobs.enqueue(
+        jobs.get_job_key(episode, transcription_model, summarization_model, AUTO_PROMPT),
+        lane,
+        profiling=profiling.should_profile(profile),
+        episode_uuid=episode.uuid,
+        podcast_uuid=episode.podcast.uuid if episode.podcast else None,
+        transcription_model=transcription_model.name,
+        summarization_model=summarization_model.name,
+        prompt=AUTO_PROMPT,
+    )
+
+
+def run_job(job, owner):
+    """
+    Runs a job claimed by a worker. The job can be preempted between slices
+    and chunks, see jobs.checkpoint.
+
+    Args:
+        job (Job): A job claimed with jobs.claim.
+        owner (str): The identifier of the worker.
+
+    Returns:
+        Summary: The summary of the episode.
+
+    Raises:
+        jobs.Preempted: If the job yielded its worker and was queued again.
+    """
+    episode = taddy.get_episode(job.episode_uuid)
+    transcription_model = TranscriptionModel(name=job.transcription_model)
+    summarization_model = SummarizationModel(name=job.summarization_model)
+    return jobs.run(
+        job.key,
+        owner,
+        _get_work(job.key, episode, transcription_model, summarization_model, bool(job.profiling)),
+        lane=job.lane,
+    )
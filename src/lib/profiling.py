@@ -0,0 +1,236 @@
+import cProfile
+import io
+import logging
+import marshal
+import pstats
+import random
+import resource
+import threading
+import time
+import tracemalloc
+from src.lib.models import (
+    Job,
+    Profile,
+    ProfileStage,
+)
+
+logger = logging.getLogger(__name__)
+
+# share of jobs profiled when profiling is not switched on or off for a job,
+# set from the PROFILE_SAMPLE_RATE app setting
+SAMPLE_RATE = 0.0
+
+# frames kept per traced allocation, more frames are slower but point at the
+# caller of library code
+TRACEMALLOC_FRAMES = 10
+NUM_TOP_FUNCTIONS = 60
+NUM_TOP_ALLOCATIONS = 30
+
+# the job profile of the current thread, if any
+_current = threading.local()
+# tracemalloc is process wide, so it is started by the first profiled job and
+# stopped when the last one finishes
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def should_profile(profile=None):
+    """
+    Decides whether a job is profiled.
+
+    Args:
+        profile (bool, optional): Switches profiling on or off for the job. If
+            None, a share SAMPLE_RATE of jobs is profiled.
+
+    Returns:
+        bool: Whether to profile the job.
+    """
+    if profile is not None:
+        return profile
+    return random.random() < SAMPLE_RATE
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets the peak resident set size (VmHWM) on linux
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _get_peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # peak over the lifetime of the process, in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        _tracemalloc_users += 1
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+class JobProfile(object):
+    """
+    Collects the profile of one job: cProfile stats of the thread running the
+    job and of the worker threads it hands work to, and the duration, peak RSS
+    and peak traced memory of each stage.
+
+    Memory is measured process wide, so stages of jobs running concurrently in
+    the same process inflate each other's peaks.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.profilers = []
+        self._lock = threading.Lock()
+
+    def enter_stage(self, name):
+        """
+        Ends the current stage and starts the named one.
+        """
+        now = time.perf_counter()
+        with self._lock:
+            if self.stages:
+                stage = self.stages[-1]
+                stage.duration = now - self.start - stage.start
+                stage.peak_rss = _get_peak_rss()
+                stage.peak_traced = tracemalloc.get_traced_memory()[1]
+            if name is not None:
+                _reset_peak_rss()
+                tracemalloc.reset_peak()
+                self.stages.append(ProfileStage(name=name, start=now - self.start))
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Calls fn with cProfile enabled for the calling thread.
+        """
+        profiler = cProfile.Profile()
+        with self._lock:
+            self.profilers.append(profiler)
+        profiler.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.disable()
+
+    def get_stats(self):
+        """
+        Returns the merged cProfile stats of all threads.
+        """
+        return pstats.Stats(*self.profilers)
+
+
+def on_stage(name):
+    """
+    Records that the job run by the calling thread entered a new stage. Does
+    nothing if the job is not profiled.
+    """
+    if (job_profile := getattr(_current, "profile", None)) is not None:
+        job_profile.enter_stage(name)
+
+
+def wrap(fn):
+    """
+    Returns fn wrapped to be profiled as part of the job run by the calling
+    thread, for work handed to other threads. Returns fn itself if the job is
+    not profiled.
+    """
+    if (job_profile := getattr(_current, "profile", None)) is None:
+        return fn
+
+    def profiled(*args, **kwargs):
+        return job_profile.run(fn, *args, **kwargs)
+    return profiled
+
+
+def _get_function_stats(stats):
+    output = io.StringIO()
+    stats.stream = output
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(NUM_TOP_FUNCTIONS)
+    return output.getvalue()
+
+
+def _get_allocation_stats(snapshot):
+    lines = []
+    for stat in snapshot.statistics("traceback")[:NUM_TOP_ALLOCATIONS]:
+        lines.append("{size:.1f} KiB in {count} blocks".format(size=stat.size / 1024, count=stat.count))
+        lines.extend("    " + line for line in stat.traceback.format(most_recent_first=True))
+    return "\n".join(lines)
+
+
+def profiled(key, fn, **fields):
+    """
+    Runs fn with profiling enabled and saves the profile, also if fn raises.
+
+    Args:
+        key (str): The key of the job fn does the work of. The profile is linked
+            from the job.
+        fn (Callable[[], Summary]): Does the work.
+        **fields: Profile fields, e.g. episode_uuid.
+
+    Returns:
+        Summary: The result of fn.
+    """
+    job_profile = JobProfile()
+    _current.profile = job_profile
+    _start_tracemalloc()
+    summary = error = None
+    job_profile.enter_stage("starting")
+    try:
+        summary = job_profile.run(fn)
+        return summary
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        job_profile.enter_stage(None)
+        snapshot = tracemalloc.take_snapshot()
+        _stop_tracemalloc()
+        _current.profile = None
+        try:
+            save(key, job_profile, snapshot, summary=summary, error=error, **fields)
+        except Exception:
+            # a failure to store the profile must not fail the job
+            logger.exception("Failed to save profile of job {key}".format(key=key))
+
+
+def save(key, job_profile, snapshot, **fields):
+    """
+    Saves a job profile and links it from the job.
+
+    Returns:
+        Profile: The saved profile.
+    """
+    stats = job_profile.get_stats()
+    profile = Profile(
+        job_key=key,
+        duration=time.perf_counter() - job_profile.start,
+        stages=job_profile.stages,
+        function_stats=_get_function_stats(stats),
+        allocation_stats=_get_allocation_stats(snapshot),
+        stats=marshal.dumps(stats.stats),
+        **fields,
+    )
+    profile.save()
+    Job.objects(key=key).update_one(set__profile=profile)
+    logger.info("Saved profile {id} of job {key}".format(id=profile.id, key=key))
+    return profile
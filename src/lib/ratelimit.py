@@ -0,0 +1,187 @@
+import logging
+import random
+import time
+from pymongo import ReturnDocument
+from src.lib.models import (
+    RateLimit,
+)
+from src.lib.utils import (
+    get_openai,
+)
+
+logger = logging.getLogger(__name__)
+
+# (requests per minute, tokens per minute) per upstream model, set slightly under
+# the account quota. Models without an entry are not rate limited.
+LIMITS = {
+    "whisper-1": (45, None),
+    "gpt-3.5-turbo": (3000, 80000),
+}
+
+# adaptive scaling of the limits: halved on every 429 and grown back by
+# SCALE_INCREASE per successful call, never dropping below MIN_SCALE
+MIN_SCALE = 0.05
+SCALE_DECREASE = 0.5
+SCALE_INCREASE = 0.02
+
+MAX_RETRIES = 6
+# backoff used when a 429 response has no Retry-After header
+BASE_BACKOFF_SECONDS = 2
+MAX_BACKOFF_SECONDS = 60
+# longest single sleep while waiting for the bucket, so limit changes are picked up
+MAX_WAIT_SECONDS = 5
+
+
+def _take(name, requests_per_minute, tokens_per_minute, tokens):
+    """
+    Refills the bucket for the time elapsed since its last update and takes
+    one request and the given number of tokens from it if enough are
+    available, all in a single atomic update.
+
+    Returns:
+        dict: The bucket after the update, with "granted" set if the call may proceed.
+    """
+    now = time.time()
+    scale = {"$ifNull": ["$scale", 1.0]}
+    elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated", now]}]}]}
+
+    def refill(field, per_minute):
+        return {"$min": [
+            per_minute,
+            {"$add": [
+                {"$ifNull": ["$" + field, per_minute]},
+                {"$multiply": [elapsed, per_minute / 60, scale]},
+            ]},
+        ]}
+
+    pipeline = [
+        {"$set": {
+            "requests": refill("requests", requests_per_minute),
+            "tokens": refill("tokens", tokens_per_minute),
+            "scale": scale,
+            "updated": now,
+        }},
+        {"$set": {
+            "granted": {"$and": [
+                {"$gte": ["$requests", 1]},
+                {"$gte": ["$tokens", tokens]},
+                {"$lte": [{"$ifNull": ["$blocked_until", 0]}, now]},
+            ]},
+        }},
+        {"$set": {
+            "requests": {"$cond": ["$granted", {"$subtract": ["$requests", 1]}, "$requests"]},
+            "tokens": {"$cond": ["$granted", {"$subtract": ["$tokens", tokens]}, "$tokens"]},
+        }},
+    ]
+    return RateLimit._get_collection().find_one_and_update(
+        {"_id": name},
+        pipeline,
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def acquire(name, tokens=0):
+    """
+    Blocks until the shared bucket for name allows one more request using the
+    given number of tokens.
+
+    Args:
+        name (str): The upstream model name, a key of LIMITS.
+        tokens (int, optional): The number of tokens the request will use.
+    """
+    requests_per_minute, tokens_per_minute = LIMITS[name]
+    if tokens_per_minute is None:
+        tokens, tokens_per_minute = 0, 1
+    # a request larger than the whole budget would never be granted
+    tokens = min(tokens, tokens_per_minute)
+
+    while True:
+        bucket = _take(name, requests_per_minute, tokens_per_minute, tokens)
+        if bucket["granted"]:
+            return
+
+        now = time.time()
+        rate = bucket["scale"] / 60
+        wait = max(
+            bucket.get("blocked_until", 0) - now,
+            (1 - bucket["requests"]) / (requests_per_minute * rate),
+            (tokens - bucket["tokens"]) / (tokens_per_minute * rate),
+        )
+        wait = min(max(wait, 0.05), MAX_WAIT_SECONDS) * random.uniform(1, 1.1)
+        logger.debug("Rate limited on {name}, waiting {wait:.2f}s".format(name=name, wait=wait))
+        time.sleep(wait)
+
+
+def on_rate_limited(name, retry_after):
+    """
+    Records a 429 response: every process stops calling the API for
+    retry_after seconds and the share of the limits in use is reduced.
+    """
+    RateLimit._get_collection().update_one(
+        {"_id": name},
+        [{"$set": {
+            "scale": {"$max": [MIN_SCALE, {"$multiply": [{"$ifNull": ["$scale", 1.0]}, SCALE_DECREASE]}]},
+            "blocked_until": {"$max": [{"$ifNull": ["$blocked_until", 0]}, time.time() + retry_after]},
+        }}],
+        upsert=True,
+    )
+
+
+def on_success(name):
+    """
+    Records a successful call, growing the share of the limits in use back
+    towards the configured limits.
+    """
+    RateLimit._get_collection().update_one(
+        {"_id": name, "scale": {"$lt": 1.0}},
+        [{"$set": {"scale": {"$min": [1.0, {"$add": ["$scale", SCALE_INCREASE]}]}}}],
+    )
+
+
+def get_retry_after(error, attempt):
+    """
+    Returns the number of seconds to wait after a 429 response, taken from its
+    Retry-After header if present and exponential backoff otherwise.
+    """
+    try:
+        return float(error.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** attempt)
+
+
+def call(name, fn, tokens=0, max_retries=MAX_RETRIES):
+    """
+    Calls an OpenAI API through the shared rate limiter, retrying on 429
+    responses.
+
+    Args:
+        name (str): The upstream model name used to pick the limits.
+        fn (Callable): Makes the API call.
+        tokens (int, optional): The number of tokens the call will use.
+        max_retries (int, optional): The number of retries after 429 responses.
+
+    Returns:
+        The result of fn.
+
+    Raises:
+        openai.error.RateLimitError: If the call is still rate limited after max_retries.
+    """
+    if name not in LIMITS:
+        return fn()
+
+    openai = get_openai()
+    for attempt in range(max_retries + 1):
+        acquire(name, tokens)
+        try:
+            result = fn()
+        except openai.error.RateLimitError as e:
+            retry_after = get_retry_after(e, attempt)
+            logger.warning("Rate limited by {name}, retrying in {retry_after:.1f}s ({attempt}/{max_retries})".format(
+                name=name, retry_after=retry_after, attempt=attempt + 1, max_retries=max_retries))
+            on_rate_limited(name, retry_after)
+            if attempt == max_retries:
+                raise
+            continue
+        on_success(name)
+        return result
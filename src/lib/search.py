@@ -0,0 +1,152 @@
+import logging
+import math
+import re
+from markupsafe import Markup, escape
+from src.lib.models import (
+    SearchEntry,
+    Summary,
+)
+
+logger = logging.getLogger(__name__)
+
+RESULTS_PER_PAGE = 10
+
+# number of characters of context shown around the first match in a snippet
+SNIPPET_LENGTH = 300
+
+
+def index_summary(summary):
+    """
+    Adds or updates the search entry for a summary. Called whenever a summary
+    is saved so the index is updated incrementally.
+
+    Args:
+        summary (Summary): The saved summary.
+
+    Returns:
+        SearchEntry: The search entry for the summary.
+    """
+    transcription = summary.transcription
+    episode = transcription.episode
+    podcast = episode.podcast
+    logger.debug("Indexing summary {id}...".format(id=summary.id))
+    return SearchEntry.objects(summary=summary).modify(
+        upsert=True,
+        new=True,
+        set__episode_uuid=episode.uuid,
+        set__episode_name=episode.name,
+        set__podcast_uuid=podcast.uuid if podcast else None,
+        set__podcast_name=podcast.name if podcast else None,
+        set__summary_text=summary.text,
+        set__transcription_text=transcription.text,
+        set__creation_date=summary.creation_date,
+    )
+
+
+def rebuild_index():
+    """
+    Re-indexes every summary, e.g. for summaries saved before search existed.
+
+    Returns:
+        int: The number of summaries indexed.
+    """
+    count = 0
+    for summary in Summary.objects().no_cache():
+        index_summary(summary)
+        count += 1
+    logger.info("Indexed {count} summaries".format(count=count))
+    return count
+
+
+def get_query_terms(query):
+    """
+    Returns the plain terms of a text search query, skipping negated terms.
+
+    Args:
+        query (str): The search query.
+
+    Returns:
+        List[str]: The lowercased terms to highlight.
+    """
+    return [term.lower() for term in re.findall(r"(?<![-\w])\w+", query)]
+
+
+def highlight(text, terms, length=SNIPPET_LENGTH):
+    """
+    Builds an HTML snippet of text around the first occurrence of any of the
+    given terms, with every occurrence wrapped in a <mark> tag. Terms match at
+    word starts so stemmed matches ("summarize" for "summaries") are partially
+    highlighted.
+
+    Args:
+        text (str): The text to build the snippet from.
+        terms (List[str]): The query terms.
+        length (int, optional): The approximate snippet length in characters.
+
+    Returns:
+        Markup or None: The escaped snippet, or None if no term occurs in text.
+    """
+    if not text or not terms:
+        return None
+    pattern = re.compile(r"\b(?:{terms})\w*".format(
+        terms="|".join(re.escape(term[:max(4, len(term) - 2)]) for term in terms)), re.IGNORECASE)
+    if (match := pattern.search(text)) is None:
+        return None
+
+    start = max(0, match.start() - length // 3)
+    end = min(len(text), start + length)
+    # avoid cutting words in half at the edges of the snippet
+    if start > 0 and (space := text.find(" ", start, match.start())) != -1:
+        start = space + 1
+    if end < len(text) and (space := text.rfind(" ", match.end(), end)) != -1:
+        end = space
+
+    snippet = text[start:end]
+    parts = []
+    position = 0
+    for term_match in pattern.finditer(snippet):
+        parts.append(escape(snippet[position:term_match.start()]))
+        parts.append(Markup("<mark>{term}</mark>").format(term=term_match.group(0)))
+        position = term_match.end()
+    parts.append(escape(snippet[position:]))
+
+    prefix = "..." if start > 0 else ""
+    suffix = "..." if end < len(text) else ""
+    return Markup(prefix) + Markup("").join(parts) + Markup(suffix)
+
+
+def search(query, page=1, per_page=RESULTS_PER_PAGE):
+    """
+    Searches summaries, transcriptions, episode names and podcast names.
+    Results are ranked by text score, weighted towards episode and podcast
+    names, then by recency.
+
+    Args:
+        query (str): The search query, using MongoDB text search syntax
+            ("quoted phrases", -negated terms).
+        page (int, optional): The page of results to return, starting at 1.
+        per_page (int, optional): The number of results per page.
+
+    Returns:
+        dict: The matching results for the page with highlighted snippets, the
+            total number of matches and the number of pages.
+    """
+    queryset = SearchEntry.objects.search_text(query).order_by("$text_score", "-creation_date")
+    total = queryset.count()
+    entries = queryset.skip((page - 1) * per_page).limit(per_page)
+
+    terms = get_query_terms(query)
+    results = []
+    for entry in entries:
+        results.append({
+            "entry": entry,
+            "score": entry.get_text_score(),
+            "summary_snippet": highlight(entry.summary_text, terms),
+            "transcription_snippet": highlight(entry.transcription_text, terms),
+        })
+
+    return {
+        "results": results,
+        "total": total,
+        "pages": math.ceil(total / per_page),
+    }
@@ -1,19 +1,18 @@
-import openai
 import logging
 import math
 import re
-import tiktoken
 from src.lib.utils import (
-    KEYS,
+    forget_transcription,
+    get_encoding,
+    get_openai,
     get_summary_if_exists,
 )
 from src.lib.models import (
     SummarizationModel,
     Summary,
+    Transcription,
 )
-from src.lib import transcribe
-
-openai.api_key = KEYS["OPENAI_KEY"]
+from src.lib import dedup, jobs, persist, ratelimit, search
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +44,12 @@ MAX_TOKEN_COUNT = 4096
 _chunk_split_safety_factor = 0.9
 _chunk_overlap_ratio = 0.05
 _chunk_summary_word_limit_safety_factor = 0.9
+# tokens of new text in each chunk cut by get_next_chunk, which with the overlap
+# makes chunks about as long as the ones cut by get_chunk_indices
+_progressive_chunk_token_count = int(MAX_TOKEN_COUNT * _chunk_split_safety_factor * (1 - _chunk_overlap_ratio))
+
+# completion tokens budgeted per request by the rate limiter
+_completion_token_estimate = 500
 
 
 def get_token_count(text, model):
@@ -58,12 +63,14 @@ def get_token_count(text, model):
     Returns:
         int: The number of tokens in the text.
     """
-    return len(tiktoken.encoding_for_model(model.name).encode(text))
+    return len(get_encoding(model.name).encode(text))
 
 
 def get_prompt_response(prompt, text, model):
     """
-    Generates a response using OpenAI's Chat Completion API.
+    Generates a response using OpenAI's Chat Completion API. Calls go through
+    the shared rate limiter, budgeting the prompt tokens plus an estimate of the
+    completion.
 
     Args:
         prompt (str): The system prompt for the conversation.
@@ -73,20 +80,22 @@ def get_prompt_response(prompt, text, model):
     Returns:
         str: The response generated by the Chat Completion API.
     """
-    response = openai.ChatCompletion.create(
+    messages = [
+        {
+            "role": "system",
+            "content": prompt
+        },
+        {
+            "role": "user",
+            "content": text
+        }
+    ]
+    tokens = get_token_count(prompt, model) + get_token_count(text, model) + _completion_token_estimate
+    response = ratelimit.call(model.name, lambda: get_openai().ChatCompletion.create(
         model=model.name,
         temperature=0,
-        messages=[
-            {
-                "role": "system",
-                "content": prompt
-            },
-            {
-                "role": "user",
-                "content": text
-            }
-        ]
-    )
+        messages=messages
+    ), tokens=tokens)
     logger.debug(response)
     return response['choices'][0]['message']['content']
 
@@ -161,7 +170,86 @@ def sanitize_and_join_summary_texts(chunk_summary_texts):
     return joined_summary_text
 
 
-def chunk_and_summarize(transcription, model):
+def get_next_chunk(text, position, model, final=False):
+    """
+    Returns the indices of the next chunk of a transcription which is still
+    growing, so chunks can be summarized while later parts of the audio are
+    being transcribed. Chunks overlap the previous chunk like the ones cut by
+    get_chunk_indices. A chunk is only cut once enough text follows it for
+    another chunk of at least the overlap size, and the final chunk takes the
+    rest of the text.
+
+    Args:
+        text (str): The transcription so far.
+        position (int): The index where the previous chunk ended, 0 for the first chunk.
+        model (str): The model the chunk will be summarized with (determines tokenization scheme).
+        final (bool, optional): Whether text is complete.
+
+    Returns:
+        Tuple[int, int] or None: The start and end index of the chunk, or None if
+            there is not enough text for a chunk yet.
+    """
+    if position >= len(text):
+        return None
+    encoding = get_encoding(model.name)
+    tokens = encoding.encode(text[position:])
+    if len(tokens) > _progressive_chunk_token_count * (1 + _chunk_overlap_ratio):
+        end = position + len(encoding.decode(tokens[:_progressive_chunk_token_count]))
+    elif final:
+        end = len(text)
+    else:
+        return None
+    start = max(0, position - int((end - position) * _chunk_overlap_ratio))
+    return start, end
+
+
+def estimate_num_chunks(token_count):
+    """
+    Returns the number of chunks get_next_chunk cuts a transcription of
+    token_count tokens into.
+    """
+    return max(1, math.ceil(token_count / _progressive_chunk_token_count))
+
+
+def summarize_chunk(chunk, num_chunks, model, first=False):
+    """
+    Summarizes one chunk of a long transcription in some detail.
+
+    Args:
+        chunk (str): The chunk text.
+        num_chunks (int): The (estimated) number of chunks of the transcription, which
+            determines the length of the chunk summary.
+        model (str): The name of the model to use for generating summaries.
+        first (bool, optional): Whether this is the first chunk of the transcription.
+
+    Returns:
+        str: The chunk summary text.
+    """
+    chunk_token_count = get_token_count(chunk, model)
+    logger.debug("Chunk token count: {chunk_token_count}".format(chunk_token_count=chunk_token_count))
+    # create prompt with appropriate word count
+    chunk_summary_word_limit = int(MAX_TOKEN_COUNT * _chunk_summary_word_limit_safety_factor / num_chunks)
+    prompt = PROMPTS["chunk_summary"].format(N=chunk_summary_word_limit)
+
+    # sanitize chunk in basic way to remove dangling sentences otherwise gpt-3.5-turbo
+    # seems to generate hallucinated completions
+    sentence_starts = [m.start() for m in re.finditer(r"\. ", chunk)]
+    # remove dangling sentence at the end of chunk
+    if len(sentence_starts) > 0:
+        chunk = chunk[:sentence_starts[-1] + 1]
+        # if not first chunk, remove dangling sentence at the start
+        if not first:
+            chunk = chunk[sentence_starts[0] + 2:]
+    else:
+        logger.warning("No sentences found in chunk which is odd.")
+
+    chunk_summary_text = get_prompt_response(prompt, chunk, model)
+    chunk_summary_token_count = get_token_count(chunk_summary_text, model)
+    logger.debug("Chunk summary token count: {chunk_summary_token_count}".format(chunk_summary_token_count=chunk_summary_token_count))
+    return chunk_summary_text
+
+
+def chunk_and_summarize(transcription, model, chunk_summary_texts=None):
     """
     Generates a summary by breaking up the given transcription into chunks. Each chunk is
     summarized first in some detail. The detailed summaries for each chunk are then joined
@@ -170,6 +258,9 @@ def chunk_and_summarize(transcription, model):
     Args:
         transcription (str): The full transcription text.
         model (str): The name of the model to use for generating summaries.
+        chunk_summary_texts (Callable[[], List[str]], optional): Returns chunk summaries
+            generated while the transcription was produced. The transcription is chunked
+            here instead if they are not given or their joined text is too long.
 
     Returns:
         str: The generated summary text.
@@ -177,42 +268,33 @@ def chunk_and_summarize(transcription, model):
     Raises:
         Exception: If the generated summary exceeds the maximum token count.
     """
-    logger.info("Generating summary by breaking up transcription into chunks...")
-
-    # get chunk indices
-    chunk_indices = get_chunk_indices(transcription.text, model)
-
-    # extract topic summaries from chunks
-    chunk_summary_texts = []
-    for i, (start, end) in enumerate(chunk_indices):
-        logger.debug("Chunk {i}/{N}".format(i=i + 1, N=len(chunk_indices)))
-        logger.debug("start:end: {start}:{end}".format(start=start, end=end))
-        chunk = transcription.text[start:end]
-        chunk_token_count = get_token_count(chunk, model)
-        logger.debug("Chunk token count: {chunk_token_count}".format(chunk_token_count=chunk_token_count))
-        # create prompt with appropriate word count
-        chunk_summary_word_limit = int(MAX_TOKEN_COUNT * _chunk_summary_word_limit_safety_factor / len(chunk_indices))
-        prompt = PROMPTS["chunk_summary"].format(N=chunk_summary_word_limit)
-
-        # sanitize chunk in basic way to remove dangling sentences otherwise gpt-3.5-turbo
-        # seems to generate hallucinated completions
-        sentence_starts = [m.start() for m in re.finditer(r"\. ", chunk)]
-        # remove dangling sentence at the end of chunk
-        if len(sentence_starts) > 0:
-            chunk = chunk[:sentence_starts[-1] + 1]
-            # if not first chunk, remove dangling sentence at the start
-            if i > 0:
-                chunk = chunk[sentence_starts[0] + 2:]
-        else:
-            logger.warning("No sentences found in chunk which is odd.")
-
-        chunk_summary_text = get_prompt_response(prompt, chunk, model)
-        chunk_summary_token_count = get_token_count(chunk_summary_text, model)
-        logger.debug("Chunk summary token count: {chunk_summary_token_count}".format(chunk_summary_token_count=chunk_summary_token_count))
-        chunk_summary_texts.append(chunk_summary_text)
-
-    # sanitize and join summary texts
-    joined_summary_text = sanitize_and_join_summary_texts(chunk_summary_texts)
+    joined_summary_text = None
+    if chunk_summary_texts is not None:
+        logger.info("Generating summary from chunk summaries generated during transcription...")
+        joined_summary_text = sanitize_and_join_summary_texts(chunk_summary_texts())
+        if get_token_count(joined_summary_text, model) > MAX_TOKEN_COUNT:
+            # the number of chunks was underestimated so the chunk summaries are too long
+            logger.warning("Chunk summaries generated during transcription are too long, re-chunking...")
+            joined_summary_text = None
+
+    if joined_summary_text is None:
+        logger.info("Generating summary by breaking up transcription into chunks...")
+
+        # get chunk indices
+        chunk_indices = get_chunk_indices(transcription.text, model)
+
+        # extract topic summaries from chunks
+        chunk_summary_texts = []
+        for i, (start, end) in enumerate(chunk_indices):
+            logger.debug("Chunk {i}/{N}".format(i=i + 1, N=len(chunk_indices)))
+            logger.debug("start:end: {start}:{end}".format(start=start, end=end))
+            jobs.checkpoint()
+            chunk = transcription.text[start:end]
+            chunk_summary_texts.append(summarize_chunk(chunk, len(chunk_indices), model, first=i == 0))
+
+        # sanitize and join summary texts
+        joined_summary_text = sanitize_and_join_summary_texts(chunk_summary_texts)
+
     joined_summary_token_count = get_token_count(joined_summary_text, model)
     logger.debug("Joined summary token count: {joined_summary_token_count}".format(joined_summary_token_count=joined_summary_token_count))
 
@@ -224,7 +306,38 @@ def chunk_and_summarize(transcription, model):
     return summary_text
 
 
-def summarize(transcription, model=SummarizationModel(name="gpt-3.5-turbo")):
+def get_near_duplicate_summary(transcription, model, prompt):
+    """
+    Looks for a summary of a near duplicate transcription (re-uploads, trailers,
+    syndicated episodes) made with the same model and prompt.
+
+    Args:
+        transcription (Transcription): The transcription to be summarized.
+        model (SummarizationModel): The summarization model.
+        prompt (str): The summarization prompt.
+
+    Returns:
+        Summary or None: The summary of the most similar duplicate, if any.
+    """
+    if not transcription.minhash:
+        # transcriptions saved before signatures existed are signed on first use. The
+        # transcription may be memoized and shared between threads, so a copy is signed
+        signed = dedup.sign(Transcription(id=transcription.id, text=transcription.text))
+        Transcription.objects(id=transcription.id).update_one(
+            set__minhash=signed.minhash, set__lsh_bands=signed.lsh_bands)
+        # so the next lookup loads the signed transcription instead of signing it again
+        forget_transcription(transcription)
+        transcription = signed
+
+    for similarity, duplicate in dedup.find_near_duplicates(transcription):
+        if (summary := get_summary_if_exists(duplicate, model, prompt)):
+            logger.info("Reusing summary of transcription {id} (similarity {similarity:.2f})".format(
+                id=duplicate.id, similarity=similarity))
+            return summary
+    return None
+
+
+def summarize(transcription, model=SummarizationModel(name="gpt-3.5-turbo"), chunk_summary_texts=None):
     """
     Generate a summary of a transcription using a specified summarization model.
 
@@ -232,6 +345,10 @@ def summarize(transcription, model=SummarizationModel(name="gpt-3.5-turbo")):
         transcription (Transcription): The transcription object to be summarized.
         model (SummarizationModel, optional): The summarization model to be used.
             Defaults to SummarizationModel(name="gpt-3.5-turbo").
+        chunk_summary_texts (Callable[[], List[str]], optional): Returns chunk summaries
+            generated while the transcription was produced, used if the transcription
+            is too long to be summarized in one shot. Not called if an existing summary
+            is reused.
 
     Returns:
         Summary: The generated summary of the transcription.
@@ -243,8 +360,7 @@ def summarize(transcription, model=SummarizationModel(name="gpt-3.5-turbo")):
         raise ValueError("Transcription cannot be None")
 
     # check number of tokens in transcription here
-    encoding = tiktoken.encoding_for_model(model.name)
-    token_count = len(encoding.encode(transcription.text))
+    token_count = get_token_count(transcription.text, model)
     logger.debug("Token count: {token_count}".format(token_count=token_count))
 
     prompt = PROMPTS["generic_summarize"]
@@ -257,9 +373,13 @@ def summarize(transcription, model=SummarizationModel(name="gpt-3.5-turbo")):
     if (summary := get_summary_if_exists(transcription, model, prompt)):
         return summary
 
-    if token_count > MAX_TOKEN_COUNT:
+    jobs.report_progress(stage="summarizing")
+    reused_from = get_near_duplicate_summary(transcription, model, prompt)
+    if reused_from:
+        summary_text = reused_from.text
+    elif token_count > MAX_TOKEN_COUNT:
         # chunk transcription and generate summary
-        summary_text = chunk_and_summarize(transcription, model)
+        summary_text = chunk_and_summarize(transcription, model, chunk_summary_texts)
     else:
         logger.info("Generating summary for transcription in one shot...")
         summary_text = get_prompt_response(prompt, transcription.text, model)
@@ -268,23 +388,10 @@ def summarize(transcription, model=SummarizationModel(name="gpt-3.5-turbo")):
         transcription=transcription,
         summarization_model=model,
         prompt=prompt,
-        text=summary_text
+        text=summary_text,
+        reused_from=reused_from,
     )
     logger.debug("Saving summary...")
-    summary.save(cascade=True)
-    return summary
-
-
-def transcribe_and_summarize(episode):
-    """
-    Generate a summary of the given episode by transcribing it and summarizing the transcription.
-
-    Args:
-        episode (str): The episode to be transcribed and summarized.
-
-    Returns:
-        str: The summary of the episode.
-    """
-    transcription = transcribe.transcribe(episode)
-    summary = summarize(transcription)
+    persist.insert(summary)
+    search.index_summary(summary)
     return summary
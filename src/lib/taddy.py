@@ -1,7 +1,8 @@
-import requests
 import logging
+from src.lib.cache import LRUCache
 from src.lib.utils import (
-    KEYS,
+    get_keys,
+    get_session,
     get_episode_if_exists
 )
 from src.lib.models import (
@@ -9,15 +10,26 @@ from src.lib.models import (
     Episode,
 )
 
-HEADERS = {
-    "X-USER-ID": KEYS["TADDY_USER_ID"],
-    "X-API-KEY": KEYS["TADDY_KEY"],
-}
-
 ENDPOINT = "https://api.taddy.org"
 
+# podcast and episode listings are served from memory for this many seconds
+CATALOG_TTL = 300
+
 logger = logging.getLogger(__name__)
 
+_catalog_cache = LRUCache(maxsize=1024, ttl=CATALOG_TTL)
+
+
+def get_headers():
+    """
+    Returns the authentication headers for the Taddy API.
+    """
+    keys = get_keys()
+    return {
+        "X-USER-ID": keys["TADDY_USER_ID"],
+        "X-API-KEY": keys["TADDY_KEY"],
+    }
+
 
 def handle_response(response):
     """
@@ -53,6 +65,9 @@ def search_or_get_podcast(term=None, uuid=None):
     if term is None and uuid is None:
         logger.error("You must provide a search term or a podcast uuid!")
         return False
+    cache_key = ("podcast", term, uuid)
+    if (podcast := _catalog_cache.get(cache_key)) is not None:
+        return podcast
     if uuid:
         logger.debug("Getting podcast: {uuid}".format(uuid=uuid))
         query = """
@@ -81,10 +96,10 @@ def search_or_get_podcast(term=None, uuid=None):
             }}
         }}
         """.format(term=term)
-    response = requests.post(
+    response = get_session().post(
         url=ENDPOINT,
         json={"query": query},
-        headers=HEADERS
+        headers=get_headers()
     )
     response_json = handle_response(response)
     if (podcast_json := response_json["data"]["getPodcastSeries"]) is None:
@@ -100,6 +115,7 @@ def search_or_get_podcast(term=None, uuid=None):
         imageUrl=podcast_json["imageUrl"],
         episodeCount=podcast_json["totalEpisodesCount"],
     )
+    _catalog_cache.set(cache_key, podcast)
     return podcast
 
 
@@ -115,6 +131,10 @@ def get_episodes(podcast, page=1, limitPerPage=10):
     Returns:
         List[Episode]: A list of Episode objects representing the retrieved episodes.
     """
+    cache_key = ("episodes", podcast.uuid, page, limitPerPage)
+    if (episodes := _catalog_cache.get(cache_key)) is not None:
+        return episodes
+
     logger.debug(
         "Getting episodes for podcast: {uuid} ({name})".format(
             uuid=podcast.uuid,
@@ -139,10 +159,10 @@ def get_episodes(podcast, page=1, limitPerPage=10):
         page=page,
         limitPerPage=limitPerPage,
     )
-    response = requests.post(
+    response = get_session().post(
         url=ENDPOINT,
         json={"query": query},
-        headers=HEADERS
+        headers=get_headers()
     )
     response_json = handle_response(response)
     episodes_json = response_json["data"]["getPodcastSeries"]["episodes"]
@@ -157,6 +177,7 @@ def get_episodes(podcast, page=1, limitPerPage=10):
             audioUrl=episode_json["audioUrl"],
         )
         episodes.append(episode)
+    _catalog_cache.set(cache_key, episodes)
     return episodes
 
 
@@ -197,10 +218,10 @@ def get_episode(uuid):
     """.format(
         uuid=uuid,
     )
-    response = requests.post(
+    response = get_session().post(
         url=ENDPOINT,
         json={"query": query},
-        headers=HEADERS
+        headers=get_headers()
     )
     response_json = handle_response(response)
     episode_json = response_json["data"]["getPodcastEpisode"]
@@ -1,103 +1,798 @@
-import openai
-import urllib3
-import uuid
 import os
+import io
+import re
+import difflib
 import logging
 import math
-import pydub
+import mmap
+import itertools
+import tempfile
+import contextlib
 from src.lib.utils import (
-    KEYS,
+    get_http,
     get_transcription_if_exists,
 )
 from src.lib.models import (
+    SliceTranscription,
+    SplitManifest,
     Transcription,
     TranscriptionModel,
 )
-
-openai.api_key = KEYS["OPENAI_KEY"]
+from src.lib import audiocache, backends, dedup, jobs, persist
 
 logger = logging.getLogger(__name__)
 
+# maximum file size accepted by the whisper API (25MB)
+MAX_FILE_SIZE = 26214400
+
+# episodes up to this size are downloaded, split and uploaded entirely from memory,
+# larger ones are spilled to an anonymous temporary file in SPILL_DIR
+IN_MEMORY_MAX_FILE_SIZE = 104857600
+# prefer tmpfs for spilled downloads when it is available
+SPILL_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else None
+DOWNLOAD_CHUNK_SIZE = 1048576
+
+# each slice runs on this long into the next so words cut at its end are heard
+# whole at the start of the next, the texts are stitched where they agree
+OVERLAP_SECONDS = 4
+# slices are sized for latency rather than the upload limit: no slice is longer
+# than TARGET_SLICE_SECONDS, and audio is cut into at least PARALLEL_SLICES
+# slices, which the pipeline transcribes concurrently, unless they would be
+# shorter than MIN_SLICE_SECONDS
+TARGET_SLICE_SECONDS = 600
+PARALLEL_SLICES = 4
+MIN_SLICE_SECONDS = 120
+# the words at the end of a slice transcription and the start of the next
+# searched for the overlap, and the number of consecutive words which must match
+STITCH_WORDS = 30
+MIN_STITCH_WORDS = 3
+
+# mpeg audio frame header tables used to cut mp3 files on frame boundaries
+_MPEG_SAMPLE_RATES = {
+    3: (44100, 48000, 32000),  # MPEG 1
+    2: (22050, 24000, 16000),  # MPEG 2
+    0: (11025, 12000, 8000),  # MPEG 2.5
+}
+_MPEG_BITRATES = {
+    (3, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (3, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (3, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+_MP3_SEARCH_WINDOW = 65536
+
+
+def _close_mmap(audio_map):
+    # slices handed out may still reference the mapping, in which case it is
+    # unmapped when the last of them is garbage collected
+    try:
+        audio_map.close()
+    except BufferError:
+        logger.debug("Audio buffer still referenced, deferring unmap")
+
+
+def _allocate_audio_buffer(size, stack):
+    """
+    Returns a writable buffer of size bytes, in memory up to IN_MEMORY_MAX_FILE_SIZE
+    and a memory mapped anonymous temporary file in SPILL_DIR beyond.
+    """
+    if size <= IN_MEMORY_MAX_FILE_SIZE:
+        return memoryview(bytearray(size))
+    logger.debug("Download exceeds {size} bytes, spilling to {dir}...".format(
+        size=IN_MEMORY_MAX_FILE_SIZE, dir=SPILL_DIR or tempfile.gettempdir()))
+    spill_file = stack.enter_context(tempfile.TemporaryFile(dir=SPILL_DIR))
+    spill_file.truncate(size)
+    audio_map = mmap.mmap(spill_file.fileno(), size)
+    stack.callback(_close_mmap, audio_map)
+    return memoryview(audio_map)
+
+
+def _map_file(audio_file, stack):
+    if os.fstat(audio_file.fileno()).st_size == 0:
+        return memoryview(b"")
+    audio_map = mmap.mmap(audio_file.fileno(), 0, access=mmap.ACCESS_READ)
+    stack.callback(_close_mmap, audio_map)
+    return memoryview(audio_map)
+
+
+def _request_audio(url, stack, headers=None):
+    response = get_http().request("GET", url, headers=headers, preload_content=False)
+    stack.callback(response.release_conn)
+    if response.status != 200 and not (headers and response.status == 304):
+        raise Exception("Audio download failed with status {status}".format(status=response.status))
+    return response
+
+
+def _open_audio(url, stack):
+    """
+    Revalidates the cached audio of url, see audiocache.py.
+
+    Returns:
+        Tuple[memoryview or None, HTTPResponse or None]: The cached audio if it is
+            still valid, otherwise the response to download the audio from.
+    """
+    if (validators := audiocache.get_validators(url)):
+        try:
+            response = _request_audio(url, stack, validators)
+        except Exception as e:
+            if (audio_file := audiocache.load(url, stack)) is None:
+                raise
+            logger.warning("Could not revalidate cached audio, using it anyway: {error}".format(error=e))
+            return _map_file(audio_file, stack), None
+        if response.status != 304:
+            return None, response
+        if (audio_file := audiocache.load(url, stack)) is not None:
+            logger.debug("Cached audio is still valid")
+            return _map_file(audio_file, stack), None
+    return None, _request_audio(url, stack)
+
+
+def _read_audio(response, stack):
+    buffer = bytearray()
+    spill_file = None
+    for chunk in response.stream(DOWNLOAD_CHUNK_SIZE):
+        if spill_file is None and len(buffer) + len(chunk) > IN_MEMORY_MAX_FILE_SIZE:
+            logger.debug("Download exceeds {size} bytes, spilling to {dir}...".format(
+                size=IN_MEMORY_MAX_FILE_SIZE, dir=SPILL_DIR or tempfile.gettempdir()))
+            spill_file = stack.enter_context(tempfile.TemporaryFile(dir=SPILL_DIR))
+            spill_file.write(buffer)
+            buffer = None
+        if spill_file is None:
+            buffer += chunk
+        else:
+            spill_file.write(chunk)
+
+    if spill_file is None:
+        logger.debug("Downloaded {size} bytes to memory".format(size=len(buffer)))
+        return memoryview(buffer)
+
+    spill_file.flush()
+    audio_map = mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ)
+    stack.callback(_close_mmap, audio_map)
+    logger.debug("Downloaded {size} bytes to disk".format(size=len(audio_map)))
+    return memoryview(audio_map)
+
+
+def download_audio(url, stack):
+    """
+    Downloads an audio file into a buffer. Files up to IN_MEMORY_MAX_FILE_SIZE
+    are kept in memory, larger ones are spilled to an anonymous temporary file
+    in SPILL_DIR and memory mapped. Downloads are cached on disk and cached
+    files are used as long as the server confirms they have not changed.
+
+    Args:
+        url (str): The url of the audio file.
+        stack (contextlib.ExitStack): The stack owning the download. The connection,
+            temporary file and mapping are released when the stack is closed, also
+            if an exception is raised.
+
+    Returns:
+        memoryview: A view of the downloaded bytes.
+
+    Raises:
+        Exception: If the download fails.
+    """
+    audio, response = _open_audio(url, stack)
+    if audio is None:
+        audio = _read_audio(response, stack)
+        audiocache.store(url, audio, response.headers)
+    return audio
+
 
-def get_audio_splits(file_path):
+def download_audio_progressively(url, stack):
     """
-    Generates a list of audio splits from the given file path, splitting
-        the file if its size exceeds the maximum file size.
+    Downloads an audio file into a buffer of the size announced by the server,
+    yielding as the bytes arrive so the start of the file can be processed
+    while the rest is still downloading. If the server does not announce the
+    size, the whole file is downloaded as in download_audio before yielding.
+    Cached audio which is still valid is yielded at once.
 
     Args:
-        file_path (str): The path to the audio file.
+        url (str): The url of the audio file.
+        stack (contextlib.ExitStack): The stack owning the download.
+
+    Yields:
+        Tuple[memoryview, int]: The buffer of the whole file and the number of bytes
+            received so far, first with 0 bytes received and last with all of them.
+
+    Raises:
+        Exception: If the download fails or its size does not match the announced size.
+    """
+    audio, response = _open_audio(url, stack)
+    if audio is not None:
+        yield audio, len(audio)
+        return
+    size = response.headers.get("Content-Length")
+    if size is None or response.headers.get("Content-Encoding", "identity") != "identity":
+        audio = _read_audio(response, stack)
+        audiocache.store(url, audio, response.headers)
+        yield audio, len(audio)
+        return
+
+    audio = _allocate_audio_buffer(int(size), stack)
+    received = 0
+    yield audio, received
+    for chunk in response.stream(DOWNLOAD_CHUNK_SIZE):
+        if received + len(chunk) > len(audio):
+            raise Exception("Audio download exceeds its announced size of {size} bytes".format(size=len(audio)))
+        audio[received:received + len(chunk)] = chunk
+        received += len(chunk)
+        yield audio, received
+    if received != len(audio):
+        raise Exception("Audio download ended after {received} of {size} bytes".format(
+            received=received, size=len(audio)))
+    logger.debug("Downloaded {size} bytes".format(size=len(audio)))
+    audiocache.store(url, audio, response.headers)
+
+
+def _mp3_frame_header(audio, offset):
+    """
+    Returns the version, layer, bitrate in bits per second, sample rate and
+    padding of the mp3 frame header at offset, or None if there is no valid
+    frame header at offset.
+    """
+    if offset + 4 > len(audio):
+        return None
+    if audio[offset] != 0xFF or (audio[offset + 1] & 0xE0) != 0xE0:
+        return None
+    version = (audio[offset + 1] >> 3) & 3
+    layer = (audio[offset + 1] >> 1) & 3
+    bitrate_index = audio[offset + 2] >> 4
+    sample_rate_index = (audio[offset + 2] >> 2) & 3
+    padding = (audio[offset + 2] >> 1) & 1
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or sample_rate_index == 3:
+        return None
+
+    bitrates = _MPEG_BITRATES[(version, layer)] if version == 3 else \
+        _MPEG_BITRATES[(2, 3 if layer == 3 else 2)]
+    bitrate = bitrates[bitrate_index] * 1000
+    sample_rate = _MPEG_SAMPLE_RATES[version][sample_rate_index]
+    return version, layer, bitrate, sample_rate, padding
+
+
+def _mp3_frame_length(audio, offset):
+    """
+    Returns the length in bytes of the mp3 frame starting at offset, or 0 if
+    there is no valid frame header at offset.
+    """
+    if (header := _mp3_frame_header(audio, offset)) is None:
+        return 0
+    version, layer, bitrate, sample_rate, padding = header
+    if layer == 3:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 1 and version != 3:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+
+def _find_mp3_frame(audio, offset):
+    """
+    Returns the offset of the first mp3 frame at or after offset which is
+    followed by another valid frame (or the end of the audio), or -1 if none is
+    found within _MP3_SEARCH_WINDOW bytes.
+    """
+    window = bytes(audio[offset:offset + _MP3_SEARCH_WINDOW])
+    i = window.find(b"\xff")
+    while i != -1:
+        position = offset + i
+        frame_length = _mp3_frame_length(audio, position)
+        if frame_length and (position + frame_length >= len(audio) or
+                             _mp3_frame_length(audio, position + frame_length)):
+            return position
+        i = window.find(b"\xff", i + 1)
+    return -1
+
+
+def _mp3_header_length(audio):
+    """
+    Returns the length of the ID3v2 tag at the start of audio, 0 if there is none.
+    """
+    if bytes(audio[:3]) != b"ID3" or len(audio) < 10:
+        return 0
+    # ID3v2 tag size is a 28 bit syncsafe integer excluding the 10 byte header
+    size = 0
+    for b in audio[6:10]:
+        size = (size << 7) | (b & 0x7F)
+    return 10 + size + (10 if audio[5] & 0x10 else 0)
+
+
+def _mp3_audio_start(audio):
+    """
+    Returns the offset of the first mp3 frame (after any ID3v2 tag), or -1 if
+    the audio does not look like an mp3 file.
+    """
+    offset = _mp3_header_length(audio)
+    position = _find_mp3_frame(audio, offset)
+    if position != offset:
+        return -1
+    return position
+
+
+def _mp3_frame_count(audio, offset):
+    """
+    Returns the number of frames announced by the Xing/Info or VBRI header in
+    the mp3 frame at offset, or None if the frame has no such header.
+    """
+    version, layer, _, _, _ = _mp3_frame_header(audio, offset)
+    mono = audio[offset + 3] >> 6 == 3
+    # the Xing header follows the side information, which depends on version and channels
+    side_info = (17 if mono else 32) if version == 3 else (9 if mono else 17)
+    xing = offset + 4 + side_info
+    if bytes(audio[xing:xing + 4]) in (b"Xing", b"Info") and len(audio) >= xing + 12 and audio[xing + 7] & 1:
+        return int.from_bytes(audio[xing + 8:xing + 12], "big")
+    vbri = offset + 36
+    if bytes(audio[vbri:vbri + 4]) == b"VBRI" and len(audio) >= vbri + 18:
+        return int.from_bytes(audio[vbri + 14:vbri + 18], "big")
+    return None
+
+
+def _mp3_bytes_per_second(audio, audio_start, size):
+    """
+    Returns the average number of bytes per second of the mp3 frames from
+    audio_start to size. Variable bitrate files are measured with the frame
+    count of their Xing/Info or VBRI header. Without one the bitrate of the
+    first frame is used, which is only right for constant bitrate files.
+    """
+    version, layer, bitrate, sample_rate, _ = _mp3_frame_header(audio, audio_start)
+    if frame_count := _mp3_frame_count(audio, audio_start):
+        if layer == 3:
+            samples_per_frame = 384
+        elif layer == 1 and version != 3:
+            samples_per_frame = 576
+        else:
+            samples_per_frame = 1152
+        return (size - audio_start) * sample_rate / (frame_count * samples_per_frame)
+    return bitrate / 8
+
+
+def _get_mp3_target(size, audio_start, i, num_splits):
+    # where the i-th of num_splits equally sized slices of the audio frames starts
+    return audio_start + i * (size - audio_start) // num_splits
+
+
+def _get_mp3_cut_targets(size, audio_start, num_splits, overlap_bytes):
+    """
+    Returns the offsets near which the start of each slice after the first and
+    the end of each slice before the last are cut, in the order they are
+    searched for, as (offset, is_start) pairs.
+    """
+    targets = []
+    for i in range(1, num_splits):
+        target = _get_mp3_target(size, audio_start, i, num_splits)
+        targets += [(target, True), (min(target + overlap_bytes, size - 1), False)]
+    return targets
+
+
+def _get_mp3_boundaries(audio, audio_start, num_splits, overlap_bytes):
+    """
+    Returns byte offsets cutting mp3 audio into num_splits slices of roughly
+    equal size on frame boundaries, each but the last running on for
+    overlap_bytes into the next, or None if a frame boundary cannot be found.
 
     Returns:
-        List[str]: A list of file paths representing the audio splits.
+        Tuple[List[int], List[int]] or None: The start offsets of the slices
+            followed by the size of the audio, and the end offset of each slice.
+    """
+    boundaries, ends = [0], []
+    for target, is_start in _get_mp3_cut_targets(len(audio), audio_start, num_splits, overlap_bytes):
+        if (position := _find_mp3_frame(audio, target)) == -1:
+            return None
+        (boundaries if is_start else ends).append(position)
+    return boundaries + [len(audio)], ends + [len(audio)]
+
+
+def _split_with_pydub(audio, boundaries=None, ends=None):
+    """
+    Decodes audio with pydub and re-exports slices as in-memory mp3 files,
+    either get_num_splits overlapping slices of equal duration or the slices
+    with the given boundaries and ends in milliseconds.
+
+    Returns:
+        Tuple[List[int], List[int], List[memoryview]]: The slice boundaries, the
+            slice ends and the slices.
 
     Notes:
-        - If the file size is below the maximum file size, the function returns a
-            list containing the original file path.
-        - The maximum file size is set to 26,214,400 (25MB) bytes.
-    """
-    file_size = os.path.getsize(file_path)
-    MAX_FILE_SIZE = 26214400
-    if file_size < MAX_FILE_SIZE:
-        return [file_path]
-
-    logger.info("Podcast audio file size above 25MB, splitting file...")
-    src_audio = pydub.AudioSegment.from_file(file_path)
-    duration_seconds = src_audio.duration_seconds
-    num_splits = math.ceil(file_size / (MAX_FILE_SIZE * 0.99))
-    logger.info("File will be split into {num_splits} audio slices...".format(num_splits=num_splits))
-
-    duration_milliseconds = duration_seconds * 1000
-    split_duration_milliseconds = int(duration_milliseconds / num_splits)
-    audio_slices = src_audio[::split_duration_milliseconds]
-
-    slice_filenames = []
-    for audio_slice in audio_slices:
-        if len(audio_slice) < 1000:
-            logger.debug("Slice size < 1s, skipping")
-            continue
-        slice_filename_prefix = file_path.split(".")[0]
-        slice_filename = "{prefix}_{i}.mp3".format(prefix=slice_filename_prefix, i=len(slice_filenames))
-        audio_slice.export(slice_filename, format="mp3")
-        slice_filenames.append(slice_filename)
+        - Decoding and encoding take far longer than downloading, the slices are
+          cached on disk by the content of audio.
+    """
+    # the slices depend on the splitting settings unless they are given
+    params = [boundaries, ends] if boundaries is not None else \
+        [MAX_FILE_SIZE, OVERLAP_SECONDS, TARGET_SLICE_SECONDS, PARALLEL_SLICES, MIN_SLICE_SECONDS]
+    if (cached := audiocache.load_splits(audio, params)) is not None:
+        return cached
+
+    # pydub is only needed for audio which is not mp3
+    import pydub
+    src_audio = pydub.AudioSegment.from_file(io.BytesIO(audio))
+    if boundaries is None:
+        duration_milliseconds = len(src_audio)
+        num_splits = get_num_splits(len(audio), duration_milliseconds / 1000)
+        boundaries = [i * duration_milliseconds // num_splits for i in range(num_splits)] + [duration_milliseconds]
+        ends = [min(boundary + OVERLAP_SECONDS * 1000, duration_milliseconds) for boundary in boundaries[1:]]
+
+    splits = [
+        src_audio[start:end].export(io.BytesIO(), format="mp3").getbuffer()
+        for start, end in get_slice_ranges(boundaries, ends)
+    ]
+    audiocache.store_splits(audio, params, boundaries, ends, splits)
+    return boundaries, ends, splits
+
+
+class SplitError(Exception):
+    """
+    Raised when audio which is being split while it downloads turns out not
+    to be splittable on mp3 frame boundaries after some slices were cut.
+    """
 
-    return slice_filenames
 
+def get_num_splits(file_size, duration=None):
+    """
+    Returns the number of slices to cut audio into: enough to keep each below
+    MAX_FILE_SIZE and, if the duration is known, at most TARGET_SLICE_SECONDS
+    long and at least PARALLEL_SLICES unless they would be shorter than
+    MIN_SLICE_SECONDS.
 
-def transcribe_files(audio_files):
+    Args:
+        file_size (int): The size of the audio in bytes.
+        duration (float, optional): The duration of the audio in seconds.
     """
-    Transcribes a list of audio files.
+    # leaves room for the overlap of each slice with the next
+    num_splits = 1 if file_size < MAX_FILE_SIZE else math.ceil(file_size / (MAX_FILE_SIZE * 0.95))
+    if duration:
+        num_splits = max(
+            num_splits,
+            math.ceil(duration / TARGET_SLICE_SECONDS),
+            min(PARALLEL_SLICES, int(duration // MIN_SLICE_SECONDS)),
+        )
+    return num_splits
+
+
+def get_slice_ranges(boundaries, ends=None):
+    """
+    Returns the start and end of each slice of a split. Slices without ends,
+    from manifests saved before slices overlapped, end where the next starts.
+    """
+    return list(zip(boundaries[:-1], ends or boundaries[1:]))
+
+
+def get_audio_splits(audio, manifest=None):
+    """
+    Generates a list of audio splits from the given audio buffer, cutting it
+    into slices which overlap by OVERLAP_SECONDS.
 
     Args:
-        audio_files (List[str]): A list of paths to audio files to be transcribed.
+        audio (memoryview): The downloaded audio.
+        manifest (Tuple[str, List[int], List[int]], optional): The unit, boundaries
+            and ends of a previous split of the same audio, which is reproduced
+            exactly. Ends are None for splits without overlap.
 
     Returns:
-        str: The concatenated transcription result from all the audio files.
+        Tuple[Tuple[str, List[int], List[int]], List[memoryview]]: The split
+            manifest (unit, slice boundaries and slice ends) and byte views
+            representing the audio splits.
 
-    TODO:
-        - Improve the joining logic to handle lost words and broken sentences.
-          Explore overlapping audio chunks for smarter joining.
+    Notes:
+        - mp3 audio is cut into get_num_splits slices, from its size and the
+            duration estimated from its bitrate. Other audio is only decoded to
+            be split if its size exceeds the maximum file size of 26,214,400 (25MB)
+            bytes, otherwise the function returns a list containing the original
+            buffer.
+        - mp3 audio is cut on frame boundaries without re-encoding so splits are
+            views into the original buffer and boundaries are byte offsets. Other
+            formats are decoded by pydub and exported to in-memory mp3 files with
+            boundaries in milliseconds.
     """
-    split_transcriptions = []
-    for i, audio_file in enumerate(audio_files):
-        logger.info("Transcribing file {i}/{N}".format(i=i + 1, N=len(audio_files)))
-        with open(audio_file, "rb") as f:
-            transcription_result = openai.Audio.transcribe("whisper-1", f)
-            logger.debug(transcription_result)
-            split_transcriptions.append(transcription_result)
+    if manifest is not None:
+        unit, boundaries, ends = manifest
+        if unit == "bytes":
+            return manifest, [audio[start:end] for start, end in get_slice_ranges(boundaries, ends)]
+        boundaries, ends, splits = _split_with_pydub(audio, boundaries, ends)
+        return (unit, boundaries, ends), splits
+
+    file_size = len(audio)
+    if (audio_start := _mp3_audio_start(audio)) != -1:
+        bytes_per_second = _mp3_bytes_per_second(audio, audio_start, file_size)
+        num_splits = get_num_splits(file_size, (file_size - audio_start) / bytes_per_second)
+        if num_splits == 1:
+            return ("bytes", [0, file_size], [file_size]), [audio]
+        logger.info("File will be split into {num_splits} audio slices...".format(num_splits=num_splits))
+        if (cuts := _get_mp3_boundaries(
+                audio, audio_start, num_splits, int(OVERLAP_SECONDS * bytes_per_second))) is not None:
+            return get_audio_splits(audio, ("bytes",) + cuts)
+        logger.warning("Could not find mp3 frame boundaries, re-encoding slices...")
+    elif get_num_splits(file_size) == 1:
+        return ("bytes", [0, file_size], [file_size]), [audio]
+
+    logger.info("Re-encoding audio slices...")
+    boundaries, ends, splits = _split_with_pydub(audio)
+    return ("ms", boundaries, ends), splits
+
+
+def split_audio_progressively(download, manifest=None, on_num_slices=None):
+    """
+    Cuts audio into the same slices as get_audio_splits while it is still
+    downloading. Each slice is yielded as soon as its bytes have arrived and
+    the frame boundary ending it has been found.
+
+    Args:
+        download (Iterator[Tuple[memoryview, int]]): The buffer and the number of
+            bytes received so far, as yielded by download_audio_progressively.
+        manifest (Tuple[str, List[int], List[int]], optional): The unit, boundaries
+            and ends of a previous split of the same audio, which is reproduced exactly.
+        on_num_slices (Callable[[int], None], optional): Called with the number of
+            slices as soon as it is known, before the first slice is yielded.
+
+    Yields:
+        Tuple[str, int, int, memoryview]: The unit, start and end of each slice
+            and the slice, in order.
 
+    Raises:
+        SplitError: If no mp3 frame boundary is found after slices were yielded.
+
+    Notes:
+        - Audio which is not mp3 is only split once the download completes.
+        - The number of slices is known once the first frame has arrived.
+        - A boundary is searched for once two search windows past its target
+          have arrived so it is found at the same offset as in the whole file.
+    """
+    audio, received = next(download)
+    size = len(audio)
+    if manifest is not None:
+        unit, boundaries, ends = manifest
+        ranges = get_slice_ranges(boundaries, ends)
+        if on_num_slices is not None:
+            on_num_slices(len(ranges))
+    else:
+        unit, boundaries, ends = "bytes", [0], []
+        ranges = None
+    targets = None
+
+    cut = 0
+    for audio, received in itertools.chain([(audio, received)], download):
+        complete = received == size
+        if unit != "bytes":
+            continue
+        if ranges is None:
+            view = audio if complete else audio[:received]
+            if targets is None:
+                # targets are relative to the first frame, found once any ID3v2 tag has arrived
+                if not complete and received < max(10, _mp3_header_length(view)) + 2 * _MP3_SEARCH_WINDOW:
+                    continue
+                if (audio_start := _mp3_audio_start(view)) == -1:
+                    logger.warning("Audio does not look like mp3, splitting once downloaded...")
+                    unit = None
+                    continue
+                bytes_per_second = _mp3_bytes_per_second(view, audio_start, size)
+                num_splits = get_num_splits(size, (size - audio_start) / bytes_per_second)
+                targets = _get_mp3_cut_targets(size, audio_start, num_splits, int(OVERLAP_SECONDS * bytes_per_second))
+                if on_num_slices is not None:
+                    on_num_slices(num_splits)
+            while len(boundaries) + len(ends) - 1 < len(targets):
+                target, is_start = targets[len(boundaries) + len(ends) - 1]
+                if not complete and received < target + 2 * _MP3_SEARCH_WINDOW:
+                    break
+                if (position := _find_mp3_frame(view, target)) == -1:
+                    if cut > 0:
+                        raise SplitError("No mp3 frame boundary found near byte {target}".format(target=target))
+                    logger.warning("Could not find mp3 frame boundaries, re-encoding slices once downloaded...")
+                    unit = None
+                    break
+                (boundaries if is_start else ends).append(position)
+            if unit is None:
+                continue
+            if len(boundaries) + len(ends) - 1 == len(targets) and complete:
+                boundaries.append(size)
+                ends.append(size)
+                ranges = get_slice_ranges(boundaries, ends)
+        # slices whose start and end have been found
+        available = ranges if ranges is not None else list(zip(boundaries, ends))
+        while cut < len(available) and available[cut][1] <= received:
+            start, end = available[cut]
+            yield unit, start, end, audio[start:end]
+            cut += 1
+
+    if unit != "bytes":
+        (unit, boundaries, ends), splits = get_audio_splits(audio, manifest if unit is not None else None)
+        if on_num_slices is not None:
+            on_num_slices(len(splits))
+        for (start, end), split in zip(get_slice_ranges(boundaries, ends), splits):
+            yield unit, start, end, split
+
+
+def _get_word_spans(text):
+    return [match.span() for match in re.finditer(r"\S+", text)]
+
+
+def _normalize_word(text, span):
+    return re.sub(r"\W", "", text[span[0]:span[1]].lower())
+
+
+def _stitch(text, next_text):
+    """
+    Returns text followed by next_text without the words both transcribed from
+    the overlapping audio, or None if no such words are found. Only the last
+    STITCH_WORDS words of text are changed.
+    """
+    spans = _get_word_spans(text)[-STITCH_WORDS:]
+    next_spans = _get_word_spans(next_text)[:STITCH_WORDS]
+    matcher = difflib.SequenceMatcher(
+        None,
+        [_normalize_word(text, span) for span in spans],
+        [_normalize_word(next_text, span) for span in next_spans],
+        autojunk=False,
+    )
+    match = matcher.find_longest_match(0, len(spans), 0, len(next_spans))
+    if match.size < MIN_STITCH_WORDS:
+        return None
+    # words at the edges of a slice are often cut or misheard, so the texts
+    # are joined in the middle of the words they agree on
+    middle = match.size // 2
+    return text[:spans[match.a + middle][0]] + next_text[next_spans[match.b + middle][0]:]
+
+
+def join_transcriptions(texts, overlapping=False):
+    """
+    Joins the transcriptions of consecutive audio slices.
+
+    Args:
+        texts (List[str]): The transcription of each slice.
+        overlapping (bool, optional): Whether each slice overlaps the next, in
+            which case the words transcribed twice are aligned and dropped once.
+
+    Returns:
+        str: The joined transcription.
+
+    Notes:
+        - The words in the overlap are aligned with difflib on lowercased words
+          without punctuation. If too few of them match, the texts are joined
+          as they are.
+        - Empty transcriptions, of slices without speech, are left out.
+        - Joining another text only changes the last STITCH_WORDS words of the
+          joined transcription, see get_stable_length.
+    """
     transcription_result = ''
     logger.info("Joining transcription results...")
-    for i, transcription_chunk in enumerate(split_transcriptions):
-        logger.debug(transcription_chunk["text"])
-        if i > 0:
-            if transcription_result[-1] != " ":
-                transcription_result += " "
-        transcription_result += transcription_chunk["text"]
+    for i, text in enumerate(texts):
+        logger.debug(text)
+        # slices of silence have nothing to join
+        if not text.strip():
+            continue
+        if transcription_result and overlapping:
+            if (stitched := _stitch(transcription_result, text)) is not None:
+                transcription_result = stitched
+                continue
+            logger.info("Could not align the transcription of slice {i} with the previous ones".format(i=i))
+        if transcription_result and transcription_result[-1] != " ":
+            transcription_result += " "
+        transcription_result += text
 
     return transcription_result
 
 
-# function to transcribe an audio file using whisper API
+def get_stable_length(transcription):
+    """
+    Returns the length of the start of a joined transcription which joining
+    the transcriptions of further overlapping slices leaves unchanged.
+    """
+    spans = _get_word_spans(transcription)
+    return spans[-STITCH_WORDS][0] if len(spans) >= STITCH_WORDS else 0
+
+
+def transcribe_file(audio_file, name, model=TranscriptionModel(name="whisper")):
+    """
+    Transcribes one in-memory audio file with the backend of the given model.
+
+    Args:
+        audio_file (memoryview): The audio file.
+        name (str): The file name sent with the file.
+        model (TranscriptionModel, optional): The transcription model, see backends.py.
+
+    Returns:
+        str: The transcription text.
+    """
+    return backends.get_backend(model.name).transcribe(audio_file, name)
+
+
+def transcribe_files(audio_files, texts=None, on_transcribed=None, model=TranscriptionModel(name="whisper")):
+    """
+    Transcribes a list of audio files.
+
+    Args:
+        audio_files (List[memoryview]): A list of in-memory audio files to be transcribed.
+        texts (List[str], optional): Transcriptions already known for some of the files,
+            None for the others. Only files without one are transcribed.
+        on_transcribed (Callable[[int, str], None], optional): Called with the index
+            and text of each file as soon as it is transcribed.
+        model (TranscriptionModel, optional): The transcription model.
+
+    Returns:
+        List[str]: The transcription of each audio file.
+    """
+    texts = list(texts) if texts is not None else [None] * len(audio_files)
+    for i, audio_file in enumerate(audio_files):
+        if texts[i] is not None:
+            logger.info("File {i}/{N} already transcribed".format(i=i + 1, N=len(audio_files)))
+            continue
+        jobs.checkpoint()
+        logger.info("Transcribing file {i}/{N}".format(i=i + 1, N=len(audio_files)))
+        texts[i] = transcribe_file(audio_file, "{i}.mp3".format(i=i), model)
+        if on_transcribed is not None:
+            on_transcribed(i, texts[i])
+
+    return texts
+
+
+def get_checkpoints(episode, model):
+    """
+    Returns the split manifest of an episode and the checkpointed transcriptions
+    of its slices from a previous attempt.
+
+    Args:
+        episode (Episode): The episode.
+        model (TranscriptionModel): The transcription model.
+
+    Returns:
+        Tuple[SplitManifest or None, List[str]]: The manifest and the text of each
+            slice, None for slices without a checkpoint.
+    """
+    if (manifest := SplitManifest.objects(episode_uuid=episode.uuid).first()) is None:
+        return None, []
+    checkpoints = {
+        (checkpoint.start, checkpoint.end): checkpoint.text
+        for checkpoint in SliceTranscription.objects(
+            episode_uuid=episode.uuid, transcription_model=model.name, unit=manifest.unit)
+    }
+    ranges = get_slice_ranges(manifest.boundaries, manifest.ends)
+    return manifest, [checkpoints.get(slice_range) for slice_range in ranges]
+
+
+def is_overlapping(manifest):
+    """
+    Returns whether the slices of a split manifest overlap.
+    """
+    return any(end > start for start, end in zip(manifest.boundaries[1:], manifest.ends or []))
+
+
+def save_checkpoint(episode, model, unit, start, end, text):
+    """
+    Saves the transcription of one audio slice.
+    """
+    SliceTranscription.objects(
+        episode_uuid=episode.uuid, transcription_model=model.name, unit=unit, start=start, end=end
+    ).update_one(upsert=True, set__text=text)
+
+
+def save_transcription(episode, model, texts, overlapping=False):
+    """
+    Joins the transcriptions of the slices of an episode, saves the result and
+    removes the slice checkpoints and the split manifest.
+
+    Args:
+        episode (Episode): The episode.
+        model (TranscriptionModel): The transcription model.
+        texts (List[str]): The transcription of each slice.
+        overlapping (bool, optional): Whether the slices overlap, see join_transcriptions.
+
+    Returns:
+        Transcription: The saved transcription.
+    """
+    transcription_result = join_transcriptions(texts, overlapping)
+    transcription = Transcription(
+        episode=episode,
+        transcription_model=model,
+        text=transcription_result
+    )
+    dedup.sign(transcription)
+    logger.debug("Saving transcription...")
+    persist.insert(transcription)
+    SliceTranscription.objects(episode_uuid=episode.uuid, transcription_model=model.name).delete()
+    # the manifest is shared by the transcription models, it goes with the last checkpoints
+    if SliceTranscription.objects(episode_uuid=episode.uuid).first() is None:
+        SplitManifest.objects(episode_uuid=episode.uuid).delete()
+    return transcription
+
+
 def transcribe(episode, model=TranscriptionModel(name="whisper")):
     """
     Transcribes the given episode using the specified transcription model.
@@ -111,19 +806,26 @@ def transcribe(episode, model=TranscriptionModel(name="whisper")):
         Transcription: The transcription of the episode.
 
     Raises:
-        Exception: If the specified model is not supported for transcription.
+        Exception: If no backend is registered for the model, see backends.py.
 
     Example:
         transcribe(episode, model=TranscriptionModel(name="whisper"))
 
     Notes:
-        - Only the "whisper" model is supported for transcription.
+        - "whisper" uses the whisper API, "whisper-local" a quantized model on the CPU.
         - The episode audio file will be downloaded and transcribed.
-        - The downloaded / generated file(s) will be deleted after transcription.
+        - Audio up to IN_MEMORY_MAX_FILE_SIZE is downloaded to memory, larger files are
+          spilled to a temporary file which is removed even if transcription fails.
+        - Downloads and transcoded slices are cached on disk (see audiocache.py), so
+          transcribing again with another model downloads nothing unless the audio changed.
+        - Slices overlap by OVERLAP_SECONDS and their transcriptions are stitched
+          where they agree, see join_transcriptions.
+        - The split manifest and each slice transcription are checkpointed as they
+          complete. A retry resumes from the missing slices, and skips the download
+          entirely if none are missing.
         - Assumption that download file extension can always be mp3
     """
-    if model.name != "whisper":
-        raise Exception("Only whisper model is supported right now for transcription")
+    backends.get_backend(model.name)
 
     if episode is None:
         raise ValueError("Episode cannot be None")
@@ -132,35 +834,36 @@ def transcribe(episode, model=TranscriptionModel(name="whisper")):
         return transcription
 
     logger.debug("Generating transcription for episode...")
-    http = urllib3.PoolManager()
-    response = http.request('GET', episode.audioUrl)
-
-    # download file to random filename
-    # TODO: does this need an extension at all?
-    tmp_filename = "{uuid}.mp3".format(uuid=str(uuid.uuid4()))
-    logger.debug("Downloading {src} to {dst}...".format(src=episode.audioUrl, dst=tmp_filename))
-    with open(tmp_filename, 'wb') as downloaded_file:
-        downloaded_file.write(response.data)
-
-    # get file splits if file needs to be split
-    audio_splits = get_audio_splits(tmp_filename)
-
-    # transcribe all splits
-    transcription_result = transcribe_files(audio_splits)
-
-    # delete downloadeded / generated file
-    logger.debug("Deleting files...")
-    if len(audio_splits) > 1:
-        audio_splits += [tmp_filename]
-    for filename in audio_splits:
-        logger.debug(filename)
-        os.remove(filename)
-
-    transcription = Transcription(
-        episode=episode,
-        transcription_model=model,
-        text=transcription_result
-    )
-    logger.debug("Saving transcription...")
-    transcription.save(cascade=True)
-    return transcription
+    manifest, texts = get_checkpoints(episode, model)
+    if manifest is None or None in texts:
+        with contextlib.ExitStack() as stack:
+            logger.debug("Downloading {src}...".format(src=episode.audioUrl))
+            jobs.report_progress(stage="downloading")
+            audio = download_audio(episode.audioUrl, stack)
+
+            # get file splits if file needs to be split, reproducing the previous split when resuming
+            if manifest is not None and manifest.size != len(audio):
+                logger.warning("Audio changed since last attempt, discarding checkpoints...")
+                manifest, texts = None, []
+            jobs.report_progress(stage="splitting")
+            (unit, boundaries, ends), audio_splits = get_audio_splits(
+                audio, (manifest.unit, manifest.boundaries, manifest.ends) if manifest else None)
+            if manifest is None:
+                manifest = SplitManifest(
+                    episode_uuid=episode.uuid, size=len(audio), unit=unit, boundaries=boundaries, ends=ends).save()
+                texts = [None] * len(audio_splits)
+            ranges = get_slice_ranges(boundaries, ends)
+
+            slices_done = sum(text is not None for text in texts)
+
+            def on_transcribed(i, text):
+                nonlocal slices_done
+                save_checkpoint(episode, model, unit, *ranges[i], text)
+                slices_done += 1
+                jobs.report_progress(slices_done=slices_done)
+
+            # transcribe all splits
+            jobs.report_progress(stage="transcribing", slices_done=slices_done, slices_total=len(texts))
+            texts = transcribe_files(audio_splits, texts, on_transcribed, model)
+
+    return save_transcription(episode, model, texts, is_overlapping(manifest))
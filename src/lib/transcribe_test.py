@@ -0,0 +1,241 @@
+import unittest
+from src.lib import transcribe
+
+# frame headers of 128kbps 44.1kHz MPEG 1 and 64kbps 22.05kHz MPEG 2 layer III
+# frames, and the length of those frames
+_MPEG1, _MPEG2 = 3, 2
+_FRAME_LENGTHS = {_MPEG1: 417, _MPEG2: 208}
+
+
+def _frame(version, mono=False):
+    # a silent layer III frame without padding
+    header = bytes((
+        0xFF,
+        0xE0 | version << 3 | 1 << 1 | 1,
+        (9 if version == _MPEG1 else 8) << 4,
+        (3 if mono else 1) << 6,
+    ))
+    frame = bytearray(_FRAME_LENGTHS[version])
+    frame[:4] = header
+    return frame
+
+
+def _tagged_frame(version, mono, offset, tag):
+    frame = _frame(version, mono)
+    frame[offset:offset + len(tag)] = tag
+    return bytes(frame)
+
+
+def _xing(name, frame_count, flags=1):
+    return name + flags.to_bytes(4, "big") + frame_count.to_bytes(4, "big")
+
+
+def _vbri(frame_count):
+    # version, delay and quality, then the size in bytes and the frame count
+    return b"VBRI" + bytes(6) + (1 << 20).to_bytes(4, "big") + frame_count.to_bytes(4, "big")
+
+
+def _mp3(num_frames, version=_MPEG1, first_frame=None, id3_size=0):
+    frame = _frame(version)
+    audio = bytearray()
+    if id3_size:
+        # syncsafe size of an ID3v2 tag without footer
+        audio += b"ID3\x04\x00\x00" + bytes((id3_size >> 21 & 0x7F, id3_size >> 14 & 0x7F,
+                                              id3_size >> 7 & 0x7F, id3_size & 0x7F))
+        audio += bytes(id3_size)
+    if first_frame is not None:
+        audio += first_frame
+        num_frames -= 1
+    audio += bytes(frame) * num_frames
+    return audio
+
+
+def _download(data, chunk_size):
+    # yields the buffer as download_audio_progressively does, filling it chunk by chunk
+    audio = memoryview(bytearray(len(data)))
+    yield audio, 0
+    for received in range(chunk_size, len(data) + chunk_size, chunk_size):
+        received = min(received, len(data))
+        audio[:received] = data[:received]
+        yield audio, received
+
+
+class StitchTest(unittest.TestCase):
+
+    def test_agreeing_overlap(self):
+        self.assertEqual(
+            transcribe._stitch("one two three four five", "three four five six seven"),
+            "one two three four five six seven")
+
+    def test_overlap_compared_without_case_and_punctuation(self):
+        self.assertEqual(
+            transcribe._stitch("we went to the end of it.", "End of it, and then home"),
+            "we went to the end of it, and then home")
+
+    def test_overlap_with_misheard_words(self):
+        # the texts are joined in the middle of the longest run of agreeing words
+        self.assertEqual(
+            transcribe._stitch("a b c d e f g h", "d x f g h i j"),
+            "a b c d e f g h i j")
+
+    def test_disagreeing_overlap(self):
+        self.assertIsNone(transcribe._stitch("one two three four", "five six seven eight"))
+        # fewer than MIN_STITCH_WORDS agreeing words are not trusted
+        self.assertIsNone(transcribe._stitch("one two three four", "three four five six"))
+
+    def test_empty_overlap(self):
+        self.assertIsNone(transcribe._stitch("", "one two three"))
+        self.assertIsNone(transcribe._stitch("one two three", ""))
+        self.assertIsNone(transcribe._stitch("one two three", " .,  "))
+
+    def test_join_without_overlap(self):
+        self.assertEqual(transcribe.join_transcriptions(["one two", "two three"]), "one two two three")
+
+    def test_join_overlapping(self):
+        self.assertEqual(
+            transcribe.join_transcriptions(["a b c d", "b c d e f", "d e f g h"], overlapping=True),
+            "a b c d e f g h")
+
+    def test_join_disagreeing_or_empty(self):
+        self.assertEqual(
+            transcribe.join_transcriptions(["one two", "three four"], overlapping=True),
+            "one two three four")
+        self.assertEqual(
+            transcribe.join_transcriptions(["", "one two", "", "three four", ""], overlapping=True),
+            "one two three four")
+
+
+class StableLengthTest(unittest.TestCase):
+
+    def test_short_transcription(self):
+        self.assertEqual(transcribe.get_stable_length(""), 0)
+        self.assertEqual(transcribe.get_stable_length("one two three"), 0)
+
+    def test_joining_never_changes_stable_prefix(self):
+        words = ["word{i}".format(i=i) for i in range(200)]
+        overlap = 5
+        texts = [
+            " ".join(words[0:60]),
+            # disagrees with the end of the previous text
+            " ".join(words[60 - overlap:100]).replace("word57", "ward57"),
+            # shares too few words with the previous text to be aligned
+            " ".join(["noise"] + words[98:130]),
+            " ".join(words[130 - transcribe.STITCH_WORDS:170]),
+            " ".join(words[170 - overlap:200]),
+        ]
+        for i in range(1, len(texts)):
+            transcription = transcribe.join_transcriptions(texts[:i], overlapping=True)
+            stable = transcription[:transcribe.get_stable_length(transcription)]
+            joined = transcribe.join_transcriptions(texts[:i + 1], overlapping=True)
+            self.assertTrue(joined.startswith(stable), (i, stable, joined))
+
+
+class FrameCountTest(unittest.TestCase):
+
+    def test_xing_and_info(self):
+        # the tag follows the side information, whose size depends on version and channels
+        for version, mono, side_info in (
+                (_MPEG1, False, 32), (_MPEG1, True, 17), (_MPEG2, False, 17), (_MPEG2, True, 9)):
+            for name in (b"Xing", b"Info"):
+                with self.subTest(version=version, mono=mono, name=name):
+                    frame = _tagged_frame(version, mono, 4 + side_info, _xing(name, 12345))
+                    self.assertEqual(transcribe._mp3_frame_count(frame, 0), 12345)
+                    # the tag is only looked for after the side information of the frame
+                    frame = _tagged_frame(version, not mono, 4 + side_info, _xing(name, 12345))
+                    self.assertIsNone(transcribe._mp3_frame_count(frame, 0))
+
+    def test_xing_without_frame_count(self):
+        frame = _tagged_frame(_MPEG1, False, 36, _xing(b"Xing", 12345, flags=0b1110))
+        self.assertIsNone(transcribe._mp3_frame_count(frame, 0))
+
+    def test_vbri(self):
+        for version in (_MPEG1, _MPEG2):
+            for mono in (False, True):
+                with self.subTest(version=version, mono=mono):
+                    frame = _tagged_frame(version, mono, 36, _vbri(54321))
+                    self.assertEqual(transcribe._mp3_frame_count(frame, 0), 54321)
+
+    def test_frame_at_offset(self):
+        audio = bytes(100) + _tagged_frame(_MPEG1, False, 36, _xing(b"Info", 777))
+        self.assertEqual(transcribe._mp3_frame_count(audio, 100), 777)
+
+    def test_no_header(self):
+        for version in (_MPEG1, _MPEG2):
+            self.assertIsNone(transcribe._mp3_frame_count(_frame(version), 0))
+
+    def test_bytes_per_second(self):
+        # constant bitrate files are measured from the bitrate of their first frame
+        audio = _mp3(1000)
+        self.assertEqual(transcribe._mp3_bytes_per_second(audio, 0, len(audio)), 16000)
+        # with a frame count, 1000 frames of 1152 samples at 44.1kHz
+        first_frame = _tagged_frame(_MPEG1, False, 36, _xing(b"Xing", 1000))
+        audio = _mp3(1000, first_frame=first_frame)
+        self.assertAlmostEqual(
+            transcribe._mp3_bytes_per_second(audio, 0, len(audio)), len(audio) / (1000 * 1152 / 44100))
+        # MPEG 2 layer III frames hold 576 samples
+        first_frame = _tagged_frame(_MPEG2, False, 4 + 17, _xing(b"Xing", 1000))
+        audio = _mp3(1000, version=_MPEG2, first_frame=first_frame)
+        self.assertAlmostEqual(
+            transcribe._mp3_bytes_per_second(audio, 0, len(audio)), len(audio) / (1000 * 576 / 22050))
+
+
+class NumSplitsTest(unittest.TestCase):
+
+    def test_size(self):
+        self.assertEqual(transcribe.get_num_splits(1000), 1)
+        self.assertEqual(transcribe.get_num_splits(transcribe.MAX_FILE_SIZE), 2)
+        self.assertEqual(transcribe.get_num_splits(4 * transcribe.MAX_FILE_SIZE), 5)
+
+    def test_duration(self):
+        # short episodes are not cut into slices shorter than MIN_SLICE_SECONDS
+        self.assertEqual(transcribe.get_num_splits(1000, 60), 1)
+        self.assertEqual(transcribe.get_num_splits(1000, 3 * transcribe.MIN_SLICE_SECONDS), 3)
+        # longer ones into at least PARALLEL_SLICES
+        self.assertEqual(transcribe.get_num_splits(1000, 1200), transcribe.PARALLEL_SLICES)
+        # and slices of at most TARGET_SLICE_SECONDS
+        self.assertEqual(transcribe.get_num_splits(1000, 3600), 6)
+        self.assertEqual(transcribe.get_num_splits(4 * transcribe.MAX_FILE_SIZE, 600), 5)
+
+
+class SplitProgressivelyTest(unittest.TestCase):
+
+    def assertSameSplits(self, data, chunk_size, manifest=None):
+        (unit, boundaries, ends), splits = transcribe.get_audio_splits(memoryview(data), manifest)
+        num_slices = []
+        progressive = list(transcribe.split_audio_progressively(
+            _download(data, chunk_size), manifest, num_slices.append))
+        self.assertEqual(num_slices, [len(splits)])
+        self.assertEqual(
+            [(slice_unit, start, end) for slice_unit, start, end, _ in progressive],
+            [(unit, start, end) for start, end in transcribe.get_slice_ranges(boundaries, ends)])
+        self.assertEqual([bytes(split) for *_, split in progressive], [bytes(split) for split in splits])
+        return unit, boundaries, ends
+
+    def test_constant_bitrate(self):
+        # 20000 frames of 128kbps audio last about 9 minutes
+        data = _mp3(20000)
+        unit, boundaries, ends = self.assertSameSplits(data, 100003)
+        self.assertEqual(unit, "bytes")
+        self.assertEqual(len(boundaries) - 1, transcribe.PARALLEL_SLICES)
+        # each slice but the last overlaps the next
+        for boundary, end in zip(boundaries[1:-1], ends[:-1]):
+            self.assertGreater(end, boundary)
+
+    def test_id3_and_xing(self):
+        first_frame = _tagged_frame(_MPEG1, False, 36, _xing(b"Xing", 20000))
+        self.assertSameSplits(_mp3(20000, first_frame=first_frame, id3_size=5000), 65536)
+
+    def test_downloaded_at_once(self):
+        self.assertSameSplits(_mp3(20000), 20000 * 417)
+
+    def test_manifest(self):
+        data = _mp3(20000)
+        manifest = self.assertSameSplits(data, 100003)
+        self.assertSameSplits(data, 100003, manifest)
+
+    def test_single_slice(self):
+        self.assertSameSplits(_mp3(1000), 4096)
+
+
+if __name__ == "__main__":
+    unittest.main()
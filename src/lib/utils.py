@@ -1,22 +1,133 @@
+import concurrent.futures
+import functools
 import logging
+import os
 import yaml
+from mongoengine import Document
+from pymongo import UpdateOne
 from src.lib.models import (
+    PREVIEW_LENGTH,
     Episode,
     Transcription,
     TranscriptionModel,
     SummarizationModel,
     Summary,
 )
+from src.lib import memo
 
 logger = logging.getLogger(__name__)
 
-# load yaml file with API keys
-KEYS = None
-with open("/.secrets/keys", "r") as f:
-    KEYS = yaml.safe_load(f)
+KEYS_PATH = "/.secrets/keys"
 
-if KEYS is None:
-    raise Exception("Could not load secrets file!")
+# tokenizer encodings preloaded by warm_up()
+WARM_UP_MODELS = ("gpt-3.5-turbo",)
+
+# threads for best effort background work such as prefetching
+BACKGROUND_WORKERS = 2
+
+# lookups of documents which never change once written, see memo.py
+_transcription_models = memo.Memo("transcription_models", TranscriptionModel._get_collection_name(), maxsize=64)
+_summarization_models = memo.Memo("summarization_models", SummarizationModel._get_collection_name(), maxsize=64)
+# transcriptions hold the whole text, so fewer are kept
+_transcriptions = memo.Memo("transcriptions", Transcription._get_collection_name(), maxsize=256)
+_summaries = memo.Memo("summaries", Summary._get_collection_name(), maxsize=4096)
+
+
+@functools.lru_cache(maxsize=None)
+def get_keys():
+    """
+    Loads the yaml file with API keys on first use.
+
+    Returns:
+        dict: The API keys.
+
+    Raises:
+        Exception: If the secrets file could not be loaded.
+    """
+    with open(KEYS_PATH, "r") as f:
+        keys = yaml.safe_load(f)
+
+    if keys is None:
+        raise Exception("Could not load secrets file!")
+    return keys
+
+
+@functools.lru_cache(maxsize=None)
+def get_openai():
+    """
+    Imports and configures the openai client on first use.
+
+    Returns:
+        module: The openai module with its API key set.
+    """
+    import openai
+    openai.api_key = get_keys()["OPENAI_KEY"]
+    return openai
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name):
+    """
+    Returns the tiktoken encoding for the given model, loading the BPE files
+    on first use.
+
+    Args:
+        model_name (str): The name of the model.
+
+    Returns:
+        tiktoken.Encoding: The encoding used by the model.
+    """
+    import tiktoken
+    return tiktoken.encoding_for_model(model_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_http():
+    """
+    Returns the process wide urllib3 pool manager, created on first use.
+    """
+    import urllib3
+    return urllib3.PoolManager()
+
+
+@functools.lru_cache(maxsize=None)
+def get_session():
+    """
+    Returns the process wide requests session, created on first use.
+    """
+    import requests
+    return requests.Session()
+
+
+@functools.lru_cache(maxsize=None)
+def get_background_executor():
+    """
+    Returns the process wide thread pool for best effort background work,
+    created on first use.
+    """
+    return concurrent.futures.ThreadPoolExecutor(BACKGROUND_WORKERS, thread_name_prefix="background")
+
+
+# connection pools and threads must not be shared with forked children
+os.register_at_fork(after_in_child=get_http.cache_clear)
+os.register_at_fork(after_in_child=get_session.cache_clear)
+os.register_at_fork(after_in_child=get_background_executor.cache_clear)
+
+
+def warm_up(model_names=WARM_UP_MODELS):
+    """
+    Preloads the upstream clients and tokenizer encodings. Meant to be called
+    once in the parent process before forking web or worker processes so
+    that children share them copy-on-write instead of loading them on their
+    first request.
+
+    Args:
+        model_names (Iterable[str], optional): The models whose encodings are preloaded.
+    """
+    logger.info("Warming up clients and tokenizers...")
+    get_openai()
+    for model_name in model_names:
+        get_encoding(model_name)
 
 
 def get_episode_if_exists(uuid):
@@ -50,14 +161,16 @@ def get_transcription_model_if_exists(name):
         TranscriptionModel or None: The retrieved transcription model if it exists, 
         otherwise None.
     """
-    transcription_model = TranscriptionModel.objects(name=name)
-    if transcription_model:
-        logger.debug("Transcription model exists")
-        if len(transcription_model) > 1:
-            logger.error("Multiple transcription models found with same name!")
-        return transcription_model[0]
-    else:
-        return None
+    def load():
+        transcription_model = TranscriptionModel.objects(name=name)
+        if transcription_model:
+            logger.debug("Transcription model exists")
+            if len(transcription_model) > 1:
+                logger.error("Multiple transcription models found with same name!")
+            return transcription_model[0]
+        else:
+            return None
+    return _transcription_models.load(name, load)
 
 
 def get_transcription_if_exists(episode, transcription_model):
@@ -70,22 +183,44 @@ def get_transcription_if_exists(episode, transcription_model):
 
     Returns:
         Transcription or None: The transcription object if it exists, otherwise None.
+
+    Notes:
+        - References are queried by id, the episode is not fetched again.
+        - The transcription is memoized and shared between threads, it must not
+          be modified, see memo.py.
     """
-    if (episode := get_episode_if_exists(episode.uuid)) is None:
-        return None
-    if (transcription_model := get_transcription_model_if_exists(
-            transcription_model.name)) is None:
-        return None
-    if (transcription := Transcription.objects(
-            episode=episode, transcription_model=transcription_model)):
-        logger.debug("Transcription exists")
-        if len(transcription) > 1:
-            logger.error("Multiple transcriptions found with same episode \
-                          and model!")
-        return transcription[0]
-    else:
+    if get_transcription_model_if_exists(transcription_model.name) is None:
         return None
 
+    def load():
+        if (transcription := Transcription.objects(
+                episode=episode, transcription_model=transcription_model)):
+            logger.debug("Transcription exists")
+            if len(transcription) > 1:
+                logger.error("Multiple transcriptions found with same episode \
+                              and model!")
+            return transcription[0]
+        else:
+            return None
+    return _transcriptions.load((episode.uuid, transcription_model.name), load)
+
+
+def forget_transcription(transcription):
+    """
+    Drops a transcription memoized by get_transcription_if_exists in this
+    process, so the next lookup loads it again after it was updated in the
+    database.
+
+    Args:
+        transcription (Transcription): The transcription.
+    """
+    # the referenced documents are not fetched for their ids
+    episode_uuid, transcription_model_name = (
+        reference.pk if isinstance(reference, Document) else reference.id
+        for reference in (transcription._data["episode"], transcription._data["transcription_model"])
+    )
+    _transcriptions.pop((episode_uuid, transcription_model_name))
+
 
 def get_summarization_model_if_exists(name):
     """
@@ -98,14 +233,16 @@ def get_summarization_model_if_exists(name):
         SummarizationModel or None: The matching summarization model object if found, 
                                    otherwise None.
     """
-    summarization_model = SummarizationModel.objects(name=name)
-    if summarization_model:
-        logger.debug("Summarization model exists")
-        if len(summarization_model) > 1:
-            logger.error("Multiple summarization models found with same name!")
-        return summarization_model[0]
-    else:
-        return None
+    def load():
+        summarization_model = SummarizationModel.objects(name=name)
+        if summarization_model:
+            logger.debug("Summarization model exists")
+            if len(summarization_model) > 1:
+                logger.error("Multiple summarization models found with same name!")
+            return summarization_model[0]
+        else:
+            return None
+    return _summarization_models.load(name, load)
 
 
 def get_summary_if_exists(transcription, summarization_model, prompt):
@@ -123,14 +260,102 @@ def get_summary_if_exists(transcription, summarization_model, prompt):
     if (summarization_model := get_summarization_model_if_exists(
             summarization_model.name)) is None:
         return None
-    if (summary := Summary.objects(
-            transcription=transcription,
-            summarization_model=summarization_model,
-            prompt=prompt)):
-        logger.debug("Summary exists")
-        if len(summary) > 1:
-            logger.error("Multiple summaries found with same transcription \
-                          and model!")
-        return summary[0]
-    else:
-        return None
+
+    def load():
+        if (summary := Summary.objects(
+                transcription=transcription,
+                summarization_model=summarization_model,
+                prompt=prompt)):
+            logger.debug("Summary exists")
+            if len(summary) > 1:
+                logger.error("Multiple summaries found with same transcription \
+                              and model!")
+            return summary[0]
+        else:
+            return None
+    return _summaries.load((transcription.pk, summarization_model.name, prompt), load)
+
+
+def get_summary_ids(episode_uuids):
+    """
+    Looks up which of the given episodes have a summary, with one query for
+    their transcriptions and one for the summaries of those.
+
+    Args:
+        episode_uuids (Iterable[str]): The episode uuids.
+
+    Returns:
+        dict[str, ObjectId]: The id of a summary of each episode that has one.
+    """
+    episodes = {
+        transcription["_id"]: transcription["episode"]
+        for transcription in Transcription.objects(episode__in=list(episode_uuids)).only("episode").as_pymongo()
+    }
+    if not episodes:
+        return {}
+    return {
+        episodes[summary["transcription"]]: summary["_id"]
+        for summary in Summary.objects(transcription__in=list(episodes)).only("transcription").as_pymongo()
+    }
+
+
+def _bulk_set(collection, updates, batch_size):
+    requests = []
+    count = 0
+    for _id, fields in updates:
+        requests.append(UpdateOne({"_id": _id}, {"$set": fields}))
+        if len(requests) == batch_size:
+            count += collection.bulk_write(requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        count += collection.bulk_write(requests, ordered=False).modified_count
+    return count
+
+
+def backfill_admin_fields(batch_size=1000):
+    """
+    Sets the denormalized fields shown by the admin list views (text_preview
+    and podcast_uuid) on transcriptions and summaries saved before they existed.
+
+    Args:
+        batch_size (int, optional): The number of updates sent per bulk write.
+
+    Returns:
+        int: The number of documents updated.
+    """
+    count = 0
+    # previews are computed by the server, the same way as models.get_preview
+    preview = {"$concat": [
+        {"$substrCP": ["$text", 0, PREVIEW_LENGTH]},
+        {"$cond": [{"$gt": [{"$strLenCP": "$text"}, PREVIEW_LENGTH]}, "...", ""]},
+    ]}
+    for document in (Transcription, Summary):
+        count += document._get_collection().update_many(
+            {"text_preview": {"$exists": False}, "text": {"$type": "string"}},
+            [{"$set": {"text_preview": preview}}],
+        ).modified_count
+
+    transcriptions = Transcription._get_collection()
+    podcasts = {
+        episode["_id"]: episode["podcast"]
+        for episode in Episode._get_collection().find({"podcast": {"$ne": None}}, {"podcast": 1})
+    }
+    count += _bulk_set(transcriptions, (
+        (transcription["_id"], {"podcast_uuid": podcasts[transcription["episode"]]})
+        for transcription in transcriptions.find({"podcast_uuid": None}, {"episode": 1})
+        if transcription.get("episode") in podcasts
+    ), batch_size)
+
+    podcasts = {
+        transcription["_id"]: transcription["podcast_uuid"]
+        for transcription in transcriptions.find({"podcast_uuid": {"$ne": None}}, {"podcast_uuid": 1})
+    }
+    summaries = Summary._get_collection()
+    count += _bulk_set(summaries, (
+        (summary["_id"], {"podcast_uuid": podcasts[summary["transcription"]]})
+        for summary in summaries.find({"podcast_uuid": None}, {"transcription": 1})
+        if summary.get("transcription") in podcasts
+    ), batch_size)
+
+    logger.info("Backfilled admin fields of {count} documents".format(count=count))
+    return count
@@ -0,0 +1,443 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import mongoengine
+from bson import ObjectId
+from src.bench import make_vocabulary, percentile
+from src.conf.flask_conf import LoadTestConfig
+from src.lib.models import (
+    CacheVersion,
+    Episode,
+    Job,
+    Podcast,
+    Profile,
+    RateLimit,
+    SearchEntry,
+    SliceTranscription,
+    SplitManifest,
+    SummarizationModel,
+    Summary,
+    Transcription,
+    TranscriptionModel,
+)
+
+logger = logging.getLogger(__name__)
+
+# traffic mix, relative weights of each kind of request
+MIX = {
+    "search": 30,
+    "browse": 40,
+    "summarize": 5,
+    "poll": 25,
+}
+
+# one 128kbps 44.1kHz MPEG 1 layer III frame, repeated to make stub episode audio
+_MP3_FRAME = b"\xff\xfb\x90\x64" + bytes(413)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # set on subclasses
+    latency = 0
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def _send(self, status, body, content_type="application/json", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+
+class TaddyStub(_StubHandler):
+    """
+    Answers the GraphQL queries made by taddy.py with podcasts p0..pN, each
+    with episodes pI-e0..eM, and serves their audio.
+    """
+    num_podcasts = 50
+    num_episodes = 200
+    audio_bytes = 417 * 1000
+
+    def _podcast(self, uuid):
+        return {
+            "uuid": uuid,
+            "name": "Podcast {uuid}".format(uuid=uuid),
+            "itunesId": zlib.crc32(uuid.encode()),
+            "description": "A stub podcast.",
+            "imageUrl": "https://example.com/{uuid}.png".format(uuid=uuid),
+            "totalEpisodesCount": self.num_episodes,
+        }
+
+    def _episode(self, uuid):
+        return {
+            "uuid": uuid,
+            "name": "Episode {uuid}".format(uuid=uuid),
+            "description": "A stub episode.",
+            "audioUrl": "http://{host}/audio/{uuid}.mp3".format(host=self.headers["Host"], uuid=uuid),
+        }
+
+    def do_POST(self):
+        time.sleep(self.latency)
+        query = json.loads(self._read_body())["query"]
+        if (match := re.search(r'getPodcastEpisode\(uuid:"([^"]+)"\)', query)):
+            episode = self._episode(match.group(1))
+            episode["podcastSeries"] = {"uuid": match.group(1).split("-")[0]}
+            data = {"getPodcastEpisode": episode}
+        else:
+            match = re.search(r'getPodcastSeries\((name|uuid):"([^"]*)"\)', query)
+            uuid = match.group(2) if match.group(1) == "uuid" else \
+                "p{i}".format(i=zlib.crc32(match.group(2).encode()) % self.num_podcasts)
+            podcast = self._podcast(uuid)
+            if (match := re.search(r"episodes\(page:(\d+),limitPerPage:(\d+)\)", query)):
+                page, limit = int(match.group(1)), int(match.group(2))
+                podcast["episodes"] = [
+                    self._episode("{uuid}-e{i}".format(uuid=uuid, i=i))
+                    for i in range((page - 1) * limit, min(page * limit, self.num_episodes))
+                ]
+            data = {"getPodcastSeries": podcast}
+        self._send(200, json.dumps({"data": data}).encode())
+
+    def do_GET(self):
+        etag = '"{size}"'.format(size=self.audio_bytes)
+        if self.headers.get("If-None-Match") == etag:
+            self._send(304, b"", headers=[("ETag", etag)])
+            return
+        time.sleep(self.latency)
+        audio = _MP3_FRAME * (self.audio_bytes // len(_MP3_FRAME))
+        self._send(200, audio, "audio/mpeg", headers=[("ETag", etag)])
+
+
+class OpenAIStub(_StubHandler):
+    """
+    Answers chat completion and audio transcription requests with fixed text.
+    """
+
+    def do_POST(self):
+        body = self._read_body()
+        time.sleep(self.latency)
+        if self.path.endswith("/audio/transcriptions"):
+            response = {"text": "This is a stub transcription of {n} bytes of audio. ".format(n=len(body)) * 20}
+        else:
+            response = {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "gpt-3.5-turbo",
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "- A stub summary point.\n" * 5},
+                    "finish_reason": "stop",
+                }],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+        self._send(200, json.dumps(response).encode())
+
+
+def start_stub(handler, latency, **attributes):
+    """
+    Starts a stub server in a background thread.
+
+    Returns:
+        Tuple[ThreadingHTTPServer, str]: The server and its base url.
+    """
+    handler = type(handler.__name__, (handler,), dict(latency=latency, **attributes))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{port}".format(port=server.server_address[1])
+
+
+def serve(args):
+    """
+    Runs the web app against the stub servers, optionally with in-process
+    worker slots summarizing the episodes users ask for.
+    """
+    from werkzeug.serving import make_server
+    from src.lib import taddy, utils
+    from src.wsgi import create_app
+
+    keys_file = tempfile.NamedTemporaryFile("w", suffix=".yaml", delete=False)
+    keys_file.write("OPENAI_KEY: loadtest\nTADDY_USER_ID: loadtest\nTADDY_KEY: loadtest\n")
+    keys_file.close()
+    utils.KEYS_PATH = keys_file.name
+    taddy.ENDPOINT = args.taddy_url
+    app = create_app("src.conf.flask_conf.LoadTestConfig")
+    utils.get_openai().api_base = args.openai_url + "/v1"
+
+    if args.worker_slots:
+        from src.worker import work
+        stopped = threading.Event()
+        for i in range(args.worker_slots):
+            threading.Thread(target=work, args=(stopped,), name="worker-{i}".format(i=i), daemon=True).start()
+
+    make_server("127.0.0.1", args.port, app, threaded=True).serve_forever()
+
+
+def seed(args, words, weights):
+    """
+    Fills the scratch database with summarized episodes of the stub podcasts.
+    """
+    rng = random.Random(args.seed)
+    TranscriptionModel.objects(name="whisper").update_one(upsert=True, set__name="whisper")
+    SummarizationModel.objects(name="gpt-3.5-turbo").update_one(upsert=True, set__name="gpt-3.5-turbo")
+    podcasts, episodes, transcriptions, summaries, entries = {}, [], [], [], []
+    for i in range(args.summaries):
+        podcast_uuid = "p{i}".format(i=rng.randrange(TaddyStub.num_podcasts))
+        podcasts[podcast_uuid] = {"_id": podcast_uuid, "name": "Podcast {uuid}".format(uuid=podcast_uuid)}
+        # episodes beyond the stub catalog so summarize requests mostly ask for new ones
+        episode_uuid = "{podcast}-e{i}".format(podcast=podcast_uuid, i=TaddyStub.num_episodes + i)
+        episode_name = " ".join(rng.choices(words, weights, k=6))
+        transcription_text = " ".join(rng.choices(words, weights, k=args.transcript_words))
+        summary_text = " ".join(rng.choices(words, weights, k=150))
+        transcription_id, summary_id = ObjectId(), ObjectId()
+        now = datetime.utcnow()
+        episodes.append({"_id": episode_uuid, "name": episode_name, "podcast": podcast_uuid})
+        transcriptions.append({
+            "_id": transcription_id, "episode": episode_uuid, "transcription_model": "whisper",
+            "podcast_uuid": podcast_uuid, "text": transcription_text, "creation_date": now,
+        })
+        summaries.append({
+            "_id": summary_id, "transcription": transcription_id, "summarization_model": "gpt-3.5-turbo",
+            "podcast_uuid": podcast_uuid, "prompt": "auto", "text": summary_text, "creation_date": now,
+        })
+        entries.append({
+            "summary": summary_id, "episode_uuid": episode_uuid, "episode_name": episode_name,
+            "podcast_uuid": podcast_uuid, "podcast_name": podcasts[podcast_uuid]["name"],
+            "summary_text": summary_text, "transcription_text": transcription_text, "creation_date": now,
+        })
+    for document_class, documents in ((Podcast, list(podcasts.values())), (Episode, episodes),
+                                      (Transcription, transcriptions), (Summary, summaries),
+                                      (SearchEntry, entries)):
+        if documents:
+            document_class._get_collection().insert_many(documents)
+    SearchEntry.ensure_indexes()
+    logger.info("Seeded {n} summaries".format(n=args.summaries))
+
+
+def sample_process(pid):
+    """
+    Returns the thread count and resident memory in MB of a process.
+    """
+    with open("/proc/{pid}/status".format(pid=pid)) as f:
+        status = dict(line.split(":", 1) for line in f if ":" in line)
+    return int(status["Threads"]), int(status["VmRSS"].split()[0]) / 1024
+
+
+class Client:
+    """
+    Makes one kind of request at a time like a browser would, remembering
+    the ETag of the summaries page to revalidate it when polling.
+    """
+
+    def __init__(self, base_url, words, rng):
+        import requests
+        self.session = requests.Session()
+        self.base_url = base_url
+        self.words = words
+        self.rng = rng
+        self.summaries_etag = None
+
+    def request(self, kind):
+        rng = self.rng
+        podcast_uuid = "p{i}".format(i=rng.randrange(TaddyStub.num_podcasts))
+        if kind == "search":
+            return self.session.get(self.base_url + "/search", params={
+                "q": " ".join(rng.sample(self.words[len(self.words) // 100:len(self.words) // 10], rng.randint(1, 2))),
+                "page": rng.choice((1, 1, 1, 2)),
+            })
+        if kind == "browse":
+            if rng.random() < 0.2:
+                return self.session.post(self.base_url + "/podcast_search", data={"term": rng.choice(self.words)})
+            return self.session.get(self.base_url + "/episodes", params={
+                "podcast_uuid": podcast_uuid,
+                "page": min(int(rng.expovariate(0.5)) + 1, TaddyStub.num_episodes // 10),
+            })
+        if kind == "summarize":
+            return self.session.get(self.base_url + "/summaries", params={
+                "episode_uuid": "{podcast}-e{i}".format(podcast=podcast_uuid, i=rng.randrange(TaddyStub.num_episodes)),
+            })
+        headers = {"If-None-Match": self.summaries_etag} if self.summaries_etag else {}
+        response = self.session.get(self.base_url + "/summaries", headers=headers)
+        self.summaries_etag = response.headers.get("ETag", self.summaries_etag)
+        return response
+
+
+def run(args):
+    """
+    Starts the stubs and the app, sends requests at args.rate per second in
+    the configured mix for args.duration seconds and reports latencies, error
+    rates and the thread count and memory of the app over time.
+    """
+    words, weights = make_vocabulary(args.vocabulary, args.seed)
+    # always the scratch database the app is served from, never the real one
+    mongoengine.connect(db=LoadTestConfig.MONGODB_DB, host="localhost", port=27017)
+    # including jobs and other state a --keep run left behind
+    for document_class in (Podcast, Episode, Transcription, Summary, SearchEntry, Job, CacheVersion,
+                           RateLimit, SplitManifest, SliceTranscription, Profile):
+        document_class.drop_collection()
+    seed(args, words, weights)
+
+    _, taddy_url = start_stub(TaddyStub, args.taddy_latency / 1000)
+    _, openai_url = start_stub(OpenAIStub, args.openai_latency / 1000)
+    port = args.port
+    app = subprocess.Popen([
+        sys.executable, "-m", "src.loadtest", "-ll", args.log_level, "serve",
+        "--port", str(port), "--taddy_url", taddy_url, "--openai_url", openai_url,
+        "--worker_slots", str(args.worker_slots),
+    ])
+    base_url = "http://127.0.0.1:{port}".format(port=port)
+
+    import requests
+    for _ in range(100):
+        try:
+            requests.get(base_url + "/", timeout=1)
+            break
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    else:
+        app.terminate()
+        raise Exception("App did not start")
+
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    samples = []
+    lock = threading.Lock()
+    rng = random.Random(args.seed)
+    clients = threading.local()
+    kinds, kind_weights = zip(*MIX.items())
+
+    def request(kind):
+        if not hasattr(clients, "client"):
+            clients.client = Client(base_url, words, random.Random(rng.random()))
+        start = time.perf_counter()
+        try:
+            ok = clients.client.request(kind).status_code < 400
+        except requests.RequestException:
+            ok = False
+        with lock:
+            latencies[kind].append(time.perf_counter() - start)
+            if not ok:
+                errors[kind] += 1
+
+    stopped = threading.Event()
+
+    def sample():
+        start = time.perf_counter()
+        while not stopped.wait(args.sample_interval):
+            threads, rss = sample_process(app.pid)
+            with lock:
+                done = sum(len(values) for values in latencies.values())
+            samples.append({"t": time.perf_counter() - start, "threads": threads, "rss_mb": rss, "requests": done})
+            logger.info("t={t:.0f}s threads={threads} rss={rss:.0f}MB requests={requests}".format(
+                t=samples[-1]["t"], threads=threads, rss=rss, requests=done))
+
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+    try:
+        # open loop: requests are sent on schedule however long earlier ones take
+        with concurrent.futures.ThreadPoolExecutor(args.clients) as executor:
+            start = time.perf_counter()
+            next_request = start
+            while next_request - start < args.duration:
+                time.sleep(max(0, next_request - time.perf_counter()))
+                executor.submit(request, rng.choices(kinds, kind_weights)[0])
+                next_request += rng.expovariate(args.rate)
+        elapsed = time.perf_counter() - start
+    finally:
+        stopped.set()
+        sampler.join()
+        app.terminate()
+        app.wait()
+
+    result = {"rate": args.rate, "elapsed": elapsed, "kinds": {}, "samples": samples}
+    for kind in kinds:
+        values = latencies[kind]
+        result["kinds"][kind] = {
+            "n": len(values),
+            "errors": errors[kind],
+            "error_rate": errors[kind] / len(values) if values else 0,
+            "p50": percentile(values, 50),
+            "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+        }
+        logger.info("{kind}: n={n} errors={error_rate:.1%} p50={p50:.1f}ms p95={p95:.1f}ms p99={p99:.1f}ms".format(
+            kind=kind, n=len(values), error_rate=result["kinds"][kind]["error_rate"],
+            p50=percentile(values, 50) * 1000, p95=percentile(values, 95) * 1000, p99=percentile(values, 99) * 1000))
+    total = sum(len(values) for values in latencies.values())
+    logger.info("total: {n} requests in {t:.0f}s ({rate:.1f}/s), errors={error_rate:.1%}, "
+                "max threads={threads}, max rss={rss:.0f}MB".format(
+                    n=total, t=elapsed, rate=total / elapsed,
+                    error_rate=sum(errors.values()) / total if total else 0,
+                    threads=max((sample["threads"] for sample in samples), default=0),
+                    rss=max((sample["rss_mb"] for sample in samples), default=0)))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if not args.keep:
+        mongoengine.get_db().client.drop_database(LoadTestConfig.MONGODB_DB)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Load tests the web app against stub Taddy and OpenAI servers and a scratch database.")
+    log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+    parser.add_argument(
+        "-ll", "--log_level", choices=log_levels,
+        default="INFO", help="The log level (default: INFO)"
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run a load test.")
+    run_parser.add_argument("--rate", type=float, default=20, help="Requests per second (default: 20)")
+    run_parser.add_argument("--duration", type=float, default=60, help="Seconds (default: 60)")
+    run_parser.add_argument("--clients", type=int, default=64,
+                            help="Maximum concurrent requests (default: 64)")
+    run_parser.add_argument("--port", type=int, default=5050)
+    run_parser.add_argument("--worker_slots", type=int, default=0,
+                            help="Worker slots run in the app process to summarize requested episodes (default: 0)")
+    run_parser.add_argument("--taddy_latency", type=float, default=150, help="Stub Taddy latency in ms")
+    run_parser.add_argument("--openai_latency", type=float, default=2000, help="Stub OpenAI latency in ms")
+    run_parser.add_argument("--summaries", type=int, default=500, help="Summaries seeded (default: 500)")
+    run_parser.add_argument("--transcript_words", type=int, default=2000)
+    run_parser.add_argument("--vocabulary", type=int, default=20000)
+    run_parser.add_argument("--sample_interval", type=float, default=5,
+                            help="Seconds between thread and memory samples (default: 5)")
+    run_parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    run_parser.add_argument("--output", help="Write the results as JSON to this file.")
+    run_parser.add_argument("--keep", action="store_true", help="Keep the scratch database.")
+    run_parser.set_defaults(func=run)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the app against stub servers, started by run.")
+    serve_parser.add_argument("--port", type=int, required=True)
+    serve_parser.add_argument("--taddy_url", required=True)
+    serve_parser.add_argument("--openai_url", required=True)
+    serve_parser.add_argument("--worker_slots", type=int, default=0)
+    serve_parser.set_defaults(func=serve)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+    args.func(args)
@@ -0,0 +1,28 @@
+import argparse
+import logging
+import mongoengine
+from src.lib import search, utils
+
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Rebuild the full-text search index from all saved summaries and backfill "
+                    "the fields shown by admin list views."
+    )
+    log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+    parser.add_argument(
+        "-ll", "--log_level", choices=log_levels,
+        default="INFO", help="The log level (default: INFO)"
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    mongoengine.connect(db="summpods", host="localhost", port=27017)
+    utils.backfill_admin_fields()
+    search.rebuild_index()
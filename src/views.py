@@ -1,14 +1,30 @@
+import hashlib
 import logging
+import math
 import threading
+import zlib
+from datetime import datetime, timezone
+import markdown
+from markdown.extensions import Extension
 from flask import (
     Blueprint,
+    Response,
+    abort,
+    jsonify,
+    make_response,
     render_template,
     request,
+    stream_with_context,
 )
+from markupsafe import Markup
 from src.lib import (
+    export,
     taddy,
-    summarize,
+    search,
+    pipeline,
+    utils,
 )
+from src.lib import memo
 from src.lib.models import (
     Summary,
 )
@@ -17,6 +33,133 @@ logger = logging.getLogger(__name__)
 
 bp = Blueprint("home", __name__)
 
+EPISODES_PER_PAGE = 10
+# how long that an episode has no summary is remembered if the broadcast of a new
+# summary is missed, see memo.py
+SUMMARY_STATUS_TTL = 60
+
+# rendered summary cards keyed by summary id, summaries never change once saved
+_summary_cards = memo.Memo("summary_cards", Summary._get_collection_name(), maxsize=4096)
+# summary id, or False if there is none, keyed by episode uuid
+_summary_status = memo.Memo(
+    "summary_status", Summary._get_collection_name(), maxsize=16384, negative_ttl=SUMMARY_STATUS_TTL)
+# ids and creation dates of all summaries, newest first, keyed by the write
+# counts of the summary collection so polling clients share one query per change
+_summary_heads = memo.Memo("summary_heads", Summary._get_collection_name(), maxsize=4)
+# episode pages being prefetched, so concurrent requests prefetch each page once
+_prefetching = set()
+_prefetching_lock = threading.Lock()
+
+
+class _NoRawHTML(Extension):
+    # without the raw HTML processors, HTML in the text is escaped like any other text
+    def extendMarkdown(self, md):
+        md.preprocessors.deregister("html_block")
+        md.inlinePatterns.deregister("html")
+
+
+@bp.app_template_filter("markdown")
+def markdown_filter(text):
+    """
+    Renders markdown generated by the summarization model to HTML. Raw HTML in
+    model output is displayed rather than rendered, while blockquotes and
+    entities are converted as usual.
+    """
+    return Markup(markdown.markdown(text or "", extensions=[_NoRawHTML()]))
+
+
+def make_etag(*parts):
+    """
+    Builds an ETag from the given parts.
+    """
+    return hashlib.sha1(":".join(str(part) for part in parts).encode()).hexdigest()
+
+
+def conditional_response(etag, last_modified, render):
+    """
+    Returns 304 Not Modified if the client's cached copy matches etag or is not
+    older than last_modified, otherwise calls render to build the page.
+
+    Args:
+        etag (str): The ETag of the current page contents.
+        last_modified (datetime or None): When the page contents last changed (UTC).
+        render (Callable[[], str]): Renders the page.
+
+    Returns:
+        Response: The response with validators set.
+    """
+    if last_modified is not None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(etag)
+    else:
+        not_modified = (last_modified is not None and request.if_modified_since is not None and
+                        last_modified <= request.if_modified_since)
+
+    response = Response(status=304) if not_modified else make_response(render())
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    # allow caching but always revalidate so new summaries show up on refresh
+    response.cache_control.no_cache = True
+    return response
+
+
+def render_summary_cards(summary_ids):
+    """
+    Returns the rendered card for each summary id, rendering and caching only
+    those that have not been rendered before.
+    """
+    missing = [summary_id for summary_id in summary_ids if _summary_cards.get(summary_id) is None]
+    if missing:
+        for summary in Summary.objects(id__in=missing):
+            _summary_cards.set(summary.id, Markup(render_template("summary_card.html", summary=summary)))
+    return [card for summary_id in summary_ids if (card := _summary_cards.get(summary_id)) is not None]
+
+
+def get_summary_status(episodes):
+    """
+    Returns the summary id of each episode that has a summary, looking up the
+    episodes whose status is not cached in one batched query.
+
+    Args:
+        episodes (List[Episode]): The episodes.
+
+    Returns:
+        dict[str, ObjectId]: The summary id of each summarized episode.
+    """
+    missing = [episode.uuid for episode in episodes if _summary_status.get(episode.uuid) is None]
+    if missing:
+        summary_ids = utils.get_summary_ids(missing)
+        for uuid in missing:
+            _summary_status.set(uuid, summary_ids.get(uuid, False))
+    return {
+        episode.uuid: summary_id
+        for episode in episodes if (summary_id := _summary_status.get(episode.uuid))
+    }
+
+
+def _prefetch_episodes(podcast, page):
+    try:
+        get_summary_status(taddy.get_episodes(podcast, page=page, limitPerPage=EPISODES_PER_PAGE))
+    except Exception:
+        logger.exception("Prefetching page {page} of {uuid} failed".format(page=page, uuid=podcast.uuid))
+    finally:
+        with _prefetching_lock:
+            _prefetching.discard((podcast.uuid, page))
+
+
+def prefetch_episodes(podcast, page):
+    """
+    Fetches a page of episodes and their summary status in the background so
+    navigating to it is served from the caches.
+    """
+    with _prefetching_lock:
+        if (podcast.uuid, page) in _prefetching:
+            return
+        _prefetching.add((podcast.uuid, page))
+    utils.get_background_executor().submit(_prefetch_episodes, podcast, page)
+
 
 @bp.route("/")
 def index():
@@ -43,13 +186,31 @@ def podcast_index():
 @bp.route("/episodes")
 def episodes():
     podcast_uuid = request.args["podcast_uuid"]
+    page = max(1, request.args.get("page", 1, type=int))
     podcast = taddy.search_or_get_podcast(uuid=podcast_uuid)
-    episodes = taddy.get_episodes(podcast)
+    episodes = taddy.get_episodes(podcast, page=page, limitPerPage=EPISODES_PER_PAGE)
+    summary_ids = get_summary_status(episodes)
+    # the episode count is not always known, in which case a full page implies there may be more
+    if podcast.episodeCount:
+        pages = math.ceil(podcast.episodeCount / EPISODES_PER_PAGE)
+    else:
+        pages = page + 1 if len(episodes) == EPISODES_PER_PAGE else page
     data = {
         "title": "Episodes",
+        "podcast": podcast,
         "episodes": episodes,
+        "summary_ids": summary_ids,
+        "page": page,
+        "pages": pages,
     }
-    return render_template("episodes.html", **data)
+    etag = make_etag("episodes", podcast_uuid, page, *[
+        "{uuid}={summary_id}".format(uuid=episode.uuid, summary_id=summary_ids.get(episode.uuid))
+        for episode in episodes
+    ])
+    response = conditional_response(etag, None, lambda: render_template("episodes.html", **data))
+    if page < pages:
+        prefetch_episodes(podcast, page + 1)
+    return response
 
 
 @bp.route("/summaries")
@@ -60,13 +221,87 @@ def summaries():
     if episode_uuid:
         summary_request = True
         episode = taddy.get_episode(episode_uuid)
-        # TODO: simply using threads for this won't scale eventually if traffic was high
-        threading.Thread(target=summarize.transcribe_and_summarize, args=(episode,)).start()
-    # get summaries to display on page
-    summaries = Summary.objects().order_by("-creation_date")
+        # queued in the interactive lane ahead of backfills, see worker.py; duplicate
+        # requests share the queued job and move a backfill job up to this lane
+        # profiled at PROFILE_SAMPLE_RATE, profiling on demand is left to app.py --profile
+        pipeline.enqueue(episode)
+    # get summaries to display on page, the page only changes when a summary is added or removed
+    summary_heads = _summary_heads.load(
+        memo.get_version(Summary._get_collection_name()),
+        lambda: list(Summary.objects().order_by("-creation_date").only("id", "creation_date")))
+    summary_ids = [summary.id for summary in summary_heads]
+    last_modified = summary_heads[0].creation_date if summary_heads else None
+    etag = make_etag("summaries", summary_request, *summary_ids)
+
+    def render():
+        data = {
+            "title": "Summaries",
+            "cards": render_summary_cards(summary_ids),
+            "summary_request": summary_request,
+        }
+        return render_template("summaries.html", **data)
+
+    return conditional_response(etag, last_modified, render)
+
+
+@bp.route("/stats/cache")
+def cache_stats():
+    """
+    Returns the size, hits, misses, evictions and hit rate of each memo of
+    the process serving the request as JSON.
+    """
+    return jsonify(memo.get_stats())
+
+
+@bp.route("/search")
+def search_summaries():
+    query = request.args.get("q", "").strip()
+    page = max(1, request.args.get("page", 1, type=int))
     data = {
-        "title": "Summaries",
-        "summaries": summaries,
-        "summary_request": summary_request,
+        "title": "Search",
+        "query": query,
+        "page": page,
     }
-    return render_template("summaries.html", **data)
+    if query:
+        data.update(search.search(query, page=page))
+    return render_template("search.html", **data)
+
+
+def _gzip(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        if (data := compressor.compress(chunk.encode())):
+            yield data
+    yield compressor.flush()
+
+
+@bp.route("/export/<kind>")
+def export_records(kind):
+    """
+    Streams summaries or transcriptions as newline delimited JSON, gzipped if
+    the client accepts it. Query parameters: since (ISO date, UTC),
+    podcast_uuid, model, cursor (the id of the last record received, to resume
+    an interrupted export), batch_size and text=0 to leave out texts.
+    """
+    if kind not in export.KINDS:
+        abort(404)
+    try:
+        since = request.args.get("since")
+        kwargs = {
+            "since": datetime.fromisoformat(since) if since else None,
+            "podcast_uuid": request.args.get("podcast_uuid"),
+            "model": request.args.get("model"),
+            "cursor": request.args.get("cursor"),
+            "batch_size": request.args.get("batch_size", export.DEFAULT_BATCH_SIZE, type=int),
+            "include_text": request.args.get("text") != "0",
+        }
+        export.get_filter(kind, kwargs["since"], kwargs["podcast_uuid"], kwargs["model"], kwargs["cursor"])
+    except ValueError as e:
+        abort(400, str(e))
+
+    chunks = export.export_ndjson(kind, **kwargs)
+    headers = {"Vary": "Accept-Encoding"}
+    if "gzip" in request.accept_encodings:
+        chunks = _gzip(chunks)
+        headers["Content-Encoding"] = "gzip"
+    return Response(stream_with_context(chunks), mimetype="application/x-ndjson", headers=headers)
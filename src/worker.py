@@ -0,0 +1,113 @@
+import argparse
+import logging
+import signal
+import threading
+import mongoengine
+from src.lib import jobs, pipeline, taddy, utils
+from src.lib.models import (
+    SummarizationModel,
+    TranscriptionModel,
+)
+
+logger = logging.getLogger(__name__)
+
+# how long an idle worker waits before looking for queued jobs again
+IDLE_SECONDS = 2
+
+
+def work(stopped):
+    """
+    Claims and runs queued jobs until stopped is set.
+    """
+    while not stopped.is_set():
+        owner = jobs.get_owner()
+        if (job := jobs.claim(owner)) is None:
+            stopped.wait(IDLE_SECONDS)
+            continue
+        try:
+            pipeline.run_job(job, owner)
+        except jobs.Preempted as e:
+            logger.info(e)
+        except Exception:
+            logger.exception("Job {key} failed".format(key=job.key))
+
+
+def run(args):
+    """
+    Runs args.slots jobs at a time, of which lower lanes leave
+    jobs.RESERVED_SLOTS free for interactive jobs. A job interrupted by
+    stopping the worker is claimed by another worker once its lease expires.
+    """
+    # jobs run here, not in the web app, so this is the process to warm up
+    utils.warm_up()
+    jobs.SLOTS = args.slots
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopped.set())
+    threads = [
+        threading.Thread(target=work, args=(stopped,), name="worker-{i}".format(i=i), daemon=True)
+        for i in range(args.slots)
+    ]
+    for thread in threads:
+        thread.start()
+    logger.info("Started {n} worker slots".format(n=args.slots))
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        stopped.set()
+    logger.info("Stopping...")
+
+
+def enqueue(args):
+    """
+    Queues the summarization of a podcast's episodes in a lower lane, e.g. to
+    backfill a newly added podcast or to redo its summaries with another model.
+    """
+    podcast = taddy.search_or_get_podcast(uuid=args.podcast_uuid)
+    if podcast is None:
+        raise Exception("Podcast {uuid} not found".format(uuid=args.podcast_uuid))
+    count = 0
+    for page in range(1, args.pages + 1):
+        for episode in taddy.get_episodes(podcast, page=page, limitPerPage=25):
+            pipeline.enqueue(
+                episode,
+                lane=args.lane,
+                transcription_model=TranscriptionModel(name=args.transcription_model),
+                summarization_model=SummarizationModel(name=args.summarization_model),
+            )
+            count += 1
+    logger.info("Queued {count} episodes of {name} in lane {lane}".format(
+        count=count, name=podcast.name, lane=args.lane))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs queued summarization jobs, or queues them.")
+    log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+    parser.add_argument(
+        "-ll", "--log_level", choices=log_levels,
+        default="INFO", help="The log level (default: INFO)"
+    )
+    parser.set_defaults(func=run, slots=4)
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser("run", help="Run queued jobs (default).")
+    run_parser.add_argument("--slots", type=int, default=4, help="Jobs run at once (default: 4)")
+    run_parser.set_defaults(func=run)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Queue the episodes of a podcast.")
+    enqueue_parser.add_argument("--podcast_uuid", required=True)
+    enqueue_parser.add_argument("--lane", choices=(jobs.BACKFILL, jobs.RESUMMARIZE), default=jobs.BACKFILL)
+    enqueue_parser.add_argument("--pages", type=int, default=1, help="Pages of 25 episodes (default: 1)")
+    enqueue_parser.add_argument("--transcription_model", default="whisper")
+    enqueue_parser.add_argument("--summarization_model", default="gpt-3.5-turbo")
+    enqueue_parser.set_defaults(func=enqueue)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=args.log_level)
+
+    mongoengine.connect(db="summpods", host="localhost", port=27017)
+    args.func(args)
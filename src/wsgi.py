@@ -4,7 +4,7 @@ from flask import Flask
 from flask_admin import Admin
 from flask_material import Material
 from flask_mongoengine import MongoEngine
-from src.lib import models
+from src.lib import models, profiling, utils
 
 logger = logging.getLogger(__name__)
 
@@ -21,12 +21,15 @@ def parse_args():
 
 def create_app(config_filename="src.conf.flask_conf.BaseConfig"):
     app = Flask(__name__)
+    app.config.from_object(config_filename)
 
     # init MongoDB connection
     app.config["MONGODB_SETTINGS"] = {
-        "db": "summpods",
+        "db": app.config["MONGODB_DB"],
         "host": "localhost",
-        "port": 27017
+        "port": 27017,
+        # defer connecting until first use so the client is created after fork
+        "connect": False,
     }
     db = MongoEngine()
     db.init_app(app)
@@ -40,8 +43,13 @@ def create_app(config_filename="src.conf.flask_conf.BaseConfig"):
     admin.add_view(models.EpisodeView(models.Episode))
     admin.add_view(models.TranscriptionView(models.Transcription))
     admin.add_view(models.SummaryView(models.Summary))
+    admin.add_view(models.JobView(models.Job))
+    admin.add_view(models.ProfileView(models.Profile))
 
-    app.config.from_object(config_filename)
+    profiling.SAMPLE_RATE = app.config["PROFILE_SAMPLE_RATE"]
+
+    # preload clients and tokenizers so forked workers share them
+    utils.warm_up()
 
     from src.views import bp
     app.register_blueprint(bp)